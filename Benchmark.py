@@ -0,0 +1,285 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import Downloader
+from Downloader import BuildSponsorSegments, colors
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak memory is then left out of the results
+    resource = None
+
+
+# Benchmarks for the ffmpeg side of Downloader.py. Everything runs offline on
+# synthetic lavfi sources, so results only depend on the machine and ffmpeg build.
+
+
+def GenerateSource(path, size="320x180", rate=60, duration=120):
+
+    # Deterministic test media: testsrc2 video and a sine tone, cheap to decode
+    command = [
+        'ffmpeg', '-v', 'error',
+        '-f', 'lavfi', '-i', f"testsrc2=size={size}:rate={rate}:duration={duration}",
+        '-f', 'lavfi', '-i', f"sine=frequency=440:sample_rate=48000:duration={duration}",
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-g', str(rate * 2),
+        '-c:a', 'aac', '-b:a', '128k',
+        '-y', str(path)
+    ]
+    subprocess.run(command, check=True)
+    return path
+
+
+def SyntheticSponsors(count, duration):
+
+    # Evenly spaced segments that together cover a third of the source
+    if count == 0:
+        return []
+    slot = duration / (count + 1)
+    length = slot / 3
+    return [{"segment": [slot * (i + 1), slot * (i + 1) + length], "category": "sponsor"} for i in range(count)]
+
+
+def LegacySelectFilters(sponsors):
+
+    # The old per-frame select/aselect expression, kept here only as a point of comparison
+    expr = " * ".join(f"not(between(t\\,{sp['segment'][0]}\\,{sp['segment'][1]}))" for sp in sponsors)
+    return ['-vf', f"select={expr},setpts=N/FRAME_RATE/TB", '-af', f"aselect={expr},asetpts=N/SR/TB"]
+
+
+def TimeFfmpeg(args):
+
+    # Wall time of one ffmpeg run that decodes, filters and throws the result away
+    start = time.perf_counter()
+    subprocess.run(['ffmpeg', '-v', 'error', *args, '-f', 'null', '-'], check=True)
+    return time.perf_counter() - start
+
+
+def BenchmarkFilterCost(source, duration, counts, repeat=3):
+
+    # Compares the cost of the sponsor filters as the number of segments grows
+    results = []
+    for count in counts:
+        sponsors = SyntheticSponsors(count, duration)
+
+        graph, maps = BuildSponsorSegments(sponsors, video_input="0:v", audio_input="0:a")
+        cut_time = min(TimeFfmpeg(['-i', str(source), '-filter_complex', graph, *maps]) for _ in range(repeat))
+
+        select_time = None
+        if sponsors:
+            select_time = min(TimeFfmpeg(['-i', str(source), *LegacySelectFilters(sponsors)]) for _ in range(repeat))
+
+        results.append({"segments": count, "segment_concat_s": round(cut_time, 3),
+                        "select_s": round(select_time, 3) if select_time is not None else None})
+
+        legacy = f"{select_time:.2f}s" if select_time is not None else "-"
+        print(f"{colors.BLUE}{count:>5} segment(s){colors.ENDC}  segment/concat: {cut_time:.2f}s  select: {legacy}")
+
+    return results
+
+
+def GenerateMedia(directory, size, duration, rate=30):
+
+    # Separate video and audio files, like the ones Downloader() leaves behind.
+    # bitexact keeps the files identical between runs.
+    video_file = Path(directory) / f"video_{size}_{duration}s.mp4"
+    audio_file = Path(directory) / f"audio_{duration}s.m4a"
+
+    if not video_file.exists():
+        subprocess.run([
+            'ffmpeg', '-v', 'error',
+            '-f', 'lavfi', '-i', f"testsrc2=size={size}:rate={rate}:duration={duration}",
+            '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '18', '-g', str(rate * 2),
+            '-fflags', '+bitexact', '-map_metadata', '-1',
+            '-y', str(video_file)
+        ], check=True)
+
+    if not audio_file.exists():
+        subprocess.run([
+            'ffmpeg', '-v', 'error',
+            '-f', 'lavfi', '-i', f"sine=frequency=440:sample_rate=48000:duration={duration}",
+            '-c:a', 'aac', '-b:a', '128k',
+            '-fflags', '+bitexact', '-map_metadata', '-1',
+            '-y', str(audio_file)
+        ], check=True)
+
+    return video_file, audio_file
+
+
+def ChunkedLibx265(lib, audio, video, sponsors, info):
+
+    # Forces the chunked path with four chunks, whatever the environment says
+    Downloader.LIBX265_CHUNK_WORKERS = max(2, min(4, os.cpu_count() or 1))
+    Downloader.LIBX265_CHUNK_SECONDS = max(1, info["duration"] // 4)
+    return Downloader.ConverterLibx265(lib, "bench", audio, video, sponsors, info=info)
+
+
+# Converter paths covered by the suite
+CONVERTERS = {
+    "libx265": lambda lib, audio, video, sponsors, info: Downloader.ConverterLibx265(lib, "bench", audio, video, sponsors, info=info),
+    "libx265-chunked": lambda lib, audio, video, sponsors, info: ChunkedLibx265(lib, audio, video, sponsors, info),
+    "raw": lambda lib, audio, video, sponsors, info: Downloader.ConverterRaw(lib, "bench", audio, video, sponsors, info=info),
+    "audio-aac": lambda lib, audio, video, sponsors, info: Downloader.ConverterAudioOnly(lib, "bench", audio, sponsors, ("aac", "m4a"), info=info),
+    "audio-mp3": lambda lib, audio, video, sponsors, info: Downloader.ConverterAudioOnly(lib, "bench", audio, sponsors, ("libmp3lame", "mp3"), info=info),
+}
+
+
+def RunCase(case):
+
+    # Runs one converter on copies of the test media (converters delete their inputs).
+    # Called in a fresh process, so peak memory of the children belongs to this case only.
+    with tempfile.TemporaryDirectory() as work_dir:
+        video_file = Path(work_dir) / "TEMP_video_bench.mp4"
+        audio_file = Path(work_dir) / "TEMP_audio_bench.m4a"
+        shutil.copy(case["video"], video_file)
+        shutil.copy(case["audio"], audio_file)
+
+        sponsors = SyntheticSponsors(case["segments"], case["duration"])
+        info = {"id": "bench", "duration": case["duration"]}
+
+        start = time.perf_counter()
+        output_path = CONVERTERS[case["converter"]](work_dir, str(audio_file), str(video_file), sponsors, info)
+        wall = time.perf_counter() - start
+
+        stats = Downloader.LastFfmpegStats() or {}
+        peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss if resource else None
+
+        return {
+            "wall_s": round(wall, 3),
+            "fps": stats.get("fps"),
+            "speed": stats.get("speed"),
+            "output_bytes": os.path.getsize(output_path),
+            "peak_rss_kb": peak_rss,
+        }
+
+
+def CaseName(case):
+    return f"{case['converter']}/{case['size']}/{case['duration']}s/{case['segments']}seg"
+
+
+def BenchmarkConverters(media_dir, converters, sizes, durations, segment_counts):
+
+    # Every combination runs in its own interpreter with an empty cache directory,
+    # so caches from earlier cases (loudness, encoders) don't flatter later ones
+    results = {}
+    for size in sizes:
+        for duration in durations:
+            video_file, audio_file = GenerateMedia(media_dir, size, duration)
+            for converter in converters:
+                # Audio-only paths don't depend on the video resolution
+                if converter.startswith("audio") and size != sizes[0]:
+                    continue
+                for segments in segment_counts:
+                    case = {"converter": converter, "size": size, "duration": duration, "segments": segments,
+                            "video": str(video_file), "audio": str(audio_file)}
+                    with tempfile.TemporaryDirectory() as cache_dir:
+                        env = dict(os.environ, YTDL_CACHE_DIR=cache_dir)
+                        child = subprocess.run([sys.executable, __file__, "run-case", json.dumps(case)],
+                                               capture_output=True, text=True, env=env)
+
+                    name = CaseName(case)
+                    marker = [line for line in child.stdout.splitlines() if line.startswith("BENCHMARK_RESULT ")]
+                    if child.returncode != 0 or not marker:
+                        print(f"{colors.RED}{name}: failed{colors.ENDC}\n{child.stderr[-2000:]}")
+                        results[name] = {"error": child.returncode}
+                        continue
+
+                    result = json.loads(marker[-1][len("BENCHMARK_RESULT "):])
+                    results[name] = result
+                    fps = f"{result['fps']:.1f} fps" if result["fps"] else "- fps"
+                    print(f"{colors.BLUE}{name:<32}{colors.ENDC} {result['wall_s']:>8.2f}s  {fps:>10}  "
+                          f"{result['output_bytes'] / 1_048_576:>8.1f} MiB  rss {result['peak_rss_kb']} KiB")
+
+    return results
+
+
+def CompareWithBaseline(results, baseline, threshold):
+
+    # A case regresses when its wall time, peak memory or output size grows by more than
+    # threshold, or its fps drops by more than threshold
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before or "error" in before or "error" in result:
+            continue
+        for metric, higher_is_worse in (("wall_s", True), ("peak_rss_kb", True), ("output_bytes", True), ("fps", False)):
+            if not before.get(metric) or not result.get(metric):
+                continue
+            change = result[metric] / before[metric] - 1
+            if (change if higher_is_worse else -change) > threshold:
+                regressions.append(f"{name}: {metric} {before[metric]} -> {result[metric]} ({change * 100:+.0f}%)")
+
+    return regressions
+
+
+def Main():
+
+    parser = argparse.ArgumentParser(description="Offline ffmpeg benchmarks for Downloader.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    filters = commands.add_parser("filters", help="cost of the sponsor cut filters")
+    filters.add_argument("--counts", default="0,5,50,200", help="comma separated sponsor segment counts")
+    filters.add_argument("--duration", type=int, default=120, help="length of the synthetic source in seconds")
+    filters.add_argument("--repeat", type=int, default=3, help="runs per case, the fastest one is reported")
+    filters.add_argument("--json", help="write the results to this file")
+
+    converters = commands.add_parser("converters", help="throughput of the converter paths")
+    converters.add_argument("--converters", default=",".join(CONVERTERS), help="comma separated converter paths")
+    converters.add_argument("--sizes", default="640x360,1280x720,1920x1080", help="comma separated resolutions")
+    converters.add_argument("--durations", default="10,30", help="comma separated source lengths in seconds")
+    converters.add_argument("--segments", default="0,5,50", help="comma separated sponsor segment counts")
+    converters.add_argument("--json", help="write the results to this file")
+    converters.add_argument("--baseline", help="compare against results stored earlier with --json")
+    converters.add_argument("--threshold", type=float, default=0.15, help="allowed change (slowdown, fps drop, size growth) before a case counts as a regression")
+
+    run_case = commands.add_parser("run-case")
+    run_case.add_argument("case")
+
+    args = parser.parse_args()
+
+    if args.command == "run-case":
+        result = RunCase(json.loads(args.case))
+        print("BENCHMARK_RESULT " + json.dumps(result))
+        return 0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.command == "filters":
+            counts = [int(c) for c in args.counts.split(",") if c.strip()]
+            source = GenerateSource(Path(tmp) / "source.mp4", duration=args.duration)
+            print(f"{colors.GREEN}Filter cost over a {args.duration}s synthetic source:{colors.ENDC}")
+            results = BenchmarkFilterCost(source, args.duration, counts, repeat=args.repeat)
+        else:
+            results = BenchmarkConverters(
+                tmp,
+                [c for c in args.converters.split(",") if c.strip()],
+                [s for s in args.sizes.split(",") if s.strip()],
+                [int(d) for d in args.durations.split(",") if d.strip()],
+                [int(n) for n in args.segments.split(",") if n.strip()],
+            )
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.command == "converters" and args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = CompareWithBaseline(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"{colors.RED}{len(regressions)} regression(s) against {args.baseline}:{colors.ENDC}")
+            for line in regressions:
+                print(f"  - {line}")
+            return 1
+        print(f"{colors.GREEN}No regressions against {args.baseline}.{colors.ENDC}")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(Main())
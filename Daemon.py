@@ -0,0 +1,398 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import Downloader
+from Downloader import colors
+
+
+# Long-running service around Downloader.ProcessOne. Jobs are posted as JSON to a local
+# HTTP API, stored in SQLite so they survive restarts, and run by a pool of worker threads.
+# Each worker keeps its own warm yt-dlp extractor; the HTTP session and caches are shared.
+
+DAEMON_HOST = os.environ.get("YTDL_DAEMON_HOST", "127.0.0.1")
+DAEMON_PORT = int(os.environ.get("YTDL_DAEMON_PORT", 8765))
+DAEMON_WORKERS = int(os.environ.get("YTDL_DAEMON_WORKERS", 2))
+DAEMON_DB = Path(os.environ.get("YTDL_DAEMON_DB", Downloader.CACHE_DIR / "jobs.sqlite3"))
+
+# Accepted values for the job fields, shared with the command line
+ENCODER_NAMES = list(Downloader.ENCODER_ALIASES)
+AUDIO_FORMATS = Downloader.AUDIO_FORMATS
+
+# Progress is written to the database at most this often per job (seconds)
+PROGRESS_WRITE_INTERVAL = 1.0
+
+JOB_COLUMNS = ("id", "url", "mode", "encoder", "audio_format", "connections", "weight", "timeout", "status", "stage", "progress",
+               "output", "error", "created_at", "started_at", "finished_at")
+
+# Upper limit for the per-job connection count of segmented downloads
+MAX_CONNECTIONS = 32
+
+_db = None
+_db_lock = threading.Lock()
+_jobs_available = threading.Condition(_db_lock)
+
+# Controls of the running jobs by id, so they can be cancelled, and the video each of them works
+# on, so two jobs of one video don't run at the same time on the same temp files; guarded by _db_lock
+_running = {}
+_running_videos = {}
+
+
+def OpenJobDb(path):
+
+    # One connection shared by all threads, serialized with _db_lock
+    global _db
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    _db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+    _db.execute("PRAGMA journal_mode=WAL")
+    _db.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            encoder TEXT,
+            audio_format TEXT,
+            connections INTEGER,
+            weight REAL,
+            timeout REAL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            stage TEXT,
+            progress REAL NOT NULL DEFAULT 0,
+            output TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        )""")
+    _db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+
+    # Databases created before a column existed get it added
+    existing = {row[1] for row in _db.execute("PRAGMA table_info(jobs)")}
+    for column, kind in (("connections", "INTEGER"), ("weight", "REAL"), ("timeout", "REAL")):
+        if column not in existing:
+            _db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+
+    # Jobs that were running when the daemon stopped start over
+    with _db_lock:
+        requeued = _db.execute("UPDATE jobs SET status = 'queued', stage = NULL, progress = 0 WHERE status = 'running'").rowcount
+    if requeued:
+        print(f"{colors.YELLOW}Requeued {requeued} interrupted job(s).{colors.ENDC}")
+
+
+def JobToDict(row):
+    return dict(zip(JOB_COLUMNS, row)) if row else None
+
+
+def ValidateJob(spec):
+
+    # Checks a posted job and fills in defaults. Raises ValueError with a message for the client.
+    if not isinstance(spec, dict):
+        raise ValueError("job must be a JSON object")
+
+    url = str(spec.get("url") or "").strip()
+    if not url:
+        raise ValueError("url is required")
+
+    mode = str(spec.get("mode") or "video").lower()
+    if mode not in ("video", "audio"):
+        raise ValueError("mode must be 'video' or 'audio'")
+
+    encoder = None
+    audio_format = None
+    if mode == "video":
+        encoder = str(spec.get("encoder") or "auto").lower()
+        if encoder not in ENCODER_NAMES:
+            raise ValueError(f"encoder must be one of: {', '.join(ENCODER_NAMES)}")
+    else:
+        audio_format = str(spec.get("audio_format") or "aac").lower()
+        if audio_format not in AUDIO_FORMATS:
+            raise ValueError(f"audio_format must be one of: {', '.join(AUDIO_FORMATS)}")
+
+    connections = spec.get("connections")
+    if connections is not None:
+        if not isinstance(connections, int) or isinstance(connections, bool) or not 1 <= connections <= MAX_CONNECTIONS:
+            raise ValueError(f"connections must be a number from 1 to {MAX_CONNECTIONS}")
+
+    weight = spec.get("weight")
+    if weight is not None:
+        if not isinstance(weight, (int, float)) or isinstance(weight, bool) or weight <= 0:
+            raise ValueError("weight must be a positive number")
+
+    timeout = spec.get("timeout")
+    if timeout is not None:
+        if not isinstance(timeout, (int, float)) or isinstance(timeout, bool) or timeout <= 0:
+            raise ValueError("timeout must be a positive number of seconds")
+
+    return {"url": url, "mode": mode, "encoder": encoder, "audio_format": audio_format, "connections": connections, "weight": weight,
+            "timeout": timeout}
+
+
+def SubmitJob(spec):
+
+    job = ValidateJob(spec)
+    with _jobs_available:
+        cursor = _db.execute(
+            "INSERT INTO jobs (url, mode, encoder, audio_format, connections, weight, timeout, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job["url"], job["mode"], job["encoder"], job["audio_format"], job["connections"], job["weight"], job["timeout"], time.time()))
+        _jobs_available.notify()
+
+    return cursor.lastrowid
+
+
+def GetJob(job_id):
+    with _db_lock:
+        row = _db.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return JobToDict(row)
+
+
+def ListJobs(status=None, limit=100):
+    query = f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs"
+    params = []
+    if status:
+        query += " WHERE status = ?"
+        params.append(status)
+    query += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+
+    with _db_lock:
+        rows = _db.execute(query, params).fetchall()
+    return [JobToDict(row) for row in rows]
+
+
+def CountJobs():
+    with _db_lock:
+        rows = _db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+    return dict(rows)
+
+
+def ClaimJob(stop):
+
+    # Takes the oldest queued job whose video isn't being worked on already and marks it running;
+    # waits while there is none. The job's control is registered in the same step, so a cancel
+    # can't slip in between.
+    with _jobs_available:
+        while not stop.is_set():
+            busy = set(_running_videos.values())
+            for row in _db.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE status = 'queued' ORDER BY id").fetchall():
+                job = JobToDict(row)
+                video = Downloader.CanonicalVideoId(job["url"]) or job["url"]
+                if video in busy:
+                    continue
+                _db.execute("UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?", (time.time(), job["id"]))
+                _running[job["id"]] = Downloader.JobControl(timeout=job["timeout"] or Downloader.JOB_TIMEOUT)
+                _running_videos[job["id"]] = video
+                return job
+            _jobs_available.wait(timeout=5)
+
+    return None
+
+
+def CancelJob(job_id):
+
+    # Queued jobs are dropped right away; running ones stop their downloads and ffmpeg
+    # processes and end up as cancelled. Returns False for unknown ids.
+    with _db_lock:
+        row = _db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return False
+        if row[0] == "queued":
+            _db.execute("UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ?", (time.time(), job_id))
+        elif job_id in _running:
+            _running[job_id].cancel.set()
+
+    return True
+
+
+def UpdateJob(job_id, **fields):
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    with _db_lock:
+        _db.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+
+def ProgressWriter(job_id):
+
+    # Progress callback for Downloader.SetProgressReporter. Stage changes are written
+    # right away, progress within a stage at most every PROGRESS_WRITE_INTERVAL seconds.
+    last = {"stage": None, "written": 0.0}
+
+    def Report(stage, fraction):
+        now = time.monotonic()
+        if stage == last["stage"] and now - last["written"] < PROGRESS_WRITE_INTERVAL and fraction < 1.0:
+            return
+        last["stage"], last["written"] = stage, now
+        UpdateJob(job_id, stage=stage, progress=round(fraction, 4))
+
+    return Report
+
+
+def RunCollectionJob(job, encoder_choice, audio_format, control):
+
+    # Playlists and channels go through the batch pipeline while they're being expanded.
+    # The batch state is keyed by the url, so a requeued job continues where it stopped.
+    # The job's timeout applies to every video of the collection.
+    UpdateJob(job["id"], stage="playlist")
+    state_key = Downloader.BatchStateKey(job["url"], job["mode"], encoder_choice, audio_format)
+    successes, failures = Downloader.RunBatchPipeline(
+        Downloader.ExpandUrls([job["url"]]), job["mode"], encoder_choice=encoder_choice, audio_format=audio_format,
+        stage_limits=Downloader.ParseStageLimits(os.environ.get("YTDL_STAGE_LIMITS", "")), state_key=state_key,
+        connections=job["connections"], weight=job["weight"], cancel=control.cancel, timeout=control.timeout)
+
+    control.Check()
+    summary = f"{successes} video(s) done, {failures} failed"
+    if failures:
+        raise RuntimeError(summary)
+    return summary
+
+
+def Worker(stop):
+
+    while not stop.is_set():
+        job = ClaimJob(stop)
+        if job is None:
+            return
+
+        print(f"{colors.BLUE}Job {job['id']}: {job['url']}{colors.ENDC}")
+        Downloader.SetProgressReporter(ProgressWriter(job["id"]))
+        control = _running[job["id"]]
+        encoder_choice = job["encoder"]
+        audio_format = AUDIO_FORMATS.get(job["audio_format"])
+        try:
+            with Downloader.JobContext(control):
+                if Downloader.IsCollectionUrl(job["url"]):
+                    output = RunCollectionJob(job, encoder_choice, audio_format, control)
+                else:
+                    output = Downloader.ProcessOne(job["url"], job["mode"], encoder_choice=encoder_choice, audio_format=audio_format,
+                                                   connections=job["connections"], weight=job["weight"])
+            UpdateJob(job["id"], status="done", stage="done", progress=1.0, output=output, finished_at=time.time())
+            print(f"{colors.GREEN}Job {job['id']} done.{colors.ENDC}")
+
+        except Exception as e:
+            status = "cancelled" if control.cancel.is_set() else "failed"
+            UpdateJob(job["id"], status=status, error=str(e), finished_at=time.time())
+            print(f"{colors.RED}Job {job['id']} {status}: {e}{colors.ENDC}")
+
+        finally:
+            Downloader.SetProgressReporter(None)
+            with _jobs_available:
+                _running.pop(job["id"], None)
+                _running_videos.pop(job["id"], None)
+                # A job held back for this video can run now
+                _jobs_available.notify()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    # POST /jobs                  {"url": ..., "mode": "video"|"audio", "encoder": ..., "audio_format": ..., "connections": ..., "weight": ..., "timeout": ...}
+    # POST /jobs/<id>/cancel      drop a queued job or stop a running one
+    # GET  /jobs[?status=queued]  recent jobs
+    # GET  /jobs/<id>             one job
+    # GET  /jobs/<id>/progress    stage and progress of one job
+    # GET  /status                job counts and worker count
+
+    def SendJson(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        parts = [p for p in urlparse(self.path).path.split("/") if p]
+        if len(parts) == 3 and parts[0] == "jobs" and parts[1].isdigit() and parts[2] == "cancel":
+            if not CancelJob(int(parts[1])):
+                return self.SendJson(404, {"error": "no such job"})
+            return self.SendJson(202, GetJob(int(parts[1])))
+
+        if parts != ["jobs"]:
+            return self.SendJson(404, {"error": "not found"})
+
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            job_id = SubmitJob(json.loads(self.rfile.read(length) or b"null"))
+        except (ValueError, json.JSONDecodeError) as e:
+            return self.SendJson(400, {"error": str(e)})
+
+        self.SendJson(201, GetJob(job_id))
+
+    def do_GET(self):
+        request = urlparse(self.path)
+        parts = [p for p in request.path.split("/") if p]
+
+        if parts == ["status"]:
+            return self.SendJson(200, {"jobs": CountJobs(), "workers": self.server.workers})
+
+        if parts == ["metrics"]:
+            # Stage timings in the Prometheus text format, for scraping
+            data = Downloader.MetricsText().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        if parts == ["jobs"]:
+            query = parse_qs(request.query)
+            return self.SendJson(200, ListJobs(status=query.get("status", [None])[0]))
+
+        if len(parts) in (2, 3) and parts[0] == "jobs" and parts[1].isdigit():
+            job = GetJob(int(parts[1]))
+            if job is None:
+                return self.SendJson(404, {"error": "no such job"})
+            if len(parts) == 2:
+                return self.SendJson(200, job)
+            if parts[2] == "progress":
+                return self.SendJson(200, {key: job[key] for key in ("id", "status", "stage", "progress")})
+
+        self.SendJson(404, {"error": "not found"})
+
+    def log_message(self, format, *args):
+        # Requests aren't worth a line each next to the job output
+        pass
+
+
+def Main():
+
+    parser = argparse.ArgumentParser(description="Run Downloader.py as a service with a local HTTP/JSON API")
+    parser.add_argument("--host", default=DAEMON_HOST, help="address to listen on")
+    parser.add_argument("--port", type=int, default=DAEMON_PORT, help="port to listen on")
+    parser.add_argument("--workers", type=int, default=DAEMON_WORKERS, help="jobs processed at the same time")
+    parser.add_argument("--db", default=str(DAEMON_DB), help="SQLite file holding the job queue")
+    args = parser.parse_args()
+
+    OpenJobDb(args.db)
+
+    stop = threading.Event()
+    workers = [threading.Thread(target=Worker, args=(stop,), name=f"job-worker-{i}", daemon=True)
+               for i in range(max(1, args.workers))]
+    for worker in workers:
+        worker.start()
+
+    server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    server.workers = len(workers)
+    print(f"{colors.GREEN}Listening on http://{args.host}:{args.port} with {len(workers)} worker(s).{colors.ENDC}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        # Running jobs are requeued on the next start
+        stop.set()
+        with _jobs_available:
+            _jobs_available.notify_all()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(Main())
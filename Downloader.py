@@ -1,12 +1,56 @@
-import yt_dlp
 import os
-import requests
 import subprocess
-from tqdm import tqdm
 from pathlib import Path
 import sys
 import platform
 import json
+import re
+import time
+import copy
+import tempfile
+import hashlib
+import shutil
+import queue
+import threading
+import sqlite3
+import itertools
+import heapq
+import importlib
+import argparse
+import contextlib
+import uuid
+import atexit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
+
+
+class LazyImport:
+
+    # Stands in for a heavy module (or one attribute of it) and imports it on first use.
+    # --help, dry runs, library hits and SponsorBlock lookups never pay for yt-dlp this way.
+    def __init__(self, module, attribute=None):
+        self._module = module
+        self._attribute = attribute
+        self._target = None
+
+    def _Resolve(self):
+        if self._target is None:
+            target = importlib.import_module(self._module)
+            self._target = getattr(target, self._attribute) if self._attribute else target
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._Resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._Resolve()(*args, **kwargs)
+
+
+yt_dlp = LazyImport("yt_dlp")
+requests = LazyImport("requests")
+tqdm = LazyImport("tqdm", "tqdm")
+asyncio = LazyImport("asyncio")
+mutagen_mp4 = LazyImport("mutagen.mp4")
 
 
 class colors:
@@ -21,6 +65,203 @@ class colors:
     YELLOW = "\033[33m"
 
 
+# Worker count for each stage of the batch pipeline. Can be overridden with
+# the YTDL_STAGE_LIMITS environment variable, e.g. "download=3,encode=2"
+PIPELINE_STAGE_LIMITS = {
+    "metadata": 4,
+    "sponsors": 4,
+    "download": 2,
+    "encode": 1,
+}
+
+# Accepted spellings of every encoder choice; the key is the name stored in the library index
+ENCODER_ALIASES = {
+    "nvenc": ['nvenc', 'nvidia', '1'],
+    "vaapi": ['vaapi', 'amd', '2'],
+    "libx265": ['libx265', 'cpu', '3'],
+    "raw": ['raw', 'rawfile', '4'],
+    "smartcut": ['smartcut', 'smart', '5'],
+    "auto": ['auto', '6'],
+}
+
+# Audio formats by name: (ffmpeg codec, file extension)
+AUDIO_FORMATS = {"aac": ("aac", "m4a"), "mp3": ("libmp3lame", "mp3"), "flac": ("flac", "flac")}
+
+# Stages recorded in the batch state, in order
+BATCH_STAGES = ["extracted", "sponsors", "downloaded", "encoded"]
+
+# Urls taken from the batch at a time for one round of SponsorBlock prefix requests
+PREFETCH_GROUP_SIZE = 100
+
+# How many finished jobs may wait between two stages before the earlier stage blocks
+PIPELINE_QUEUE_SIZE = 4
+
+# On-disk cache for extracted metadata and other per-video results
+CACHE_DIR = Path(os.environ.get("YTDL_CACHE_DIR", Path.home() / ".cache" / "youtube-downloader"))
+
+# Index of finished outputs, so videos already in the library are skipped without touching the network
+LIBRARY_INDEX = Path(os.environ.get("YTDL_LIBRARY_INDEX", CACHE_DIR / "library.sqlite3"))
+
+# Timing spans of every stage are appended here as JSON lines when a path is set; the file isn't
+# rotated, so point it somewhere that is. A Prometheus textfile, e.g. for node_exporter's textfile
+# collector, is likewise only written when a path is set.
+METRICS_LOG = os.environ.get("YTDL_METRICS_LOG", "")
+METRICS_TEXTFILE = os.environ.get("YTDL_METRICS_TEXTFILE", "")
+
+# Durations kept per stage for the quantiles of the metrics export
+METRICS_WINDOW = 1000
+
+# Span fields that nested spans take over from the span around them
+SPAN_INHERITED_FIELDS = ("batch", "video_id")
+
+# Extracted info dicts are reused for this many seconds, as long as their stream urls haven't expired
+INFO_CACHE_TTL = int(os.environ.get("YTDL_INFO_CACHE_TTL", 3 * 3600))
+
+# Info dicts are large, so their folder is kept to a size limit. Entries not used for a week go too;
+# older ones are still read when an interrupted batch resumes from its downloaded streams.
+INFO_CACHE_MAX_ENTRIES = 2000
+INFO_CACHE_MAX_BYTES = int(os.environ.get("YTDL_INFO_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+INFO_CACHE_MAX_AGE = 7 * 24 * 3600
+
+# Loudness target (integrated LUFS, true peak dBTP, loudness range LU)
+LOUDNESS_TARGET = (-16.0, -1.5, 11.0)
+
+# How loudness is normalized:
+#   "gain"    - measure once per source (cached) and apply a plain volume change
+#   "dynamic" - ffmpeg's single-pass loudnorm, slow because it works at 192 kHz internally
+#   "tags"    - like "gain", but audio-only files get ReplayGain tags and keep their samples
+LOUDNESS_MODE = os.environ.get("YTDL_LOUDNESS_MODE", "gain").lower()
+
+# Audio-only jobs stream copy the download when it already has the requested codec and its
+# loudness doesn't have to change: always in "tags" mode, in "gain" mode only when the gain
+# would be within the tolerance (dB). Loudness is then written as ReplayGain tags.
+AUDIO_PASSTHROUGH = os.environ.get("YTDL_AUDIO_PASSTHROUGH", "1") != "0"
+AUDIO_PASSTHROUGH_GAIN_TOLERANCE = float(os.environ.get("YTDL_AUDIO_PASSTHROUGH_GAIN_TOLERANCE", 1.0))
+
+# ffprobe codec names of the audio formats offered by GetAudioFormatOfChoice
+AUDIO_CODEC_NAMES = {"aac": "aac", "libmp3lame": "mp3", "flac": "flac"}
+
+# Encoder profiles the auto encoder chooses from, with the settings used for calibration.
+# quality: 2 = high (visually lossless settings), 1 = standard
+ENCODER_PROFILES = {
+    "nvenc": {
+        "encoder": "hevc_nvenc", "hwaccel": "cuda", "device": None, "quality": 2,
+        "input_args": ['-init_hw_device', 'cuda'],
+        "output_args": ['-vf', 'format=nv12,hwupload_cuda', '-c:v', 'hevc_nvenc', '-preset', 'p5', '-tune', 'hq', '-rc', 'constqp', '-qp', '16'],
+    },
+    "vaapi": {
+        "encoder": "hevc_vaapi", "hwaccel": "vaapi", "device": "/dev/dri/renderD128", "quality": 1,
+        "input_args": ['-vaapi_device', '/dev/dri/renderD128'],
+        "output_args": ['-vf', 'format=nv12,hwupload', '-c:v', 'hevc_vaapi', '-global_quality', '20'],
+    },
+    "libx265": {
+        "encoder": "libx265", "hwaccel": None, "device": None, "quality": 2,
+        "input_args": [],
+        "output_args": ['-c:v', 'libx265', '-preset', 'medium', '-crf', '10'],
+    },
+}
+ENCODER_QUALITY_LEVELS = {"standard": 1, "high": 2}
+
+# Lowest quality level the auto encoder may pick, and the length of the calibration encode.
+# An encoder that failed its calibration or a real encode is tried again after ENCODER_RETRY_AFTER
+# seconds, so a GPU that was busy or not ready yet isn't given up on for good.
+AUTO_MIN_QUALITY = os.environ.get("YTDL_AUTO_MIN_QUALITY", "standard").lower()
+ENCODER_CALIBRATION_SECONDS = 2
+ENCODER_RETRY_AFTER = int(os.environ.get("YTDL_ENCODER_RETRY_AFTER", 3600))
+
+# Scratch space for TEMP files and unfinished outputs (defaults to the library folder itself).
+# Jobs are held back while their estimated footprint would leave less than SCRATCH_MIN_FREE bytes free.
+SCRATCH_DIR = os.environ.get("YTDL_SCRATCH_DIR")
+SCRATCH_MIN_FREE = int(float(os.environ.get("YTDL_SCRATCH_MIN_FREE_GB", 1)) * 1024 ** 3)
+# Seconds a job waits for scratch space before it fails (0 = no limit, only cancellation ends the wait)
+SCRATCH_WAIT_TIMEOUT = float(os.environ.get("YTDL_SCRATCH_WAIT_TIMEOUT", 0))
+
+# Output size relative to the downloaded streams, for the scratch estimate
+SCRATCH_OUTPUT_FACTOR = {"raw": 10.0}
+
+# Segmented downloads: parallel range requests per stream (0 or 1 = yt-dlp's own single connection).
+# Can also be set per job, see the connections argument of ProcessOne/RunBatchPipeline.
+SEGMENTED_CONNECTIONS = int(os.environ.get("YTDL_SEGMENTED_CONNECTIONS", 0))
+SEGMENT_SIZE = 8 * 1024 * 1024
+SEGMENT_RETRIES = 5
+
+# Shared download bandwidth cap in bytes per second ("20M", "500K"; empty or 0 = unlimited) and
+# time-of-day overrides like "09:00-18:00=5M,22:00-06:00=0". Jobs can be given weights.
+BANDWIDTH_LIMIT = os.environ.get("YTDL_BANDWIDTH_LIMIT", "")
+BANDWIDTH_SCHEDULE = os.environ.get("YTDL_BANDWIDTH_SCHEDULE", "")
+
+# Streaming mode: ffmpeg reads the stream urls directly instead of TEMP files (set YTDL_STREAMING=1).
+# With a bandwidth cap every stream goes through the local relay, in pieces of this size unless the
+# format has its own, so streamed jobs share the cap; HLS streams are downloaded instead then.
+STREAMING = os.environ.get("YTDL_STREAMING", "0") == "1"
+STREAMABLE_PROTOCOLS = ("http", "https", "m3u8", "m3u8_native")
+STREAM_RELAY_CHUNK_SIZE = 10 * 1024 * 1024
+
+# Wall time one video may take from extraction to finished file, in seconds (0 = no limit).
+# When it runs out, its ffmpeg/ffprobe children are stopped and its downloads abort.
+JOB_TIMEOUT = float(os.environ.get("YTDL_JOB_TIMEOUT", 0))
+
+# Seconds a child process gets to exit after SIGTERM before it's killed
+PROCESS_TERMINATE_GRACE = 5
+
+# How often a running child is checked for cancellation and its job's deadline (seconds)
+PROCESS_POLL_INTERVAL = 0.5
+
+# Chunked libx265: number of chunks encoded at the same time (0 or 1 = off) and chunk length in seconds
+LIBX265_CHUNK_WORKERS = int(os.environ.get("YTDL_X265_CHUNK_WORKERS", 0))
+LIBX265_CHUNK_SECONDS = int(os.environ.get("YTDL_X265_CHUNK_SECONDS", 60))
+
+# Connection pooling for the shared HTTP session: number of hosts kept and connections per host
+HTTP_POOL_HOSTS = 4
+HTTP_POOL_PER_HOST = 8
+
+# SponsorBlock cache: freshness of found segments and of "no segments" answers, and size limits
+SPONSOR_CACHE_TTL = int(os.environ.get("YTDL_SPONSOR_CACHE_TTL", 24 * 3600))
+SPONSOR_NEGATIVE_CACHE_TTL = int(os.environ.get("YTDL_SPONSOR_NEGATIVE_CACHE_TTL", 6 * 3600))
+SPONSOR_CACHE_MAX_ENTRIES = 20000
+
+# SponsorBlock server, and how many leading hex characters of sha256(video id) a batched lookup sends.
+# 4 is the shortest prefix the API accepts; at that length nearly every video gets a bucket of its own.
+SPONSORBLOCK_API = os.environ.get("YTDL_SPONSORBLOCK_API", "https://sponsor.ajay.app").rstrip("/")
+SPONSOR_HASH_PREFIX_LENGTH = 4
+SPONSOR_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+_ffmpeg_stats = threading.local()
+
+_cache_locks = {}
+_cache_prune_counters = {}
+_cache_locks_guard = threading.Lock()
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+_library_db = None
+_library_lock = threading.Lock()
+
+_bandwidth_scheduler = None
+_bandwidth_scheduler_lock = threading.Lock()
+
+_scratch_reserved = {}
+_scratch_condition = threading.Condition()
+
+_process_supervisor = None
+_process_supervisor_lock = threading.Lock()
+
+_progress_slots = set()
+_progress_slots_lock = threading.Lock()
+
+_stream_relay = None
+_stream_relay_lock = threading.Lock()
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+_batch_spans = {}
+
+# Per-thread state: a warm yt-dlp extractor, an optional progress callback (used by Daemon.py),
+# the control of the job being worked on and the stack of open timing spans
+_thread_state = threading.local()
+
+
 def Main():
     
     # Initial prompt
@@ -37,12 +278,22 @@ def Main():
             # Either video or audio-only
             mode = GetModeOfChoice()
 
+            encoder_choice = None
+            audio_format = None
             if mode == "video":
                 encoder_choice = GetEncoderOfChoice()
-                ProcessOne(url, mode='video', encoder_choice=encoder_choice)
             else:
-                # Audio only
-                ProcessOne(url, mode='audio')
+                # Audio only; format is asked up front so the download can match it
+                audio_format = GetAudioFormatOfChoice()
+
+            if IsCollectionUrl(url):
+                # Playlists and channels run through the batch pipeline while they're being expanded
+                state_key = BatchStateKey(url, mode, encoder_choice, audio_format)
+                successes, failures = RunBatchPipeline(ExpandUrls([url]), mode, encoder_choice=encoder_choice, audio_format=audio_format,
+                                                       stage_limits=ParseStageLimits(os.environ.get("YTDL_STAGE_LIMITS", "")), state_key=state_key)
+                print(f"{colors.GREEN}Done. Success: {successes}, Failed: {failures}.{colors.ENDC}")
+            else:
+                ProcessOne(url, mode=mode, encoder_choice=encoder_choice, audio_format=audio_format)
 
         except Exception as e:
             print(f"{colors.RED}Error: {e}{colors.ENDC}")
@@ -73,17 +324,15 @@ def Main():
             audio_format = GetAudioFormatOfChoice()
 
         print(f"{colors.GREEN}Found {len(urls)} URL(s). Starting batch...{colors.ENDC}")
-        successes, failures = 0, 0
 
-        for i, url in enumerate(urls, 1):
-            print(f"{colors.BLUE}[{i}/{len(urls)}]{colors.ENDC} {url}")
-            try:
-                ProcessOne(url, mode, encoder_choice=encoder_choice, audio_format=audio_format)
-                successes += 1
-            except Exception as e:
-                failures += 1
-                print(f"{colors.RED}Failed: {e}{colors.ENDC}")
-                # continue with next URL
+        # Playlists and channels in the file are expanded lazily while the batch runs
+        if any(IsCollectionUrl(url) for url in urls):
+            urls = ExpandUrls(urls)
+
+        stage_limits = ParseStageLimits(os.environ.get("YTDL_STAGE_LIMITS", ""))
+        state_key = BatchStateKey(Path(file_path).resolve(), mode, encoder_choice, audio_format)
+        successes, failures = RunBatchPipeline(urls, mode, encoder_choice=encoder_choice, audio_format=audio_format,
+                                               stage_limits=stage_limits, state_key=state_key)
 
         print(f"{colors.GREEN}Done. Success: {successes}, Failed: {failures}.{colors.ENDC}")
         return
@@ -92,39 +341,1059 @@ def Main():
         print(f"{colors.RED}Invalid choice. Please choose 1 or 2.{colors.ENDC}")
 
 
-def ProcessOne(url, mode, encoder_choice=None, audio_format=None):
-    # Check if the URL is reachable by sending a request
-    check_url = requests.get(url, timeout=3)
-    # Raise HTTPError for bad responses
-    check_url.raise_for_status()
+def ParseArguments(argv):
+
+    parser = argparse.ArgumentParser(
+        prog="Downloader.py",
+        description="Downloads YouTube videos or audio without their SponsorBlock segments. "
+                    "Without arguments the interactive prompts are used.")
+    parser.add_argument("urls", nargs="*", help="video, playlist or channel urls")
+    parser.add_argument("--url", action="append", default=[], dest="more_urls", metavar="URL", help="another url (can be repeated)")
+    parser.add_argument("--file", action="append", default=[], help="text file with one url per line (can be repeated)")
+    parser.add_argument("--spec", help="JSON batch spec: {\"mode\", \"encoder\", \"audio_format\", ..., \"jobs\": [url or {\"url\", overrides}], \"files\": [...]}")
+    parser.add_argument("--mode", choices=["video", "audio"], default="video")
+    parser.add_argument("--encoder", choices=list(ENCODER_ALIASES), default="auto", help="video encoder (default: auto)")
+    parser.add_argument("--audio-format", choices=list(AUDIO_FORMATS), default="aac", help="format of audio-only files (default: aac)")
+    parser.add_argument("--connections", type=PositiveInt, help="parallel connections per stream for segmented downloads")
+    parser.add_argument("--weight", type=PositiveFloat, help="share of the bandwidth cap relative to other downloads")
+    parser.add_argument("--stage-limits", default=os.environ.get("YTDL_STAGE_LIMITS", ""), help="workers per pipeline stage, e.g. download=3,encode=2")
+    parser.add_argument("--dry-run", action="store_true", help="show what would be done, without network access")
+    parser.add_argument("--sponsors-only", action="store_true", help="print the SponsorBlock segments of the videos as JSON")
+
+    return parser.parse_args(argv)
+
+
+def PositiveInt(value):
+
+    # Argparse type (and spec check) for counts such as --connections
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise argparse.ArgumentTypeError(f"expected a positive integer, got {value!r}")
+    if isinstance(value, (bool, float)) or number < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive integer, got {value!r}")
+    return number
+
+
+def PositiveFloat(value):
 
-    # If url is reachable, proceed to load the YouTube video
-    with yt_dlp.YoutubeDL({"quiet": True}) as ytdl:
-        info = ytdl.extract_info(url, download=False)
+    # Argparse type (and spec check) for shares such as --weight
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise argparse.ArgumentTypeError(f"expected a positive number, got {value!r}")
+    if isinstance(value, bool) or not 0 < number < float("inf"):
+        raise argparse.ArgumentTypeError(f"expected a positive number, got {value!r}")
+    return number
+
+
+def BuildCliJobs(args):
+
+    # One dict per url; settings come from the job entry, then the spec, then the command line
+    defaults = {"mode": args.mode, "encoder": args.encoder, "audio_format": args.audio_format,
+                "connections": args.connections, "weight": args.weight}
+    entries = [(url, {}) for url in args.urls + args.more_urls]
+    files = list(args.file)
+
+    if args.spec:
+        with open(args.spec, "r", encoding="utf-8") as f:
+            spec = json.load(f)
+
+        # Check the shape up front so a bad spec is a usage error, not a traceback
+        if not isinstance(spec, dict):
+            raise ValueError(f"{args.spec}: the spec must be a JSON object")
+        if not isinstance(spec.get("jobs", []), list):
+            raise ValueError(f"{args.spec}: \"jobs\" must be a list")
+        if not isinstance(spec.get("files", []), list) or not all(isinstance(path, str) for path in spec.get("files", [])):
+            raise ValueError(f"{args.spec}: \"files\" must be a list of paths")
+
+        defaults.update({key: spec[key] for key in defaults if key in spec})
+        for i, entry in enumerate(spec.get("jobs", [])):
+            if isinstance(entry, str):
+                entries.append((entry, {}))
+            elif isinstance(entry, dict) and isinstance(entry.get("url"), str):
+                entries.append((entry["url"], {key: entry[key] for key in defaults if key in entry}))
+            else:
+                raise ValueError(f"{args.spec}: jobs[{i}] must be a url or an object with a \"url\"")
+        files += spec.get("files", [])
+
+    for file_path in files:
+        entries += [(url, {}) for url in LoadUrlsFromFile(file_path)]
+
+    jobs = []
+    for url, overrides in entries:
+        job = dict(defaults, **overrides, url=url)
+        if not all(isinstance(job[key], str) for key in ("mode", "encoder", "audio_format")) \
+                or job["mode"] not in ("video", "audio") or job["encoder"] not in ENCODER_ALIASES or job["audio_format"] not in AUDIO_FORMATS:
+            raise ValueError(f"Invalid settings for {url}: {overrides or defaults}")
+        try:
+            for key, check in (("connections", PositiveInt), ("weight", PositiveFloat)):
+                if job[key] is not None:
+                    job[key] = check(job[key])
+        except argparse.ArgumentTypeError as e:
+            raise ValueError(f"Invalid {key} for {url}: {e}")
+        jobs.append(job)
+
+    return jobs
+
+
+def RunCli(argv):
+
+    # Non-interactive entry point; returns the process exit code
+    args = ParseArguments(argv)
+    try:
+        jobs = BuildCliJobs(args)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"{colors.RED}Error: {e}{colors.ENDC}", file=sys.stderr)
+        return 2
+
+    if not jobs:
+        print(f"{colors.RED}No urls given. Use --url, --file or --spec (see --help).{colors.ENDC}", file=sys.stderr)
+        return 2
+
+    if args.sponsors_only:
+        urls = ExpandUrls([job["url"] for job in jobs]) if any(IsCollectionUrl(job["url"]) for job in jobs) else [job["url"] for job in jobs]
+        video_ids = list(dict.fromkeys(v for v in (CanonicalVideoId(url) for url in urls) if v))
+        PrefetchSponsorSegments(video_ids)
+        print(json.dumps({video_id: FetchSponsorSegments(video_id) for video_id in video_ids}, indent=2))
+        return 0
+
+    # Jobs with the same settings share one batch pipeline, in the order they were given. The
+    # same video given twice (positional, --file, spec) would run twice at once on the same temp files.
+    groups = {}
+    seen = set()
+    for job in jobs:
+        settings = (job["mode"], job["encoder"], job["audio_format"], job["connections"], job["weight"])
+        key = (settings, CanonicalVideoId(job["url"]) or job["url"])
+        if key not in seen:
+            seen.add(key)
+            groups.setdefault(settings, []).append(job["url"])
+
+    if args.dry_run:
+        for (mode, encoder, audio_format, _, _), urls in groups.items():
+            print(f"{colors.GREEN}{mode} / {encoder if mode == 'video' else audio_format}:{colors.ENDC}")
+            for url in urls:
+                print(f"  {url}: {DescribePlannedJob(url, mode, encoder, AUDIO_FORMATS[audio_format])}")
+        return 0
+
+    successes = failures = 0
+    for (mode, encoder, audio_format, connections, weight), urls in groups.items():
+        audio = AUDIO_FORMATS[audio_format] if mode == 'audio' else None
+        encoder_choice = encoder if mode == 'video' else None
+        state_key = BatchStateKey("\n".join(urls), mode, encoder_choice, audio)
+        if any(IsCollectionUrl(url) for url in urls):
+            urls = ExpandUrls(urls)
+        done, failed = RunBatchPipeline(urls, mode, encoder_choice=encoder_choice, audio_format=audio,
+                                        stage_limits=ParseStageLimits(args.stage_limits), state_key=state_key,
+                                        connections=connections, weight=weight)
+        successes += done
+        failures += failed
+
+    print(f"{colors.GREEN}Done. Success: {successes}, Failed: {failures}.{colors.ENDC}")
+    return 1 if failures else 0
+
+
+def DescribePlannedJob(url, mode, encoder_choice, audio_format):
+
+    # What a run would do for url, judged from local state only
+    if IsCollectionUrl(url):
+        return "playlist/channel, expanded when the batch runs"
+
+    video_id = CanonicalVideoId(url)
+    if not video_id:
+        return "unrecognized url, extracted when the batch runs"
+
+    existing = LookupLibrary(video_id, mode, OutputVariant(mode, encoder_choice, audio_format))
+    if existing:
+        return f"skip, already in the library ({existing})"
+
+    info = ReadCache("info", video_id, INFO_CACHE_TTL)
+    steps = ["reuse cached info" if info and StreamUrlsValid(info) else "extract info"]
+
+    sponsors = ReadCache("sponsors", SponsorCacheKey(video_id, ("sponsor", "selfpromo")), SPONSOR_CACHE_TTL, empty_max_age=SPONSOR_NEGATIVE_CACHE_TTL)
+    steps.append("SponsorBlock lookup" if sponsors is None else f"{len(sponsors)} cached sponsor segment(s)")
+
+    steps.append("download + encode" if mode == 'video' else "download + convert")
+    return ", ".join(steps)
+
+
+def ProcessOne(url, mode, encoder_choice=None, audio_format=None, connections=None, weight=None):
+    # Skip videos that are already in the library with the same settings
+    variant = OutputVariant(mode, encoder_choice, audio_format)
+    existing = LookupLibrary(CanonicalVideoId(url), mode, variant)
+    if existing:
+        print(f"{colors.CYAN}Already in the library: {existing}{colors.ENDC}")
+        return existing
+
+    with Span("job", url=url, mode=mode, variant=variant) as span, JobContext():
+        # Resolve title & id of the video
+        ReportProgress("metadata", 0.0)
+        info = ExtractVideoInfo(url)
         title = info.get("title", "output")
-        video_id = info.get("id")
+        video_id = span["video_id"] = info.get("id")
         print(f"{colors.GREEN}Found a video titled: {title}")
 
-    # Fetch SponsorBlock segments via SponsorBlock API
+        # Fetch SponsorBlock segments via SponsorBlock API
+        ReportProgress("sponsors", 0.0)
+        sponsors = GetSponsorsForVideo(video_id) or []
+
+        # Get platform & necessary paths
+        library_path, video_file, audio_file = GetPlatformAndOperatingSystem(video_id, variant)
+        print(f"{colors.BLUE}Saving files to: {library_path}{colors.ENDC}")
+
+        # Download + encode
+        output = Downloader(url, title, library_path, audio_file, video_file, sponsors, mode, encoder_choice=encoder_choice, audio_format=audio_format,
+                            info=info, connections=connections, weight=weight)
+        RecordLibraryEntry(video_id, mode, variant, output)
+        return output
+
+
+def ExtractVideoInfo(url):
+
+    with Span("extract", url=url) as span:
+        # Reuse a previous extraction of the same video while its stream urls are still valid
+        video_id = CanonicalVideoId(url)
+        if video_id:
+            cached = ReadCache("info", video_id, INFO_CACHE_TTL)
+            if cached and StreamUrlsValid(cached):
+                span["cached"] = True
+                return cached
+
+        # No separate reachability check; extraction fails with a clear error for unreachable urls
+        ytdl = GetExtractor()
+        info = ytdl.sanitize_info(ytdl.extract_info(url, download=False), remove_private_keys=True)
+        span["cached"] = False
+
+        if info.get("id"):
+            WriteCache("info", info["id"], info)
+            PruneCache("info", INFO_CACHE_MAX_ENTRIES, INFO_CACHE_MAX_BYTES, every=10, max_age=INFO_CACHE_MAX_AGE)
+
+        return info
+
+
+def GetExtractor():
+
+    # YoutubeDL instances aren't thread safe, so every thread keeps its own. Reusing it keeps
+    # the extractor classes and their cookies/player caches warm between videos.
+    ytdl = getattr(_thread_state, "extractor", None)
+    if ytdl is None:
+        ytdl = yt_dlp.YoutubeDL({"quiet": True, "noplaylist": True})
+        _thread_state.extractor = ytdl
+
+    return ytdl
+
+
+def SetProgressReporter(callback):
+    # Installs callback(stage, fraction) for the work done on this thread; None removes it
+    _thread_state.reporter = callback
+
+
+def ReportProgress(stage, fraction, reporter=None):
+
+    # Forwards progress to the reporter of the current thread, if there is one.
+    # Worker threads pass the reporter of the thread that started them.
+    reporter = reporter or getattr(_thread_state, "reporter", None)
+    if reporter is not None:
+        try:
+            reporter(stage, max(0.0, min(fraction, 1.0)))
+        except Exception:
+            pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobControl:
+
+    # Cancellation and time limit of one job. The thread working on the job installs it with
+    # JobContext; downloads and child processes started for the job check it while they run.
+    def __init__(self, cancel=None, timeout=None):
+        self.cancel = cancel or threading.Event()
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout if timeout else None
+
+    def Interrupted(self):
+        return self.cancel.is_set() or (self.deadline is not None and time.monotonic() > self.deadline)
+
+    def Check(self):
+        if self.cancel.is_set():
+            raise JobCancelled("Job cancelled")
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise TimeoutError(f"Job exceeded its time limit of {self.timeout:g}s")
+
+
+@contextlib.contextmanager
+def JobContext(control=None):
+
+    # Installs control for the work done on this thread and puts the previous one back afterwards.
+    # Without a control the installed one is kept, or a new one with JOB_TIMEOUT is made.
+    previous = CurrentJobControl()
+    _thread_state.job = control or previous or JobControl(timeout=JOB_TIMEOUT)
+    try:
+        yield _thread_state.job
+    finally:
+        _thread_state.job = previous
+
+
+def CurrentJobControl():
+    return getattr(_thread_state, "job", None)
+
+
+def AcquireProgressSlot():
+
+    # Terminal line for one progress bar. Bars of downloads and encodes running at the same
+    # time are stacked on their own lines instead of overwriting each other.
+    with _progress_slots_lock:
+        slot = next(i for i in itertools.count() if i not in _progress_slots)
+        _progress_slots.add(slot)
+    return slot
+
+
+def ReleaseProgressSlot(slot):
+    with _progress_slots_lock:
+        _progress_slots.discard(slot)
+
+
+@contextlib.contextmanager
+def Span(stage, **fields):
+
+    # Times the block and records it as one span (see RecordSpan). The block can add
+    # measurements such as bytes or fps to the yielded dict. Spans opened inside another
+    # span on the same thread name it as their parent and take over its batch and video id.
+    stack = getattr(_thread_state, "spans", None)
+    if stack is None:
+        stack = _thread_state.spans = []
+
+    span = {"stage": stage}
+    if stack:
+        parent = stack[-1]
+        span["parent"] = parent["stage"]
+        span.update({key: parent[key] for key in SPAN_INHERITED_FIELDS if parent.get(key)})
+    span.update({key: value for key, value in fields.items() if value is not None})
+    span["start"] = round(time.time(), 3)
+
+    stack.append(span)
+    start = time.perf_counter()
+    try:
+        yield span
+    except BaseException as e:
+        span["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        span["seconds"] = round(time.perf_counter() - start, 4)
+        stack.pop()
+        RecordSpan(span)
+
+
+def RecordSpan(span):
+
+    # Appends the span to the JSON lines log, adds it to the running totals of its stage
+    # and to the batch it belongs to. The Prometheus textfile is refreshed whenever
+    # an outermost span ends.
+    with _metrics_lock:
+        totals = _metrics.setdefault(span["stage"], {"count": 0, "errors": 0, "seconds": 0.0, "bytes": 0, "output_bytes": 0,
+                                                     "durations": deque(maxlen=METRICS_WINDOW)})
+        totals["count"] += 1
+        totals["errors"] += 1 if "error" in span else 0
+        totals["seconds"] += span["seconds"]
+        totals["bytes"] += span.get("bytes") or 0
+        totals["output_bytes"] += span.get("output_bytes") or 0
+        totals["durations"].append(span["seconds"])
+        for key in ("fps", "speed"):
+            if span.get(key):
+                totals[key] = span[key]
+
+        if span.get("batch") in _batch_spans:
+            _batch_spans[span["batch"]].append(span)
+
+        if METRICS_LOG:
+            try:
+                Path(METRICS_LOG).parent.mkdir(parents=True, exist_ok=True)
+                with open(METRICS_LOG, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(span, default=str) + "\n")
+            except OSError:
+                pass
+
+    if "parent" not in span:
+        WriteMetricsTextfile()
+
+
+def Percentile(values, fraction):
+
+    # Linear interpolation between the closest ranks; None for no values
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    position = (len(ordered) - 1) * fraction
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def MetricsText():
+
+    # The running totals in the Prometheus text exposition format
+    with _metrics_lock:
+        stages = {stage: dict(totals, durations=list(totals["durations"])) for stage, totals in sorted(_metrics.items())}
+
+    lines = ["# HELP ytdl_stage_seconds Time spent in each stage, quantiles over the last runs.",
+             "# TYPE ytdl_stage_seconds summary"]
+    for stage, totals in stages.items():
+        for quantile in (0.5, 0.95):
+            lines.append(f'ytdl_stage_seconds{{stage="{stage}",quantile="{quantile}"}} {Percentile(totals["durations"], quantile):.4f}')
+        lines.append(f'ytdl_stage_seconds_sum{{stage="{stage}"}} {totals["seconds"]:.4f}')
+        lines.append(f'ytdl_stage_seconds_count{{stage="{stage}"}} {totals["count"]}')
+
+    metrics = [
+        ("ytdl_stage_errors_total", "counter", "Stage runs that raised an error.", "errors"),
+        ("ytdl_downloaded_bytes_total", "counter", "Bytes downloaded.", "bytes"),
+        ("ytdl_output_bytes_total", "counter", "Bytes of finished output files.", "output_bytes"),
+        ("ytdl_encode_fps", "gauge", "Frames per second of the last ffmpeg run.", "fps"),
+        ("ytdl_encode_speed", "gauge", "Speed of the last ffmpeg run relative to real time.", "speed"),
+    ]
+    for name, kind, description, key in metrics:
+        values = [(stage, totals[key]) for stage, totals in stages.items() if totals.get(key)]
+        if not values:
+            continue
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+        lines += [f'{name}{{stage="{stage}"}} {value}' for stage, value in values]
+
+    return "\n".join(lines) + "\n"
+
+
+def WriteMetricsTextfile():
+
+    # Written next to the target and renamed over it, so a collector never reads half a file
+    if not METRICS_TEXTFILE:
+        return
+    try:
+        target = Path(METRICS_TEXTFILE)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        temp = target.with_name(f".{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        temp.write_text(MetricsText(), encoding="utf-8")
+        os.replace(temp, target)
+    except OSError as e:
+        print(f"{colors.YELLOW}Could not write the metrics textfile: {e}{colors.ENDC}")
+
+
+def PrintSpanSummary(spans, title="Stage timings"):
+
+    # p50/p95 per stage, slowest stages first by total time
+    durations = {}
+    for span in spans:
+        durations.setdefault(span["stage"], []).append(span["seconds"])
+    if not durations:
+        return
+
+    print(f"{colors.GREEN}{title}:{colors.ENDC}")
+    print(f"  {'stage':<20}{'runs':>6}{'p50':>10}{'p95':>10}{'total':>11}")
+    for stage, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+        print(f"  {stage:<20}{len(values):>6}{Percentile(values, 0.5):>9.2f}s{Percentile(values, 0.95):>9.2f}s{sum(values):>10.1f}s")
+
+
+def GetHttpSession():
+
+    # One pooled session for the whole run, so connections and TLS sessions get reused
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_HOSTS,
+                pool_maxsize=HTTP_POOL_PER_HOST,
+                # Wait for a free connection instead of opening extra ones past the limit
+                pool_block=True,
+                max_retries=Retry(total=2, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET", "HEAD"]),
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+
+    return _http_session
+
+
+def CanonicalVideoId(url):
+
+    # Pulls the 11 character video id out of the common YouTube url shapes
+    match = re.search(r"(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/|/v/)([A-Za-z0-9_-]{11})(?![A-Za-z0-9_-])", url)
+    return match.group(1) if match else None
+
+
+def IsCollectionUrl(url):
+    # Playlists and channels; a watch url with a list= parameter still means just that video
+    if CanonicalVideoId(url):
+        return False
+    return bool(re.search(r"[?&]list=|/playlist\b|/channel/|/c/|/user/|/@", url))
+
+
+def ExpandUrls(urls):
+
+    # Yields video urls. Playlists and channels are expanded with flat extraction one page at
+    # a time, as the consumer asks for more, so a channel with thousands of videos starts
+    # processing right away. Videos are deduplicated by id; only the ids are kept in memory.
+    seen = set()
+    for url in urls:
+        videos = ExpandCollection(url) if IsCollectionUrl(url) else [url]
+        try:
+            for video_url in videos:
+                key = CanonicalVideoId(video_url) or video_url
+                if key not in seen:
+                    seen.add(key)
+                    yield video_url
+        except (yt_dlp.utils.YoutubeDLError, requests.RequestException, OSError) as e:
+            # The lazy entries are fetched page by page outside yt-dlp's own error handling,
+            # so a page failing partway through only ends this url, not the whole batch
+            print(f"{colors.RED}Could not expand {url}: {e}{colors.ENDC}")
+
+
+def ExpandCollection(url, depth=0):
+
+    print(f"{colors.BLUE}Expanding {url}...{colors.ENDC}")
+    with yt_dlp.YoutubeDL({"quiet": True, "no_warnings": True, "extract_flat": "in_playlist", "lazy_playlist": True}) as ytdl:
+        # process=False keeps the entries as the extractor's generator instead of resolving all pages
+        result = ytdl.extract_info(url, download=False, process=False)
+
+        # Channel urls redirect to one of their tabs first
+        for _ in range(3):
+            if result.get("_type") not in ("url", "url_transparent"):
+                break
+            result = ytdl.extract_info(result["url"], download=False, process=False)
+
+        for entry in result.get("entries") or []:
+            if not entry:
+                continue
+            entry_url = entry.get("url") or ""
+            # A channel's tabs (videos, shorts, live) come back as nested playlists
+            if entry.get("_type") == "playlist" or entry.get("ie_key") == "YoutubeTab" or IsCollectionUrl(entry_url):
+                if depth < 2 and entry_url:
+                    yield from ExpandCollection(entry_url, depth + 1)
+            elif entry.get("id") and entry.get("ie_key") in (None, "Youtube"):
+                yield f"https://www.youtube.com/watch?v={entry['id']}"
+            elif entry_url:
+                yield entry_url
+
+
+def StreamUrlsValid(info, margin=600):
+
+    # YouTube stream urls carry an "expire" timestamp; treat the info as stale shortly before that
+    now = time.time()
+    for fmt in info.get("formats") or []:
+        expire = re.search(r"[?&/]expire[=/](\d+)", fmt.get("url") or "")
+        if expire and int(expire.group(1)) < now + margin:
+            return False
+
+    return True
+
+
+def OutputVariant(mode, encoder_choice=None, audio_format=None):
+
+    # Normalizes the user's choice so e.g. "3", "cpu" and "libx265" share library entries
+    if mode == 'audio':
+        return audio_format[1] if audio_format else "m4a"
+
+    choice = str(encoder_choice or "").lower()
+    for name, aliases in ENCODER_ALIASES.items():
+        if choice in aliases:
+            return name
+
+    return choice or "unknown"
+
+
+def GetLibraryIndex():
+
+    # Opened lazily; one connection shared by all threads and guarded by _library_lock
+    global _library_db
+    if _library_db is None:
+        LIBRARY_INDEX.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(str(LIBRARY_INDEX), check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        # The primary key doubles as the lookup index, so lookups stay fast with many entries
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS library (
+                video_id TEXT NOT NULL,
+                mode TEXT NOT NULL,
+                variant TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                checksum TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (video_id, mode, variant)
+            ) WITHOUT ROWID""")
+        # Progress of batch runs, one row per url, so an interrupted batch resumes where it stopped
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS batch_state (
+                batch TEXT NOT NULL,
+                url TEXT NOT NULL,
+                stage TEXT,
+                video_id TEXT,
+                title TEXT,
+                sponsors TEXT,
+                output TEXT,
+                error TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (batch, url)
+            ) WITHOUT ROWID""")
+        _library_db = db
+
+    return _library_db
+
+
+def LookupLibrary(video_id, mode, variant):
+
+    # Returns the output path of an earlier run, as long as the file is still there unchanged in size
+    if not video_id:
+        return None
+
+    try:
+        with _library_lock:
+            row = GetLibraryIndex().execute(
+                "SELECT path, size FROM library WHERE video_id = ? AND mode = ? AND variant = ?",
+                (video_id, mode, variant)).fetchone()
+    except sqlite3.Error as e:
+        print(f"{colors.YELLOW}Could not read the library index: {e}{colors.ENDC}")
+        return None
+
+    if row is None:
+        return None
+
+    path, size = row
+    try:
+        if os.path.getsize(path) == size:
+            return path
+    except OSError:
+        pass
+
+    # The file was moved, deleted or replaced; forget it. The index is shared with other
+    # processes, so a locked database only leaves the row for a later lookup.
+    try:
+        with _library_lock:
+            GetLibraryIndex().execute("DELETE FROM library WHERE video_id = ? AND mode = ? AND variant = ?", (video_id, mode, variant))
+    except sqlite3.Error as e:
+        print(f"{colors.YELLOW}Could not update the library index: {e}{colors.ENDC}")
+    return None
+
+
+def ReadBatchRecord(batch, url):
+
+    # Last stored state of url in the batch, {} when there is none
+    with _library_lock:
+        row = GetLibraryIndex().execute(
+            "SELECT stage, video_id, title, sponsors, output, error FROM batch_state WHERE batch = ? AND url = ?",
+            (batch, url)).fetchone()
+    if row is None:
+        return {}
+
+    record = dict(zip(("stage", "video_id", "title", "sponsors", "output", "error"), row))
+    record["sponsors"] = json.loads(record["sponsors"]) if record["sponsors"] else None
+    return record
+
+
+def WriteBatchRecord(batch, url, **fields):
+
+    # Updates only the given fields of the url's row; one small write per stage change
+    values = {key: json.dumps(value) if key == "sponsors" else value for key, value in fields.items()}
+    columns = ", ".join(["batch", "url", "updated_at", *values])
+    placeholders = ", ".join("?" * (len(values) + 3))
+    updates = ", ".join(f"{key} = excluded.{key}" for key in ["updated_at", *values])
+    with _library_lock:
+        GetLibraryIndex().execute(
+            f"INSERT INTO batch_state ({columns}) VALUES ({placeholders}) ON CONFLICT (batch, url) DO UPDATE SET {updates}",
+            (batch, url, time.time(), *values.values()))
+
+
+def CountBatchRecords(batch):
+
+    # (known urls, finished urls) of the batch
+    with _library_lock:
+        known, finished = GetLibraryIndex().execute(
+            "SELECT COUNT(*), COALESCE(SUM(stage = 'encoded'), 0) FROM batch_state WHERE batch = ?", (batch,)).fetchone()
+    return known, finished
+
+
+def DropBatchRecords(batch):
+    with _library_lock:
+        GetLibraryIndex().execute("DELETE FROM batch_state WHERE batch = ?", (batch,))
+
+
+def FileChecksum(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def RecordLibraryEntry(video_id, mode, variant, output_path):
+
+    # Remembers a finished output; failures here only cost a re-download later
+    if not video_id or not output_path or not os.path.exists(output_path):
+        return
+
+    try:
+        size = os.path.getsize(output_path)
+        checksum = FileChecksum(output_path)
+        with _library_lock:
+            GetLibraryIndex().execute(
+                "INSERT OR REPLACE INTO library (video_id, mode, variant, path, size, checksum, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (video_id, mode, variant, str(output_path), size, checksum, time.time()))
+    except (OSError, sqlite3.Error) as e:
+        print(f"{colors.YELLOW}Could not update the library index: {e}{colors.ENDC}")
+
+
+def CachePath(namespace, key):
+    # Every namespace gets its own folder, one json file per key
+    safe_key = "".join(x if x.isalnum() or x in "-_" else "_" for x in str(key))
+    return CACHE_DIR / namespace / f"{safe_key}.json"
+
+
+def ReadCache(namespace, key, max_age=None, empty_max_age=None):
+
+    # Returns the cached value, or None when it's missing, unreadable or older than max_age.
+    # Empty values (negative results) can be given a shorter lifetime with empty_max_age.
+    path = CachePath(namespace, key)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    value = entry.get("value")
+    if not value and empty_max_age is not None:
+        max_age = empty_max_age
+
+    if max_age is not None and time.time() - entry.get("stored_at", 0) > max_age:
+        return None
+
+    # Mark the entry as recently used for LRU eviction
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    return value
+
+
+def WriteCache(namespace, key, value):
+
+    # Write to a temporary file and rename it into place, so readers never see half a file
+    path = CachePath(namespace, key)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp_", suffix=".json")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"stored_at": time.time(), "value": value}, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"{colors.YELLOW}Could not write {namespace} cache: {e}{colors.ENDC}")
+
+
+def CacheKeyLock(namespace, key):
+
+    # In-process lock per cache entry, used to keep concurrent workers from fetching the same thing
+    with _cache_locks_guard:
+        return _cache_locks.setdefault((namespace, key), threading.Lock())
+
+
+def PruneCache(namespace, max_entries=None, max_bytes=None, every=50, max_age=None):
+
+    # Evict least recently used entries once the namespace grows past its limits, and entries
+    # not used for max_age seconds. Scanning the folder isn't free, so only do it every few writes.
+    with _cache_locks_guard:
+        count = _cache_prune_counters.get(namespace, 0)
+        _cache_prune_counters[namespace] = count + 1
+    if count % every:
+        return
+
+    entries = []
+    for path in (CACHE_DIR / namespace).glob("*.json"):
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+
+    # Oldest first
+    entries.sort()
+    total_bytes = sum(size for _, size, _ in entries)
+    expired = time.time() - max_age if max_age else None
+    while entries and ((max_entries and len(entries) > max_entries) or (max_bytes and total_bytes > max_bytes)
+                       or (expired is not None and entries[0][0] < expired)):
+        _, size, path = entries.pop(0)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total_bytes -= size
+
+
+def DropCache(namespace, key):
+    try:
+        os.remove(CachePath(namespace, key))
+    except OSError:
+        pass
+
+
+def GetSponsorsForVideo(video_id):
+
+    # Fetch SponsorBlock segments and report what was found. None when SponsorBlock couldn't
+    # be asked, so callers don't take a failed lookup for a video without segments.
     sponsors = []
     if video_id:
-        sponsors = FetchSponsorSegments(video_id)
-        if sponsors:
+        with Span("sponsors", video_id=video_id) as span:
+            sponsors = FetchSponsorSegments(video_id)
+            span["segments"] = len(sponsors) if sponsors is not None else None
+        if sponsors is None:
+            print(f"{colors.YELLOW}SponsorBlock unavailable; continuing without removing segments.{colors.ENDC}")
+        elif sponsors:
             print(f"{colors.CYAN}Fetched {len(sponsors)} SponsorBlock segment(s).{colors.ENDC}")
         else:
             print(f"{colors.YELLOW}No SponsorBlock segments found (API returned none).{colors.ENDC}")
     else:
-        print(f"{colors.YELLOW}No video ID; cannot query SponsorBlock.{colors.ENDC}") #######
+        print(f"{colors.YELLOW}No video ID; cannot query SponsorBlock.{colors.ENDC}")
+
+    return sponsors
+
+
+def ParseStageLimits(spec):
+
+    # Turns "download=3,encode=2" into a dictionary of per-stage worker counts
+    limits = dict(PIPELINE_STAGE_LIMITS)
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        name, _, value = part.partition("=")
+        name = name.strip().lower()
+        if name not in limits:
+            print(f"{colors.YELLOW}Unknown pipeline stage '{name}', ignoring.{colors.ENDC}")
+            continue
+        try:
+            limits[name] = max(1, int(value))
+        except ValueError:
+            print(f"{colors.YELLOW}Invalid worker count for stage '{name}': {value}{colors.ENDC}")
+
+    return limits
+
+
+def BatchStateKey(source, mode, encoder_choice=None, audio_format=None):
+    # The same url list run with the same settings continues from its earlier state
+    spec = json.dumps([str(source), mode, encoder_choice, list(audio_format) if audio_format else None])
+    return hashlib.sha256(spec.encode("utf-8")).hexdigest()[:32]
+
 
-    # Get platform & necessary paths
-    library_path, video_file, audio_file = GetPlatformAndOperatingSystem(video_id)
-    print(f"{colors.BLUE}Saving files to: {library_path}{colors.ENDC}")
+def RunBatchPipeline(urls, mode, encoder_choice=None, audio_format=None, stage_limits=None, state_key=None, connections=None, weight=None,
+                     cancel=None, timeout=None):
+
+    # Runs the batch through four stages (metadata, sponsors, download, encode),
+    # each with its own pool of workers and a bounded queue in front of it.
+    # This way the next video is already downloading while the previous one encodes.
+    # urls may be a generator (see ExpandUrls); it's consumed only as fast as the pipeline moves.
+    # Setting cancel stops the batch; timeout limits every video (default JOB_TIMEOUT).
+    limits = dict(PIPELINE_STAGE_LIMITS)
+    limits.update(stage_limits or {})
+
+    total = len(urls) if isinstance(urls, (list, tuple)) else "?"
+
+    # Only counts are kept in memory; finished jobs are dropped
+    counts = {"successes": 0, "failures": 0}
+    counts_lock = threading.Lock()
+
+    # Spans of this run are collected for the summary at the end
+    batch_id = uuid.uuid4().hex[:12]
+    with _metrics_lock:
+        _batch_spans[batch_id] = []
+    variant = OutputVariant(mode, encoder_choice, audio_format)
+
+    # Progress of every url is kept in the batch_state table of the library index, so an
+    # interrupted batch can be rerun and only does what's left. Rows are keyed by url, hold the
+    # last finished stage and are updated one at a time. Generators without a state_key can't be
+    # recognized on a rerun, so their rows are kept under this run's id and removed at the end.
+    if state_key is None and isinstance(urls, (list, tuple)):
+        state_key = BatchStateKey("\n".join(urls), mode, encoder_choice, audio_format)
+    batch_key = state_key or batch_id
+
+    def Record(job, **fields):
+        job["record"].update(fields)
+        WriteBatchRecord(batch_key, job["url"], **fields)
+
+    def Reached(job, stage):
+        done = job["record"].get("stage")
+        return done in BATCH_STAGES and BATCH_STAGES.index(done) >= BATCH_STAGES.index(stage)
+
+    def Count(key):
+        with counts_lock:
+            counts[key] += 1
+
+    known, finished = CountBatchRecords(batch_key)
+    if known:
+        print(f"{colors.CYAN}Resuming batch: {finished} of {known} known url(s) already finished.{colors.ENDC}")
+
+    skipped = 0
+
+    def Pending():
+        # Urls that were fully processed earlier, in this batch or any other run, are counted
+        # right away, before anything touches the network
+        nonlocal skipped
+        for i, url in enumerate(urls, 1):
+            if cancel is not None and cancel.is_set():
+                return
+            record = ReadBatchRecord(batch_key, url)
+            job = {"index": i, "url": url, "record": record}
+            if Reached(job, "encoded") and (not record.get("output") or os.path.exists(record["output"])):
+                Count("successes")
+                continue
+            if LookupLibrary(CanonicalVideoId(url), mode, variant):
+                Count("successes")
+                skipped += 1
+                continue
+            yield job
+
+    def StageMetadata(job):
+        print(f"{colors.BLUE}[{job['index']}/{total}]{colors.ENDC} {job['url']}")
+        record = job["record"]
+
+        # Downloaded streams don't need fresh stream urls, any earlier extraction will do
+        info = None
+        if Reached(job, "downloaded") and record.get("video_id"):
+            info = ReadCache("info", record["video_id"])
+        if info is None:
+            info = ExtractVideoInfo(job["url"])
+
+        job["info"] = info
+        job["title"] = info.get("title", "output")
+        job["video_id"] = info.get("id")
+        print(f"{colors.GREEN}Found a video titled: {job['title']}{colors.ENDC}")
+        if not Reached(job, "extracted"):
+            Record(job, stage="extracted", video_id=job["video_id"], title=job["title"])
+
+    def SponsorsKnown(job):
+        # Segments are only stored once SponsorBlock answered; a failed lookup is tried again on a rerun
+        return Reached(job, "sponsors") and job["record"].get("sponsors") is not None
+
+    def StageSponsors(job):
+        if SponsorsKnown(job):
+            job["sponsors"] = job["record"]["sponsors"]
+            return
+        sponsors = GetSponsorsForVideo(job["video_id"])
+        job["sponsors"] = sponsors or []
+        if sponsors is not None:
+            Record(job, stage="sponsors", sponsors=sponsors)
 
-    # Download + encode
-    return Downloader(url, title, library_path, audio_file, video_file, sponsors, mode, encoder_choice=encoder_choice, audio_format=audio_format)
+    def StageDownload(job):
+        library_path, video_file, audio_file = GetPlatformAndOperatingSystem(job["video_id"], variant)
+        job["library_path"], job["video_file"], job["audio_file"] = library_path, video_file, audio_file
 
+        needed = [audio_file] if mode == 'audio' else [video_file, audio_file]
+        downloaded = Reached(job, "downloaded") and all(os.path.exists(f) for f in needed)
+        sources = None if downloaded else ResolveStreamSources(mode, encoder_choice, audio_format, job["info"], weight)
 
-def GetPlatformAndOperatingSystem(video_id):
+        # Held until the encode finishes (or the job fails), so downloads don't outrun the disk
+        footprint = EstimateScratchBytes(job["info"], mode, encoder_choice, audio_format, streaming=downloaded or bool(sources))
+        job["scratch"] = ReserveScratch(ScratchDirectory(library_path), footprint, job["title"])
+
+        if downloaded:
+            print(f"{colors.CYAN}Streams of {job['title']} are already downloaded.{colors.ENDC}")
+            return
+
+        # Streamed jobs download while they encode; nothing lands on disk to resume from
+        if sources:
+            job["audio_file"], job["video_file"] = sources
+            return
+
+        # Half-finished .part files from an earlier run are continued with range requests
+        DownloadStreams(job["url"], audio_file, video_file, mode, info=job["info"], audio_format=audio_format,
+                        connections=connections, weight=weight)
+        Record(job, stage="downloaded")
+
+    def StageEncode(job):
+        output = EncodeStreams(job["library_path"], job["title"], job["audio_file"], job["video_file"], job["sponsors"], mode,
+                               encoder_choice=encoder_choice, audio_format=audio_format, info=job["info"])
+        ReleaseScratch(job.pop("scratch", None))
+        RecordLibraryEntry(job["video_id"], mode, variant, output)
+        Record(job, stage="encoded", output=output, error=None)
+        Count("successes")
+
+    stages = [
+        ("metadata", StageMetadata),
+        ("sponsors", StageSponsors),
+        ("download", StageDownload),
+        ("encode", StageEncode),
+    ]
+
+    # One queue in front of every stage. None is used as a stop signal.
+    queues = [queue.Queue(maxsize=PIPELINE_QUEUE_SIZE) for _ in stages]
+
+    def Worker(position, name, handler):
+        inbox = queues[position]
+        outbox = queues[position + 1] if position + 1 < len(queues) else None
+        while True:
+            job = inbox.get()
+            if job is None:
+                return
+            try:
+                # The video's time limit starts when it enters the first stage
+                control = job.setdefault("control", JobControl(cancel, timeout if timeout is not None else JOB_TIMEOUT))
+                with JobContext(control), Span(f"pipeline.{name}", batch=batch_id, video_id=job.get("video_id"), index=job["index"]):
+                    control.Check()
+                    handler(job)
+            except Exception as e:
+                # Record the failure and drop the job from the rest of the pipeline.
+                # The stored stage stays at the last one that finished, so a rerun starts here.
+                Record(job, error=f"{handler.__name__}: {e}")
+                ReleaseScratch(job.pop("scratch", None))
+                Count("failures")
+                print(f"{colors.RED}Failed [{job['index']}/{total}] {job['url']}: {e}{colors.ENDC}")
+                continue
+            if outbox is not None:
+                outbox.put(job)
+
+    pools = []
+    for position, (name, handler) in enumerate(stages):
+        workers = [threading.Thread(target=Worker, args=(position, name, handler), name=f"{name}-{n}", daemon=True)
+                   for n in range(limits[name])]
+        for w in workers:
+            w.start()
+        pools.append(workers)
+
+    # Feed the first stage; blocks when the metadata workers fall behind. SponsorBlock is
+    # looked up a group of urls at a time, in a few prefix requests per group.
+    try:
+        pending = Pending()
+        while True:
+            group = list(itertools.islice(pending, PREFETCH_GROUP_SIZE))
+            if not group:
+                break
+            with Span("sponsor_prefetch", batch=batch_id, videos=len(group)):
+                PrefetchSponsorSegments(CanonicalVideoId(job["url"]) for job in group if not SponsorsKnown(job))
+            for job in group:
+                queues[0].put(job)
+
+        if skipped:
+            print(f"{colors.CYAN}Skipped {skipped} video(s) already in the library.{colors.ENDC}")
+    finally:
+        # Shut the stages down in order, so every job gets through before its next stage stops.
+        # This also runs when feeding fails, so no worker (or its scratch) outlives the batch.
+        for position, workers in enumerate(pools):
+            for _ in workers:
+                queues[position].put(None)
+            for w in workers:
+                w.join()
+
+        with _metrics_lock:
+            spans = _batch_spans.pop(batch_id)
+    PrintSpanSummary(spans, f"Stage timings of this batch ({counts['successes'] + counts['failures']} url(s))")
+    WriteMetricsTextfile()
+
+    if not state_key:
+        DropBatchRecords(batch_key)
+
+    return counts["successes"], counts["failures"]
+
+
+def GetPlatformAndOperatingSystem(video_id, variant=None):
     # Find home
     home = Path.home()
 
@@ -136,17 +1405,112 @@ def GetPlatformAndOperatingSystem(video_id):
 
     library_path.mkdir(parents=True, exist_ok=True)
 
-    # Creates necessary paths for temp files
+    # Creates necessary paths for temp files, in the scratch directory when one is set. The output
+    # variant is part of the name, so e.g. a video and an audio job of the same video don't share files.
+    scratch_path = Path(ScratchDirectory(library_path))
     if video_id:
-        video_file = library_path / f"TEMP_video_{video_id}.mp4"
-        audio_file = library_path / f"TEMP_audio_{video_id}.m4a"
+        suffix = "_" + re.sub(r"[^\w.-]", "_", variant) if variant else ""
+        video_file = scratch_path / f"TEMP_video_{video_id}{suffix}.mp4"
+        audio_file = scratch_path / f"TEMP_audio_{video_id}{suffix}.m4a"
     else:
-        video_file = library_path / "TEMP_video.mp4"
-        audio_file = library_path / "TEMP_audio.m4a"
+        video_file = scratch_path / "TEMP_video.mp4"
+        audio_file = scratch_path / "TEMP_audio.m4a"
 
     return str(library_path), video_file, audio_file
 
 
+def ScratchDirectory(library_path):
+    # Where TEMP files and outputs in progress go; the library itself unless YTDL_SCRATCH_DIR is set
+    if not SCRATCH_DIR:
+        return str(library_path)
+    Path(SCRATCH_DIR).mkdir(parents=True, exist_ok=True)
+    return SCRATCH_DIR
+
+
+def PublishOutput(output_path, library_path):
+
+    # Moves a finished output from the scratch directory into the library. The file appears
+    # under its final name in one step, so the library never shows half-written files.
+    if not output_path:
+        return output_path
+    target = Path(library_path) / Path(output_path).name
+    if Path(output_path).resolve() == target.resolve():
+        return output_path
+
+    try:
+        os.replace(output_path, target)
+    except OSError:
+        # Different file systems: copy next to the target first, then rename into place
+        staging = target.with_name(f".{target.name}.part")
+        shutil.copyfile(output_path, staging)
+        os.replace(staging, target)
+        os.remove(output_path)
+
+    print(f"{colors.GREEN}Moved to the library: {target}{colors.ENDC}")
+    return str(target)
+
+
+def EstimateScratchBytes(info, mode, encoder_choice=None, audio_format=None, streaming=False):
+
+    # Rough disk footprint of a job: the selected streams (unless they're streamed) plus the output.
+    # Sizes come from the format list, or from bitrate x duration when yt-dlp doesn't know them.
+    try:
+        formats = SelectFormats(info, mode, audio_format)
+    except yt_dlp.utils.DownloadError:
+        return 0
+
+    duration = (info or {}).get("duration") or 0
+    downloads = 0
+    for fmt in formats:
+        size = fmt.get("filesize") or fmt.get("filesize_approx")
+        if not size and fmt.get("tbr") and duration:
+            size = fmt["tbr"] * 1000 / 8 * duration
+        downloads += size or 0
+
+    output = downloads * SCRATCH_OUTPUT_FACTOR.get(OutputVariant(mode, encoder_choice, audio_format), 1.0)
+    return int(output if streaming else downloads + output)
+
+
+def ReserveScratch(directory, size, label="", timeout=None):
+
+    # Waits until the scratch disk has room for size more bytes on top of what running jobs
+    # have reserved, then reserves it. A job is always let through when nothing else is
+    # running, so one oversized video can't block the queue forever. The wait ends early when
+    # the job is cancelled or runs out of time, or after timeout (SCRATCH_WAIT_TIMEOUT by default).
+    # Returns a release token.
+    token = object()
+    announced = False
+    timeout = SCRATCH_WAIT_TIMEOUT if timeout is None else timeout
+    deadline = time.monotonic() + timeout if timeout else None
+    control = CurrentJobControl()
+    with Span("scratch_wait", bytes_reserved=size), _scratch_condition:
+        while True:
+            free = shutil.disk_usage(directory).free
+            if free - sum(_scratch_reserved.values()) - size >= SCRATCH_MIN_FREE or not _scratch_reserved:
+                break
+            if control is not None:
+                control.Check()
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"No scratch space for {label} after waiting {timeout:g}s")
+            if not announced:
+                print(f"{colors.YELLOW}Waiting for scratch space for {label} ({size / 1024 ** 3:.1f} GiB needed, {free / 1024 ** 3:.1f} GiB free).{colors.ENDC}")
+                announced = True
+            # Other programs may free space too, so look again now and then
+            _scratch_condition.wait(timeout=1)
+
+        if free - size < SCRATCH_MIN_FREE:
+            print(f"{colors.YELLOW}{label} may not fit in the scratch space ({free / 1024 ** 3:.1f} GiB free).{colors.ENDC}")
+        _scratch_reserved[token] = size
+
+    return token
+
+
+def ReleaseScratch(token):
+    with _scratch_condition:
+        if _scratch_reserved.pop(token, None) is not None:
+            _scratch_condition.notify_all()
+
+
 def GetModeOfChoice():
 
     while True:
@@ -160,208 +1524,1525 @@ def GetModeOfChoice():
     print(f"{colors.RED}Invalid input. Please type 1 for full video and 2 for audio only.{colors.ENDC}")
 
 
-def Downloader(url, title, library_path, audio_file, video_file, sponsors, mode, encoder_choice=None, audio_format=None):
+def Downloader(url, title, library_path, audio_file, video_file, sponsors, mode, encoder_choice=None, audio_format=None, info=None, connections=None, weight=None):
 
-    print(f"{colors.GREEN}Initiating download...{colors.ENDC}")
+    # In streaming mode ffmpeg reads the stream urls directly and no TEMP files are written
+    sources = ResolveStreamSources(mode, encoder_choice, audio_format, info, weight)
 
+    # Hold the job back until the scratch disk has room for it
+    footprint = EstimateScratchBytes(info, mode, encoder_choice, audio_format, streaming=bool(sources)) if info else 0
+    token = ReserveScratch(ScratchDirectory(library_path), footprint, title)
     try:
-        # Video & audio downloads
-        if mode == 'video':
-            with yt_dlp.YoutubeDL({
-                    'format' : 'bv*[ext=mp4]/bv*',  # Fallback to best video if no mp4
-                    'outtmpl' : str(video_file),
-                    'noplaylist' : True,
-                    'quiet': True,
-                    'no_warnings' : True,
-                    'merge_output_format' : 'never',
-                    'postprocessors' : [],
-                }) as ytdl:
-                ytdl.download([url])
-                print(f"{colors.GREEN}Video download complete.{colors.ENDC}")
-
-            with yt_dlp.YoutubeDL({
-                    'format': 'ba[ext=m4a]/ba',     # Fallback to best audio if no m4a
-                    'outtmpl': str(audio_file),
-                    'noplaylist': True,
-                    'quiet': True,
-                    'no_warnings' : True,
-                    'merge_output_format' : 'never',
-                    'postprocessors' : [],
-                }) as ytdl:
-                ytdl.download([url])
-                print(f"{colors.GREEN}Audio download complete.{colors.ENDC}")
-        
-        # Audio only download
+        if sources:
+            audio_file, video_file = sources
+        else:
+            DownloadStreams(url, audio_file, video_file, mode, info=info, audio_format=audio_format, connections=connections, weight=weight)
+
+        return EncodeStreams(library_path, title, audio_file, video_file, sponsors, mode, encoder_choice=encoder_choice, audio_format=audio_format, info=info)
+    finally:
+        ReleaseScratch(token)
+
+
+def FormatSelectors(mode, audio_format=None):
+
+    # (label, yt-dlp format selector) of every stream a job needs; video first
+    if mode == 'video':
+        return [
+            ("Video", 'bv*[ext=mp4]/bv*'),      # Fallback to best video if no mp4
+            ("Audio", 'ba[ext=m4a]/ba'),        # Fallback to best audio if no m4a
+        ]
+    elif AudioPassthroughWanted(audio_format):
+        # Prefer the AAC stream so the audio can be used without re-encoding
+        return [("Audio-only", 'ba[ext=m4a]/bestaudio/best')]
+    else:
+        return [("Audio-only", 'bestaudio/best')]
+
+
+def AudioPassthroughWanted(audio_format):
+    return AUDIO_PASSTHROUGH and bool(audio_format) and audio_format[0] == 'aac'
+
+
+class StreamInput(str):
+
+    # A stream url that ffmpeg reads directly instead of a downloaded file. It behaves
+    # like the file path it replaces; InputArgs() adds the request headers yt-dlp uses.
+    def __new__(cls, url, headers=None, protocol="https"):
+        source = super().__new__(cls, url)
+        source.headers = headers or {}
+        source.protocol = protocol
+        return source
+
+
+def InputArgs(source):
+
+    # ffmpeg arguments that open a downloaded file or a StreamInput
+    if not isinstance(source, StreamInput):
+        return ['-i', str(source)]
+
+    args = []
+    if source.protocol in ("http", "https"):
+        # Long encodes outlive single connections; pick the stream up where it dropped
+        args += ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '10']
+    if source.headers:
+        args += ['-headers', "".join(f"{name}: {value}\r\n" for name, value in source.headers.items())]
+
+    return args + ['-i', str(source)]
+
+
+class StreamRelay:
+
+    # Local http server between ffmpeg and formats that must be fetched in pieces. ffmpeg reads
+    # a stream with one open-ended GET, which YouTube throttles for DASH formats; yt-dlp asks
+    # for them in http_chunk_size ranges instead. The relay does the same on ffmpeg's behalf
+    # and answers ffmpeg's own range requests, so seeks and reconnects still work.
+    MAX_STREAMS = 256
+
+    def __init__(self):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        relay = self
+        self.streams = {}
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                relay.Serve(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="stream-relay", daemon=True).start()
+
+    def Register(self, url, headers, chunk_size, weight=None):
+        # Returns the local url ffmpeg reads instead of url
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.streams[token] = (url, headers or {}, int(chunk_size), weight)
+            # Old entries belong to finished encodes; keep the table small in long-running daemons
+            while len(self.streams) > self.MAX_STREAMS:
+                self.streams.pop(next(iter(self.streams)))
+        return f"http://127.0.0.1:{self.server.server_address[1]}/{token}"
+
+    def Fetch(self, url, headers, start, end):
+        response = self.session.get(url, headers=dict(headers, Range=f"bytes={start}-{end}"), stream=True, timeout=30)
+        if response.status_code != 206:
+            response.close()
+            raise RuntimeError(f"HTTP {response.status_code} for bytes {start}-{end}")
+        return response
+
+    def Serve(self, request):
+        with self.lock:
+            entry = self.streams.get(request.path.strip("/"))
+        if entry is None:
+            request.send_error(404)
+            return
+        url, headers, chunk_size, weight = entry
+
+        # Relayed bytes count against the bandwidth cap like downloaded ones
+        scheduler = GetBandwidthScheduler()
+        flow = scheduler.Register(weight) if scheduler else None
+
+        match = re.match(r"bytes=(\d+)-(\d*)", request.headers.get("Range", ""))
+        start = int(match.group(1)) if match else 0
+
+        try:
+            # The first piece also tells the total size
+            response = self.Fetch(url, headers, start, start + chunk_size - 1)
+            size = int(response.headers.get("Content-Range", "").rsplit("/", 1)[-1])
+        except (RuntimeError, ValueError, requests.RequestException) as e:
+            request.send_error(502, str(e))
+            return
+        end = min(int(match.group(2)), size - 1) if match and match.group(2) else size - 1
+
+        request.send_response(206 if match else 200)
+        request.send_header("Content-Type", response.headers.get("Content-Type", "application/octet-stream"))
+        request.send_header("Content-Length", str(end - start + 1))
+        request.send_header("Accept-Ranges", "bytes")
+        if match:
+            request.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        request.end_headers()
+
+        # Errors just drop the connection; ffmpeg reconnects with a range request from where it stopped
+        position = start
+        try:
+            while True:
+                with response:
+                    for data in response.iter_content(chunk_size=256 * 1024):
+                        data = data[:end + 1 - position]
+                        if scheduler:
+                            scheduler.Consume(flow, len(data))
+                        request.wfile.write(data)
+                        position += len(data)
+                        if position > end:
+                            break
+                if position > end:
+                    return
+                response = self.Fetch(url, headers, position, min(position + chunk_size, end + 1) - 1)
+        except (OSError, RuntimeError, requests.RequestException):
+            return
+
+
+def GetStreamRelay():
+
+    # Started on first use
+    global _stream_relay
+    with _stream_relay_lock:
+        if _stream_relay is None:
+            _stream_relay = StreamRelay()
+        return _stream_relay
+
+
+def SelectFormat(info, selector):
+    # The format dict yt-dlp would download for one selector, picked from the extracted info
+    with yt_dlp.YoutubeDL({'format': selector, 'quiet': True, 'no_warnings': True}) as ytdl:
+        selected = ytdl.process_ie_result(copy.deepcopy(info), download=False)
+    return (selected.get("requested_formats") or [selected])[0]
+
+
+def SelectFormats(info, mode, audio_format=None):
+    # The format dicts of every stream this job needs
+    return [SelectFormat(info, selector) for _, selector in FormatSelectors(mode, audio_format)]
+
+
+def ResolveStreamSources(mode, encoder_choice=None, audio_format=None, info=None, weight=None):
+
+    # Returns (audio, video) StreamInputs when the job can be encoded straight from the
+    # stream urls, otherwise None and the streams are downloaded to TEMP files as usual.
+    # Paths that seek around in their input (smart cut, chunked libx265, audio passthrough
+    # with its concat demuxer cuts) keep using files.
+    if not STREAMING or not info:
+        return None
+
+    if mode == 'video':
+        variant = OutputVariant(mode, encoder_choice, audio_format)
+        if variant == "smartcut":
+            return None
+        if variant == "libx265" and LIBX265_CHUNK_WORKERS > 1 and (info.get("duration") or 0) > 2 * LIBX265_CHUNK_SECONDS:
+            return None
+    elif AudioPassthroughWanted(audio_format):
+        return None
+
+    try:
+        formats = SelectFormats(info, mode, audio_format)
+    except yt_dlp.utils.DownloadError as e:
+        print(f"{colors.YELLOW}Could not resolve stream urls ({e}); downloading instead.{colors.ENDC}")
+        return None
+
+    # ffmpeg's own reads can't be held back, so with a cap every stream has to go through the relay
+    capped = GetBandwidthScheduler() is not None
+
+    sources = []
+    for (label, _), fmt in zip(FormatSelectors(mode, audio_format), formats):
+        if not fmt.get("url") or fmt.get("protocol") not in STREAMABLE_PROTOCOLS:
+            print(f"{colors.YELLOW}{label} stream can't be read directly ({fmt.get('protocol')}); downloading instead.{colors.ENDC}")
+            return None
+        if capped and fmt["protocol"] not in ("http", "https"):
+            print(f"{colors.YELLOW}{label} stream ({fmt['protocol']}) can't be kept under the bandwidth cap; downloading instead.{colors.ENDC}")
+            return None
+        # Formats yt-dlp fetches in chunks are relayed the same way, or they'd be throttled
+        chunk_size = (fmt.get("downloader_options") or {}).get("http_chunk_size")
+        if (chunk_size or capped) and fmt["protocol"] in ("http", "https"):
+            relayed = GetStreamRelay().Register(fmt["url"], fmt.get("http_headers"), chunk_size or STREAM_RELAY_CHUNK_SIZE, weight)
+            sources.append(StreamInput(relayed, protocol="http"))
         else:
-            with yt_dlp.YoutubeDL({
-                    'format': 'bestaudio/best',
-                    'outtmpl': str(audio_file),
-                    'noplaylist': True,
-                    'quiet': True,
-                    'no_warnings' : True,
-                    'merge_output_format' : 'never',
-                    'postprocessors' : [],
-                }) as ytdl:
+            sources.append(StreamInput(fmt["url"], fmt.get("http_headers"), fmt["protocol"]))
+
+    print(f"{colors.GREEN}Streaming directly into ffmpeg, no temporary files.{colors.ENDC}")
+    if mode == 'video':
+        return sources[1], sources[0]
+    return sources[0], None
+
+
+def ParseRate(value):
+    # "20M" -> 20 MiB/s in bytes; empty or 0 means unlimited (None)
+    value = str(value or "").strip().upper()
+    if not value:
+        return None
+    match = re.fullmatch(r"([\d.]+)\s*([KMG]?)B?(?:/S)?", value)
+    if not match:
+        raise ValueError(f"Invalid rate '{value}'")
+    factor = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}[match.group(2)]
+    return int(float(match.group(1)) * factor) or None
+
+
+def ParseBandwidthSchedule(spec):
+
+    # "09:00-18:00=5M,22:00-06:00=0" -> [(start minute, end minute, rate)]; windows may wrap midnight
+    windows = []
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        try:
+            span, _, rate = part.partition("=")
+            start, _, end = span.strip().partition("-")
+            start_h, start_m = (int(x) for x in start.split(":"))
+            end_h, end_m = (int(x) for x in end.split(":"))
+            windows.append((start_h * 60 + start_m, end_h * 60 + end_m, ParseRate(rate)))
+        except ValueError:
+            print(f"{colors.YELLOW}Invalid bandwidth schedule entry '{part}', ignoring.{colors.ENDC}")
+
+    return windows
+
+
+class BandwidthScheduler:
+
+    # One token bucket for every download in the process, refilled at the current cap.
+    # Waiting downloads are served in weighted fair queueing order: each chunk gets a virtual
+    # finish time of start + size / weight and the smallest one goes first. Only downloads that
+    # are actually waiting compete, so bandwidth a finished or slow download leaves unused goes
+    # to the others right away, and the bucket keeps the total under the cap.
+    def __init__(self, limit=None, schedule=None, burst_seconds=0.5):
+        self.limit = limit
+        self.schedule = schedule or []
+        self.burst_seconds = burst_seconds
+        self.condition = threading.Condition()
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.virtual_time = 0.0
+        self.waiting = []
+        self.sequence = itertools.count()
+
+    def Rate(self):
+        # Current cap in bytes per second, None for unlimited
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.schedule:
+            inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+            if inside:
+                return rate
+        return self.limit
+
+    def Register(self, weight=1.0):
+        return {"weight": max(float(weight or 1.0), 0.01), "finish": 0.0}
+
+    def Refill(self, rate):
+        now = time.monotonic()
+        capacity = max(rate * self.burst_seconds, 64 * 1024)
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        return capacity
+
+    def Consume(self, flow, size):
+
+        # Blocks until size bytes fit under the cap. Called after every received chunk, so
+        # blocking here holds back the next read of that download.
+        if size <= 0 or not self.Rate():
+            return
+
+        with self.condition:
+            start = max(self.virtual_time, flow["finish"])
+            flow["finish"] = start + size / flow["weight"]
+            entry = (flow["finish"], next(self.sequence), size)
+            heapq.heappush(self.waiting, entry)
+
+            while True:
+                rate = self.Rate()
+                if not rate:
+                    break
+                capacity = self.Refill(rate)
+                # Chunks bigger than the bucket go through once it's full and leave it in debt
+                if self.waiting[0] is entry and self.tokens >= min(size, capacity):
+                    self.tokens -= size
+                    break
+                if self.waiting[0] is entry:
+                    delay = (min(size, capacity) - self.tokens) / rate
+                else:
+                    delay = 0.05
+                self.condition.wait(timeout=max(delay, 0.005))
+
+            self.waiting.remove(entry)
+            heapq.heapify(self.waiting)
+            self.virtual_time = max(self.virtual_time, start)
+            self.condition.notify_all()
+
+
+def GetBandwidthScheduler():
+
+    # Created on first use from YTDL_BANDWIDTH_LIMIT / YTDL_BANDWIDTH_SCHEDULE; None when neither is set
+    global _bandwidth_scheduler
+    with _bandwidth_scheduler_lock:
+        if _bandwidth_scheduler is None and (BANDWIDTH_LIMIT or BANDWIDTH_SCHEDULE):
+            try:
+                limit = ParseRate(BANDWIDTH_LIMIT)
+            except ValueError as e:
+                print(f"{colors.YELLOW}{e} in YTDL_BANDWIDTH_LIMIT; downloads are not capped.{colors.ENDC}")
+                limit = None
+            _bandwidth_scheduler = BandwidthScheduler(limit, ParseBandwidthSchedule(BANDWIDTH_SCHEDULE))
+
+    return _bandwidth_scheduler
+
+
+def SegmentedDownload(url, output_file, headers=None, connections=4, total_size=None, progress_hook=None, cancel=None, weight=1.0):
+
+    # Downloads url with several parallel range requests into a preallocated .segments file.
+    # Ranges are handed out from a shared queue, so fast connections take on more of them.
+    # Finished ranges are noted in a .segments.json sidecar; an interrupted download continues
+    # with the missing ones. Every range is retried on its own and the result is checked
+    # against the expected size before it's renamed into place.
+    from requests.adapters import HTTPAdapter
+
+    output_file = Path(output_file)
+    # Not ".part": yt-dlp would take this sparse file for one of its own partial downloads
+    part_file = output_file.with_name(output_file.name + ".segments")
+    sidecar = output_file.with_name(output_file.name + ".segments.json")
+
+    session = requests.Session()
+    session.headers.update(headers or {})
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=connections))
+    session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=connections))
+
+    try:
+        # Ask for the first byte: confirms range support and tells the size. Streamed and closed
+        # unread, so a server that ignores the range doesn't send the whole file here.
+        with session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=30) as probe:
+            content_range = probe.headers.get("Content-Range", "")
+            status = probe.status_code
+        if status != 206 or "/" not in content_range:
+            raise RuntimeError(f"Server doesn't support range requests (HTTP {status})")
+        size = int(content_range.rsplit("/", 1)[1])
+        if total_size and total_size != size:
+            print(f"{colors.YELLOW}Expected {total_size} bytes but the server reports {size}.{colors.ENDC}")
+
+        ranges = [(start, min(start + SEGMENT_SIZE, size) - 1) for start in range(0, size, SEGMENT_SIZE)]
+
+        # Continue an earlier attempt when the sidecar matches this download
+        done = set()
+        try:
+            with open(sidecar, "r", encoding="utf-8") as f:
+                previous = json.load(f)
+            if previous.get("size") == size and previous.get("segment_size") == SEGMENT_SIZE and part_file.exists():
+                done = set(previous.get("done", []))
+        except (OSError, ValueError):
+            pass
+
+        # Reserve the whole file up front; every connection writes at its own offsets
+        with open(part_file, "r+b" if part_file.exists() else "wb") as f:
+            f.truncate(size)
+            if hasattr(os, "posix_fallocate") and size:
+                try:
+                    os.posix_fallocate(f.fileno(), 0, size)
+                except OSError:
+                    pass
+
+        # Every connection counts against the shared bandwidth cap, sharing this download's weight
+        scheduler = GetBandwidthScheduler()
+        flow = scheduler.Register(weight) if scheduler else None
+
+        lock = threading.Lock()
+        downloaded = [sum(end - start + 1 for i, (start, end) in enumerate(ranges) if i in done)]
+        todo = queue.Queue()
+        for i in range(len(ranges)):
+            if i not in done:
+                todo.put(i)
+
+        def Report(status="downloading"):
+            if progress_hook:
+                progress_hook({"status": status, "downloaded_bytes": downloaded[0], "total_bytes": size})
+
+        def SaveSidecar():
+            tmp = sidecar.with_name(sidecar.name + ".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"url": url.split("?")[0], "size": size, "segment_size": SEGMENT_SIZE, "done": sorted(done)}, f)
+            os.replace(tmp, sidecar)
+
+        def FetchRange(handle, index):
+            start, end = ranges[index]
+            position = start
+            for attempt in range(SEGMENT_RETRIES):
+                if cancel is not None and cancel.is_set():
+                    raise yt_dlp.utils.DownloadCancelled("Segmented download cancelled")
+                try:
+                    # A retry only asks for what's still missing from the range. The response is
+                    # closed on every way out, so a refused or broken range doesn't leak its connection.
+                    with session.get(url, headers={"Range": f"bytes={position}-{end}"}, stream=True, timeout=30) as response:
+                        if response.status_code != 206:
+                            raise RuntimeError(f"HTTP {response.status_code} for bytes {position}-{end}")
+                        handle.seek(position)
+                        for chunk in response.iter_content(chunk_size=256 * 1024):
+                            if cancel is not None and cancel.is_set():
+                                raise yt_dlp.utils.DownloadCancelled("Segmented download cancelled")
+                            chunk = chunk[:end + 1 - position]
+                            if scheduler:
+                                scheduler.Consume(flow, len(chunk))
+                            handle.write(chunk)
+                            position += len(chunk)
+                            with lock:
+                                downloaded[0] += len(chunk)
+                            Report()
+                    if position != end + 1:
+                        raise RuntimeError(f"Range {start}-{end} ended early at {position}")
+                    return
+                except (requests.RequestException, RuntimeError) as e:
+                    if attempt == SEGMENT_RETRIES - 1:
+                        raise RuntimeError(f"Range {start}-{end} failed after {SEGMENT_RETRIES} attempts: {e}")
+                    time.sleep(min(2 ** attempt, 10))
+
+        def Worker():
+            with open(part_file, "r+b") as handle:
+                while True:
+                    try:
+                        index = todo.get_nowait()
+                    except queue.Empty:
+                        return
+                    FetchRange(handle, index)
+                    handle.flush()
+                    with lock:
+                        done.add(index)
+                        SaveSidecar()
+
+        workers = max(1, min(connections, todo.qsize()))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(Worker) for _ in range(workers)]
+            for future in as_completed(futures):
+                future.result()
+
+        # Verify before the file gets its final name
+        actual = os.path.getsize(part_file)
+        if len(done) != len(ranges) or actual != size:
+            raise RuntimeError(f"Segmented download incomplete: {actual} of {size} bytes")
+
+        os.replace(part_file, output_file)
+        try:
+            os.remove(sidecar)
+        except OSError:
+            pass
+        Report("finished")
+
+    finally:
+        session.close()
+
+
+def DownloadStreams(url, audio_file, video_file, mode, info=None, audio_format=None, connections=None, weight=None):
+
+    print(f"{colors.GREEN}Initiating download...{colors.ENDC}")
+
+    # Parallel range requests instead of yt-dlp's single connection, when asked for
+    if connections is None:
+        connections = SEGMENTED_CONNECTIONS
+
+    # Streams to fetch: (label, yt-dlp format selector, output file)
+    selectors = FormatSelectors(mode, audio_format)
+    files = [video_file, audio_file] if mode == 'video' else [audio_file]
+    targets = [(label, selector, output_file) for (label, selector), output_file in zip(selectors, files)]
+
+    # Set when one stream fails, so the other one stops at its next chunk
+    cancel = threading.Event()
+
+    # The fetches run on pool threads, so take the reporter and job control of this thread along
+    reporter = getattr(_thread_state, "reporter", None)
+    control = CurrentJobControl()
+
+    # Combined progress of all streams: label -> (downloaded bytes, total bytes)
+    progress = {}
+    progress_lock = threading.Lock()
+    slot = AcquireProgressSlot()
+    progress_bar = tqdm(total=0, desc="Download Progress", ncols=100, unit='B', unit_scale=True, \
+        colour='green', leave=False, position=slot)
+
+    # Downloads share the process-wide bandwidth cap, if one is set, in proportion to their weight
+    scheduler = GetBandwidthScheduler()
+
+    def ProgressHook(label, throttle=True):
+        flow = scheduler.Register(weight) if scheduler and throttle else None
+        received = [0]
+
+        def Hook(d):
+            if cancel.is_set():
+                raise yt_dlp.utils.DownloadCancelled(f"{label} download cancelled")
+            if control is not None and control.Interrupted():
+                cancel.set()
+                raise yt_dlp.utils.DownloadCancelled(f"{label} download stopped")
+
+            # yt-dlp calls this after every chunk; waiting here throttles the next read
+            if flow is not None and d.get('status') == 'downloading':
+                downloaded = d.get('downloaded_bytes') or 0
+                if downloaded > received[0]:
+                    scheduler.Consume(flow, downloaded - received[0])
+                received[0] = downloaded
+
+            if d.get('status') in ('downloading', 'finished'):
+                downloaded = d.get('downloaded_bytes') or 0
+                total = d.get('total_bytes') or d.get('total_bytes_estimate') or downloaded
+                with progress_lock:
+                    progress[label] = (downloaded, total)
+                    progress_bar.total = sum(t for _, t in progress.values())
+                    progress_bar.n = sum(b for b, _ in progress.values())
+                    progress_bar.refresh()
+                    if progress_bar.total:
+                        ReportProgress("download", progress_bar.n / progress_bar.total, reporter)
+        return Hook
+
+    def Fetch(label, format_selector, output_file):
+        if connections > 1 and info is not None and FetchSegmented(label, format_selector, output_file):
+            return
+
+        with yt_dlp.YoutubeDL({
+                'format' : format_selector,
+                'outtmpl' : str(output_file),
+                'noplaylist' : True,
+                'quiet': True,
+                'no_warnings' : True,
+                'noprogress' : True,
+                'merge_output_format' : 'never',
+                'continuedl' : True,                        # Pick up .part files left by an interrupted run
+                'postprocessors' : [],
+                'progress_hooks' : [ProgressHook(label)],
+            }) as ytdl:
+            if info is None:
                 ytdl.download([url])
-                print(f"{colors.GREEN}Audio-only download complete.{colors.ENDC}")
+            else:
+                # Select formats from the already extracted info instead of extracting again
+                try:
+                    ytdl.process_ie_result(copy.deepcopy(info), download=True)
+                except yt_dlp.utils.DownloadError:
+                    if cancel.is_set():
+                        raise
+                    # Stream urls in the info may have expired; extract again from the url
+                    DropCache("info", info.get("id"))
+                    ytdl.download([url])
+
+        # tqdm.write keeps the message from tearing the progress bar
+        tqdm.write(f"{colors.GREEN}{label} download complete.{colors.ENDC}")
+
+    def FetchSegmented(label, format_selector, output_file):
+        # Returns False when the stream isn't a plain http(s) file, so yt-dlp handles it instead
+        try:
+            fmt = SelectFormat(info, format_selector)
+        except yt_dlp.utils.DownloadError:
+            return False
+        if fmt.get("protocol") not in ("http", "https") or not fmt.get("url"):
+            return False
 
-    except Exception as e:
-        print(f"{colors.RED}Download failed: {str(e)}{colors.ENDC}")
-        sys.exit(1)
+        try:
+            # The segmented engine throttles every connection itself
+            SegmentedDownload(fmt["url"], output_file, fmt.get("http_headers"), connections, total_size=fmt.get("filesize"),
+                              progress_hook=ProgressHook(label, throttle=False), cancel=cancel, weight=weight)
+        except (RuntimeError, requests.RequestException) as e:
+            if cancel.is_set():
+                raise
+            # Expired urls or servers without range support: fall back to the regular download
+            tqdm.write(f"{colors.YELLOW}{label}: segmented download failed ({e}); using a single connection.{colors.ENDC}")
+            return False
+
+        tqdm.write(f"{colors.GREEN}{label} download complete ({connections} connections).{colors.ENDC}")
+        return True
+
+    with Span("download", mode=mode, connections=connections if connections > 1 else None) as span:
+        try:
+            # Video and audio are independent, so fetch them at the same time
+            with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+                futures = [pool.submit(Fetch, *target) for target in targets]
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception:
+                        cancel.set()
+                        raise
+
+        except Exception as e:
+            print(f"{colors.RED}Download failed: {str(e)}{colors.ENDC}")
+            # A cancelled or timed out job reports that instead of the aborted download
+            if control is not None:
+                control.Check()
+            # Let the caller decide; batch runs continue with the next URL
+            raise
+
+        finally:
+            progress_bar.close()
+            ReleaseProgressSlot(slot)
+            span["bytes"] = sum(b for b, _ in progress.values())
+
+
+def EncodeStreams(library_path, title, audio_file, video_file, sponsors, mode, encoder_choice=None, audio_format=None, info=None):
+
+    # Converters write into the scratch directory; the finished file is then moved into the library
+    encoder = encoder_choice if mode == 'video' else (audio_format or (None,))[0]
+    with Span("encode", mode=mode, encoder=encoder, sponsors=len(sponsors or [])) as span:
+        output = RunConverter(ScratchDirectory(library_path), title, audio_file, video_file, sponsors, mode,
+                              encoder_choice=encoder_choice, audio_format=audio_format, info=info)
+        span["output_bytes"] = os.path.getsize(output)
+
+    with Span("publish"):
+        return PublishOutput(output, library_path)
+
+
+def RunConverter(library_path, title, audio_file, video_file, sponsors, mode, encoder_choice=None, audio_format=None, info=None):
 
     # Check whether user wanted to download only audio
     if mode == 'audio':
-        return ConverterAudioOnly(library_path, title, audio_file, sponsors, audio_format)
+        return ConverterAudioOnly(library_path, title, audio_file, sponsors, audio_format, info=info)
     else:
         # Only prompt if encoder_choice is None
         if encoder_choice is None:
             encoder_choice = GetEncoderOfChoice()
 
         if encoder_choice in ['NVENC', 'nvenc', 'NVIDIA', 'nvidia', '1']:
-            ConverterNvenc(library_path, title, audio_file, video_file, sponsors)
+            return ConverterNvenc(library_path, title, audio_file, video_file, sponsors, info=info)
 
         elif encoder_choice in ['VAAPI', 'vaapi', 'AMD', 'amd', '2']:
-            ConverterVaapi(library_path, title, audio_file, video_file, sponsors)
+            return ConverterVaapi(library_path, title, audio_file, video_file, sponsors, info=info)
         
         elif encoder_choice in ['libx265', 'LIBX265', 'CPU', 'cpu', '3']:
-            ConverterLibx265(library_path, title, audio_file, video_file, sponsors)
+            return ConverterLibx265(library_path, title, audio_file, video_file, sponsors, info=info)
         
         elif encoder_choice in ['raw', 'rawfile', 'RAW', 'RAWFILE', '4']:
-            ConverterRaw(library_path, title, audio_file, video_file, sponsors)
+            return ConverterRaw(library_path, title, audio_file, video_file, sponsors, info=info)
+
+        elif encoder_choice in ['smartcut', 'SMARTCUT', 'smart', 'SMART', '5']:
+            return ConverterSmartCut(library_path, title, audio_file, video_file, sponsors, info=info)
+
+        elif encoder_choice in ['auto', 'AUTO', '6']:
+            return ConverterAuto(library_path, title, audio_file, video_file, sponsors, info=info)
         
         else:
             print(f"{colors.RED}Invalid choice. Please try again.{colors.ENDC}")
-            return Downloader(url, title, library_path, audio_file, video_file, sponsors)
+            return RunConverter(library_path, title, audio_file, video_file, sponsors, mode, audio_format=audio_format, info=info)
+
+
+def GetEncoderOfChoice():
+
+    # Prompt user for encoding choice.
+    while True:
+        encoder_choice = input(f"{colors.RED}Please choose an encoder:{colors.ENDC}\n 1. Nvenc = Nvidia gpu\n 2. Vaapi = AMD gpu\n 3. Libx265 = cpu\n 4. Rawfile\n 5. Smart cut = no re-encode, only around sponsor cuts\n 6. Auto = fastest encoder available on this machine     ")
+        if encoder_choice in ['NVENC', 'nvenc', 'NVIDIA', 'nvidia', '1', 'VAAPI', 'vaapi', 'AMD', 'amd', '2', 'libx265', 'LIBX265', 'CPU', 'cpu', '3', 'rawfile', 'raw', 'RAW', 'RAWFILE', '4', 'smartcut', 'SMARTCUT', 'smart', 'SMART', '5', 'auto', 'AUTO', '6']:
+            return encoder_choice
+
+        print(f"{colors.RED}Invalid input. Please choose again.{colors.ENDC}")
+
+
+def ProbeEncoders():
+
+    # Asks ffmpeg which encoders and hardware accelerations it was built with.
+    # The answer only changes with the ffmpeg binary, so it's cached per binary.
+    ffmpeg_path = shutil.which('ffmpeg')
+    if not ffmpeg_path:
+        raise RuntimeError("ffmpeg was not found on PATH")
+
+    binary_key = hashlib.sha1(f"{ffmpeg_path}:{os.path.getmtime(ffmpeg_path)}".encode("utf-8")).hexdigest()[:16]
+    cached = ReadCache("encoders", binary_key)
+    if cached:
+        return cached
+
+    def Listing(flag):
+        return RunProcess(['ffmpeg', '-hide_banner', flag]).stdout.splitlines()
+
+    # Encoder lines look like " V....D libx265   libx265 H.265 / HEVC"
+    encoders = sorted({line.split()[1] for line in Listing('-encoders') if len(line.split()) > 1 and len(line.split()[0]) == 6})
+    # The hwaccel list comes after a "Hardware acceleration methods:" header
+    hwaccels = sorted({line.strip() for line in Listing('-hwaccels') if line.strip() and not line.strip().endswith(':')})
+
+    capabilities = {"key": binary_key, "encoders": encoders, "hwaccels": hwaccels, "calibration": {}}
+    WriteCache("encoders", binary_key, capabilities)
+    return capabilities
+
+
+def CalibrateEncoders(capabilities):
+
+    # Encodes a few seconds of a synthetic source with every usable profile and records
+    # the fps. Profiles that ffmpeg lacks or whose device is missing are marked unusable;
+    # ones that fail the encode are only skipped until ENCODER_RETRY_AFTER has passed.
+    calibration = capabilities.setdefault("calibration", {})
+    failures = capabilities.setdefault("failures", {})
+    changed = False
+
+    for name, profile in ENCODER_PROFILES.items():
+        if name in calibration and (name not in failures or time.time() - failures[name] < ENCODER_RETRY_AFTER):
+            continue
+
+        fps = None
+        usable = profile["encoder"] in capabilities["encoders"] and \
+            (profile["hwaccel"] is None or profile["hwaccel"] in capabilities["hwaccels"]) and \
+            (profile["device"] is None or os.path.exists(profile["device"]))
+
+        if usable:
+            command = [
+                'ffmpeg',
+                *profile["input_args"],
+                '-f', 'lavfi', '-i', f"testsrc2=size=1280x720:rate=30:duration={ENCODER_CALIBRATION_SECONDS}",
+                *profile["output_args"],
+                '-f', 'null', '-'
+            ]
+            returncode, _ = RunFfmpeg(command, ENCODER_CALIBRATION_SECONDS, desc=f"Calibrating {name}")
+            stats = LastFfmpegStats() or {}
+            if returncode == 0 and stats.get("fps"):
+                fps = stats["fps"]
+                failures.pop(name, None)
+            else:
+                failures[name] = time.time()
+
+        calibration[name] = fps
+        changed = True
+        print(f"{colors.BLUE}Encoder {name}: {f'{fps:.0f} fps' if fps else 'unavailable'}{colors.ENDC}")
+
+    if changed:
+        WriteCache("encoders", capabilities["key"], capabilities)
+
+    return calibration
+
+
+def DemoteEncoder(name):
+
+    # An encoder that failed on a real job is left out of the auto order until its retry time
+    try:
+        capabilities = ProbeEncoders()
+    except (JobCancelled, TimeoutError):
+        raise
+    except Exception:
+        return
+    capabilities.setdefault("calibration", {})[name] = None
+    capabilities.setdefault("failures", {})[name] = time.time()
+    WriteCache("encoders", capabilities["key"], capabilities)
+
+
+def ResolveAutoEncoders():
+
+    # Usable encoders that meet the quality setting, fastest first. libx265 is always the
+    # last resort, so CPU-only machines end up there without any prompt.
+    min_quality = ENCODER_QUALITY_LEVELS.get(AUTO_MIN_QUALITY, 1)
+    try:
+        calibration = CalibrateEncoders(ProbeEncoders())
+    except (JobCancelled, TimeoutError):
+        raise
+    except Exception as e:
+        print(f"{colors.YELLOW}Encoder probing failed ({e}); using libx265.{colors.ENDC}")
+        return ['libx265']
+
+    ranked = sorted((name for name, fps in calibration.items()
+                     if fps and ENCODER_PROFILES[name]["quality"] >= min_quality),
+                    key=lambda name: calibration[name], reverse=True)
+    if 'libx265' not in ranked:
+        ranked.append('libx265')
+
+    return ranked
+
+
+def ConverterAuto(library_path, title, audio_file, video_file, sponsors, info=None):
+
+    # Uses the fastest encoder that works here and falls down the chain when one fails
+    converters = {
+        'nvenc': ConverterNvenc,
+        'vaapi': ConverterVaapi,
+        'libx265': ConverterLibx265,
+    }
+
+    candidates = ResolveAutoEncoders()
+    print(f"{colors.CYAN}Auto encoder order: {', '.join(candidates)}{colors.ENDC}")
+
+    for position, name in enumerate(candidates):
+        try:
+            return converters[name](library_path, title, audio_file, video_file, sponsors, info=info)
+        except (JobCancelled, TimeoutError):
+            raise
+        except RuntimeError as e:
+            if position + 1 == len(candidates):
+                raise
+            print(f"{colors.YELLOW}{name} failed ({e}); falling back to {candidates[position + 1]}.{colors.ENDC}")
+            DemoteEncoder(name)
+
+
+def GetAudioFormatOfChoice():
+    # Asks the user their preferred audio format
+    prompt = (
+        f"{colors.RED}Choose audio format:{colors.ENDC}\n"
+        "  1) AAC (.m4a) - best compatibility\n"
+        "  2) MP3 (.mp3) - universal\n"
+        "  3) FLAC (.flac) - lossless, large files\n"
+        "Your choice: "
+    )
+
+    formats = {
+        "1": ("aac", "m4a"),
+        "2": ("libmp3lame", "mp3"),
+        "3": ("flac", "flac"),
+    }
+
+    while True:
+        choice = input(prompt).strip().lower()
+        print(choice)
+        if choice in formats:
+            return formats[choice]
+        
+        print(f"{colors.RED}Invalid input. Please type 1 - 3 to choose between audio formats.{colors.ENDC}")
+
+
+def KeptIntervals(sponsors):
+
+    # Turns the sponsor segments into the (start, end) spans of the video that are kept.
+    # An end of None means "until the end of the file".
+    kept = []
+    cursor = 0.0
+    for sp in sorted(sponsors or [], key=lambda x: x["segment"][0]):
+        start, end = sp["segment"]
+        if start > cursor:
+            kept.append((cursor, start))
+        cursor = max(cursor, end)
+    kept.append((cursor, None))
+
+    return kept
+
+
+def BuildSponsorSegments(sponsors, video_input="0:v", audio_input="1:a", video_chain=None, audio_chain=None):
+
+    # Used to build the ffmpeg filter graph that cuts fetched segments out of the encoded video.
+    # segment/asegment hand every frame to exactly one output based on the precomputed cut
+    # points, so the per-frame cost doesn't grow with the number of sponsors. Removed pieces
+    # go to a null sink and kept pieces are joined with concat. Timestamps are shifted with
+    # PTS-STARTPTS so variable frame rate sources keep their timing. video_chain/audio_chain
+    # are appended after the cut (e.g. hwupload or loudnorm). Returns the graph and -map arguments.
+    kept = KeptIntervals(sponsors)
+
+    # Consecutive pieces of the source, alternating between removed and kept ones
+    pieces = []
+    cursor = 0.0
+    for start, end in kept:
+        if start > cursor:
+            pieces.append((cursor, False))
+        pieces.append((start, True))
+        cursor = end
+    cutting = len(pieces) > 1
+
+    streams = []
+    if video_input:
+        streams.append(("v", video_input, "segment", "nullsink", "setpts", video_chain or "null"))
+    if audio_input:
+        streams.append(("a", audio_input, "asegment", "anullsink", "asetpts", audio_chain or "anull"))
+
+    graph = []
+    maps = []
+    for kind, source, segment, sink, setpts, chain in streams:
+        if not cutting:
+            graph.append(f"[{source}]{chain}[{kind}out]")
+            maps += ['-map', f"[{kind}out]"]
+            continue
+
+        # Split the stream at every cut point
+        timestamps = "|".join(str(start) for start, _ in pieces[1:])
+        graph.append(f"[{source}]{segment}=timestamps={timestamps}" + "".join(f"[{kind}p{i}]" for i in range(len(pieces))))
+
+        kept_labels = []
+        for i, (_, keep) in enumerate(pieces):
+            if keep:
+                graph.append(f"[{kind}p{i}]{setpts}=PTS-STARTPTS[{kind}k{i}]")
+                kept_labels.append(f"{kind}k{i}")
+            else:
+                graph.append(f"[{kind}p{i}]{sink}")
+
+    if cutting:
+        # Join the kept pieces back together, video and audio interleaved the way concat expects
+        kept_indexes = [i for i, (_, keep) in enumerate(pieces) if keep]
+        inputs = "".join(f"[{kind}k{i}]" for i in kept_indexes for kind, *_ in streams)
+        outputs = "".join(f"[{kind}cut]" for kind, *_ in streams)
+        has_video = 1 if video_input else 0
+        has_audio = 1 if audio_input else 0
+        graph.append(f"{inputs}concat=n={len(kept_indexes)}:v={has_video}:a={has_audio}{outputs}")
+
+        for kind, _, _, _, _, chain in streams:
+            graph.append(f"[{kind}cut]{chain}[{kind}out]")
+            maps += ['-map', f"[{kind}out]"]
+
+    return ";".join(graph), maps
+
+
+def FetchSponsorSegments(video_id, categories=("sponsor","selfpromo")):
+
+    # Answer from the local cache when possible; empty results are cached too, but only real
+    # "no segments" answers. Failed requests return None and aren't cached.
+    cache_key = SponsorCacheKey(video_id, categories)
+    cached = ReadCache("sponsors", cache_key, SPONSOR_CACHE_TTL, empty_max_age=SPONSOR_NEGATIVE_CACHE_TTL)
+    if cached is not None:
+        return cached
+
+    # Only one worker fetches a given video, the others wait and read its result from the cache
+    with CacheKeyLock("sponsors", cache_key):
+        cached = ReadCache("sponsors", cache_key, SPONSOR_CACHE_TTL, empty_max_age=SPONSOR_NEGATIVE_CACHE_TTL)
+        if cached is not None:
+            return cached
+
+        # Uses SponsorBlock API to build dictionary of sponsored content in a video
+        url = f"{SPONSORBLOCK_API}/api/skipSegments"
+        params = {
+            "videoID": video_id,
+            "categories": json.dumps(list(categories))
+        }
+        try:
+            r = GetHttpSession().get(url, params=params, timeout=5)
+            # SponsorBlock answers 404 when a video has no segments
+            if r.status_code == 404:
+                out = []
+            else:
+                r.raise_for_status()
+                out = MergeSponsorSegments(r.json())
+        except Exception as e:
+            print(f"{colors.YELLOW}SponsorBlock fetch failed: {e}{colors.ENDC}")
+            return None
+
+        WriteCache("sponsors", cache_key, out)
+        PruneCache("sponsors", SPONSOR_CACHE_MAX_ENTRIES, SPONSOR_CACHE_MAX_BYTES)
+        return out
+
+
+def PrefetchSponsorSegments(video_ids, categories=("sponsor","selfpromo")):
+
+    # Looks up many videos ahead of time through the hash-prefix endpoint. The API doesn't
+    # take prefixes shorter than 4 characters, so ids rarely share a request; the gain comes
+    # from running the lookups in parallel before the pipeline needs them, and every result
+    # lands in the cache where FetchSponsorSegments picks it up later.
+    buckets = {}
+    for video_id in dict.fromkeys(v for v in video_ids if v):
+        key = SponsorCacheKey(video_id, categories)
+        if ReadCache("sponsors", key, SPONSOR_CACHE_TTL, empty_max_age=SPONSOR_NEGATIVE_CACHE_TTL) is not None:
+            continue
+        prefix = hashlib.sha256(video_id.encode("utf-8")).hexdigest()[:SPONSOR_HASH_PREFIX_LENGTH]
+        buckets.setdefault(prefix, []).append(video_id)
+
+    if not buckets:
+        return 0
+
+    def FetchBucket(prefix, bucket_ids):
+        r = GetHttpSession().get(f"{SPONSORBLOCK_API}/api/skipSegments/{prefix}",
+                                 params={"categories": json.dumps(list(categories))}, timeout=10)
+        # 404 means no video under this prefix has segments
+        if r.status_code == 404:
+            found = {}
+        else:
+            r.raise_for_status()
+            found = {item.get("videoID"): item.get("segments") or [] for item in r.json()}
+
+        # Fan the answer out to every video of the bucket, including the ones without segments
+        for video_id in bucket_ids:
+            WriteCache("sponsors", SponsorCacheKey(video_id, categories), MergeSponsorSegments(found.get(video_id, [])))
+        return len(bucket_ids)
+
+    fetched = 0
+    with ThreadPoolExecutor(max_workers=HTTP_POOL_PER_HOST) as pool:
+        futures = [pool.submit(FetchBucket, prefix, ids) for prefix, ids in buckets.items()]
+        for future in as_completed(futures):
+            try:
+                fetched += future.result()
+            except Exception as e:
+                # The videos of a failed bucket are fetched one by one later
+                print(f"{colors.YELLOW}SponsorBlock batch lookup failed: {e}{colors.ENDC}")
+
+    PruneCache("sponsors", SPONSOR_CACHE_MAX_ENTRIES, SPONSOR_CACHE_MAX_BYTES)
+    print(f"{colors.CYAN}Prefetched SponsorBlock data for {fetched} video(s) with {len(buckets)} parallel request(s).{colors.ENDC}")
+    return fetched
+
+
+def SponsorCacheKey(video_id, categories):
+    # Same video with a different category set is a different cache entry
+    return f"{video_id}_{'-'.join(sorted(categories))}"
+
+
+def MergeSponsorSegments(data):
+
+    # Build a sorted list of segments from SponsorBlock items
+    segments = []
+    for item in data:
+        seg = item.get("segment")
+        if not seg or len(seg) != 2:
+            continue
+        # Ensure floats
+        start, end = float(seg[0]), float(seg[1])
+        if end > start:
+            segments.append({"segment": [start, end], "category": item.get("category", "unknown")})
+
+    # Sort sponsor segments and sort out possible overlapping issues
+    segments.sort(key=lambda x: x["segment"][0])
+    merged = []
+    for s in segments:
+        if not merged:
+            merged.append(s)
+            continue
+        last = merged[-1]["segment"]
+        cur = s["segment"]
+        if cur[0] <= last[1] + 0.02:
+            last[1] = max(last[1], cur[1])
+        else:
+            merged.append(s)
+            
+    # Preserve categories only for logging (FFmpeg only needs the times)
+    out = []
+    for m in merged:
+        out.append({"segment": m["segment"], "category": "merged"})
+    return out
+
+
+def SourceDuration(info, media_file):
+
+    # Length of the source, from the extracted info when yt-dlp knows it, otherwise via ffprobe
+    duration = (info or {}).get("duration")
+    if duration:
+        return float(duration)
+
+    return GetVideoDuration(media_file)
+
+
+def ExpectedDuration(info, sponsors, media_file):
+
+    # Length of the output once the sponsor segments are cut out
+    duration = SourceDuration(info, media_file)
+    kept = 0.0
+    for start, end in KeptIntervals(sponsors):
+        end = duration if end is None else min(end, duration)
+        kept += max(0.0, end - start)
+
+    return kept or duration
+
+
+class ProcessSupervisor:
+
+    # Runs the ffmpeg/ffprobe children of the whole process from one asyncio event loop on a
+    # background thread. The loop reads their output, stops them when their job is cancelled
+    # or out of time and reaps them, so no thread sits on a pipe per child. Callers block on
+    # their own result only.
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.children = set()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="process-supervisor", daemon=True)
+        self.thread.start()
+
+    def Run(self, command, on_line=None, control=None):
+        # Returns (exit code, stdout, tail of stderr). on_line gets every stdout line instead,
+        # as it arrives, on the loop's thread.
+        return self.Wait(self.Supervise(command, on_line, control))
+
+    def RunMany(self, commands, limit, on_done=None, control=None):
+        # Runs commands with at most limit children at a time and calls on_done(index, result)
+        # for every finished one. The first failure stops the others and is raised.
+        return self.Wait(self.SuperviseMany(commands, limit, on_done, control))
+
+    def Wait(self, coroutine):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        try:
+            return future.result()
+        except BaseException:
+            # Also stops the children when the waiting thread is interrupted (Ctrl+C)
+            future.cancel()
+            raise
+
+    async def Supervise(self, command, on_line=None, control=None):
+        if control is not None:
+            control.Check()
+
+        process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE, limit=1024 * 1024)
+        self.children.add(process)
+        stdout = []
+        stderr_tail = deque(maxlen=200)
+
+        async def Pump(stream, sink):
+            async for line in stream:
+                sink(line.decode("utf-8", errors="replace"))
+
+        reading = asyncio.gather(Pump(process.stdout, on_line or stdout.append), Pump(process.stderr, stderr_tail.append), process.wait())
+        try:
+            # Wakes up now and then to look at the job's cancellation and deadline
+            while True:
+                try:
+                    await asyncio.wait_for(asyncio.shield(reading), PROCESS_POLL_INTERVAL if control is not None else None)
+                    break
+                except asyncio.TimeoutError:
+                    control.Check()
+        except BaseException:
+            await self.Stop(process)
+            reading.cancel()
+            with contextlib.suppress(BaseException):
+                await reading
+            raise
+        finally:
+            self.children.discard(process)
+
+        return process.returncode, "".join(stdout), "".join(stderr_tail)
+
+    async def SuperviseMany(self, commands, limit, on_done=None, control=None):
+        gate = asyncio.Semaphore(max(1, limit))
+
+        async def One(index, command):
+            async with gate:
+                result = await self.Supervise(command, control=control)
+            if result[0] != 0:
+                raise RuntimeError(f"{command[0]} exited with error code {result[0]}: {result[2][-500:]}")
+            if on_done is not None:
+                on_done(index, result)
+            return result
+
+        tasks = [asyncio.ensure_future(One(index, command)) for index, command in enumerate(commands)]
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            # After a failure or cancellation the children still running are stopped
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def Stop(self, process):
+        # SIGTERM first so ffmpeg can finish its output file cleanly, SIGKILL if it doesn't exit
+        if process.returncode is not None:
+            return
+        with contextlib.suppress(ProcessLookupError):
+            process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), PROCESS_TERMINATE_GRACE)
+        except asyncio.TimeoutError:
+            with contextlib.suppress(ProcessLookupError):
+                process.kill()
+            await process.wait()
+
+    async def StopChildren(self):
+        await asyncio.gather(*(self.Stop(process) for process in list(self.children)), return_exceptions=True)
+
+    def StopAll(self):
+        # Registered with atexit: no ffmpeg outlives the downloader
+        if self.children:
+            with contextlib.suppress(Exception):
+                asyncio.run_coroutine_threadsafe(self.StopChildren(), self.loop).result(timeout=PROCESS_TERMINATE_GRACE + 1)
+
+
+def GetProcessSupervisor():
+
+    # Started on first use
+    global _process_supervisor
+    with _process_supervisor_lock:
+        if _process_supervisor is None:
+            _process_supervisor = ProcessSupervisor()
+            atexit.register(_process_supervisor.StopAll)
+        return _process_supervisor
+
+
+def RunProcess(command, check=False):
+
+    # subprocess.run(command, capture_output=True, text=True) through the supervisor, so the
+    # child stops when the job of this thread is cancelled or runs out of time
+    returncode, stdout, stderr = GetProcessSupervisor().Run(command, control=CurrentJobControl())
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command, stdout, stderr)
+    return subprocess.CompletedProcess(command, returncode, stdout, stderr)
+
+
+def RunFfmpeg(command, total_duration, desc="Encoding Progress"):
+
+    # Runs ffmpeg and drives a progress bar from its machine-readable -progress output.
+    # Returns the exit code and the tail of stderr for error messages. Stats of the last
+    # run (fps, speed, output size) are available through LastFfmpegStats() and the run's span.
+    with Span("ffmpeg", desc=desc) as span:
+        command = [command[0], '-progress', 'pipe:1', '-nostats'] + list(command[1:])
+
+        # The output is read on the supervisor's thread, so take the reporter of this one along
+        reporter = getattr(_thread_state, "reporter", None)
+
+        # Initialize progress bar & formatting
+        slot = AcquireProgressSlot()
+        progress_bar = tqdm(total=100, desc=desc, ncols=100, unit='%', \
+            bar_format='{desc}: |{bar}|{percentage:3.0f}%{postfix}', colour='blue', leave=False, position=slot)
+
+        stats = {"out_time": 0.0, "fps": None, "speed": None, "total_size": None}
+        block = {}
+
+        def OnLine(line):
+            # ffmpeg writes key=value lines and ends every update with a progress= line
+            key, _, value = line.strip().partition("=")
+            if key != "progress":
+                block[key] = value
+                return
+
+            try:
+                if block.get("out_time_us", "N/A") != "N/A":
+                    stats["out_time"] = int(block["out_time_us"]) / 1_000_000
+                if block.get("fps"):
+                    stats["fps"] = float(block["fps"])
+                if block.get("speed", "N/A") != "N/A":
+                    stats["speed"] = float(block["speed"].rstrip("x"))
+                if block.get("total_size", "N/A") != "N/A":
+                    stats["total_size"] = int(block["total_size"])
+            except ValueError:
+                pass
+            block.clear()
+
+            if total_duration:
+                progress = round(min(stats["out_time"] / total_duration * 100, 100), 2)
+                progress_bar.n = progress
+                progress_bar.last_print_n = progress
+                ReportProgress("encode", progress / 100, reporter)
+
+            postfix = []
+            if stats["fps"]:
+                postfix.append(f"{stats['fps']:.0f} fps")
+            if stats["speed"]:
+                postfix.append(f"{stats['speed']:.2f}x")
+            if stats["total_size"]:
+                postfix.append(f"{stats['total_size'] / 1_048_576:.1f} MiB")
+            progress_bar.set_postfix_str(" ".join(postfix), refresh=False)
+            progress_bar.update(0)
+
+        try:
+            returncode, _, stderr = GetProcessSupervisor().Run(command, on_line=OnLine, control=CurrentJobControl())
+        finally:
+            progress_bar.close()
+            ReleaseProgressSlot(slot)
+
+        _ffmpeg_stats.last = stats
+        span.update(returncode=returncode, fps=stats["fps"], speed=stats["speed"], output_bytes=stats["total_size"])
+        return returncode, stderr
+
+
+def LastFfmpegStats():
+    # Stats of the last RunFfmpeg call made on this thread
+    return getattr(_ffmpeg_stats, "last", None)
+
+
+def GetVideoDuration(video_file):
+
+    # Ffprobe to get the video duration
+    command = [
+        'ffprobe', '-v', 'error', '-show_entries', 'format=duration', 
+        '-of', 'default=noprint_wrappers=1:nokey=1', video_file
+    ]
+    
+    try:
+        # Run the ffprobe command to get the duration in seconds
+        with Span("probe"):
+            duration_str = RunProcess(command, check=True).stdout.strip()
+        total_duration = float(duration_str)  # Convert to float (seconds)
+        return total_duration
+
+    except subprocess.CalledProcessError as e:
+        # If Ffprobe fails
+        print(f"{colors.RED}Error running ffprobe to get video duration: {e.output}{colors.ENDC}")
+        raise
+
+    except ValueError:
+        # If duration_str can't be converted
+        print(f"{colors.RED}Error: Could not convert the duration to float: {duration_str}{colors.ENDC}")
+        raise
+
+
+def MeasureLoudness(audio_file, sponsors, video_id=None):
+
+    # Measures the loudness of what remains after the sponsor cut. The result is cached per
+    # video and cut, so reruns and re-encodes with another encoder skip the analysis.
+    cache_key = LoudnessCacheKey(sponsors, video_id)
+    if cache_key:
+        cached = ReadCache("loudness", cache_key)
+        if cached:
+            return cached
+
+    # ebur128 measures without resampling the whole stream to 192 kHz like loudnorm does
+    filter_graph, maps = BuildSponsorSegments(sponsors, video_input=None, audio_input="0:a",
+                                              audio_chain="ebur128=peak=true:framelog=verbose")
+    command = [
+        'ffmpeg', '-hide_banner', '-nostats',
+        *InputArgs(audio_file),
+        '-filter_complex', filter_graph, *maps,
+        '-f', 'null', '-'
+    ]
+    result = RunProcess(command)
+    if result.returncode != 0:
+        raise RuntimeError(f"Loudness analysis failed with error code {result.returncode}")
+
+    # Values come from the summary ebur128 prints at the end
+    summary = result.stderr[result.stderr.rfind("Summary:"):]
+    values = {}
+    for key, pattern in [("integrated", r"I:\s+(-?[\d.]+|-inf) LUFS"), ("range", r"LRA:\s+(-?[\d.]+) LU"), ("true_peak", r"Peak:\s+(-?[\d.]+|-inf) dBFS")]:
+        match = re.search(pattern, summary)
+        if not match:
+            raise RuntimeError(f"Could not read {key} loudness from ffmpeg output")
+        values[key] = float(match.group(1))
+
+    if cache_key:
+        WriteCache("loudness", cache_key, values)
+
+    return values
+
+
+def LoudnessCacheKey(sponsors, video_id):
+    kept = KeptIntervals(sponsors)
+    cut_signature = hashlib.sha1(json.dumps(kept).encode("utf-8")).hexdigest()[:12]
+    return f"{video_id}_{cut_signature}" if video_id else None
+
+
+def BuildLoudnessFilter(audio_file, sponsors, info=None, allow_tags=False):
+
+    # Returns the audio filter used for normalization and, in "tags" mode for audio-only
+    # files, the ReplayGain tags to write instead
+    target_i, target_tp, target_lra = LOUDNESS_TARGET
+    dynamic = f"loudnorm=I={target_i:g}:TP={target_tp:g}:LRA={target_lra:g}"
+
+    if LOUDNESS_MODE == "dynamic":
+        return dynamic, {}
+
+    video_id = (info or {}).get("id")
+
+    # Measuring a streamed input would download the audio once for the analysis and again
+    # for the encode, which couldn't start until the analysis is done. Only an earlier
+    # measurement is used then, otherwise the single-pass filter.
+    if isinstance(audio_file, StreamInput):
+        cache_key = LoudnessCacheKey(sponsors, video_id)
+        measured = ReadCache("loudness", cache_key) if cache_key else None
+        if not measured:
+            print(f"{colors.CYAN}Streaming input; normalizing loudness in a single pass.{colors.ENDC}")
+            return dynamic, {}
+    else:
+        try:
+            measured = MeasureLoudness(audio_file, sponsors, video_id)
+        except (JobCancelled, TimeoutError):
+            raise
+        except Exception as e:
+            print(f"{colors.YELLOW}Loudness analysis failed ({e}); using single-pass loudnorm.{colors.ENDC}")
+            return dynamic, {}
 
+    # Silent input, nothing to normalize
+    if measured["integrated"] == float("-inf"):
+        return "anull", {}
 
-def GetEncoderOfChoice():
+    print(f"{colors.BLUE}Measured loudness: {measured['integrated']:.1f} LUFS, true peak {measured['true_peak']:.1f} dBTP{colors.ENDC}")
 
-    # Prompt user for encoding choice.
-    while True:
-        encoder_choice = input(f"{colors.RED}Please choose an encoder:{colors.ENDC}\n 1. Nvenc = Nvidia gpu\n 2. Vaapi = AMD gpu\n 3. Libx265 = cpu\n 4. Rawfile     ")
-        if encoder_choice in ['NVENC', 'nvenc', 'NVIDIA', 'nvidia', '1', 'VAAPI', 'vaapi', 'AMD', 'amd', '2', 'libx265', 'LIBX265', 'CPU', 'cpu', '3', 'rawfile', 'raw', 'RAW', 'RAWFILE', '4']:
-            return encoder_choice
+    if LOUDNESS_MODE == "tags" and allow_tags:
+        return "anull", ReplayGainTags(measured)
 
-        print(f"{colors.RED}Invalid input. Please choose again.{colors.ENDC}")
+    return f"volume={LoudnessGain(measured):.2f}dB", {}
 
 
-def GetAudioFormatOfChoice():
-    # Asks the user their preferred audio format
-    prompt = (
-        f"{colors.RED}Choose audio format:{colors.ENDC}\n"
-        "  1) AAC (.m4a) - best compatibility\n"
-        "  2) MP3 (.mp3) - universal\n"
-        "  3) FLAC (.flac) - lossless, large files\n"
-        "Your choice: "
-    )
+def LoudnessGain(measured):
+    # A linear gain towards the target, limited so the true peak stays under its ceiling
+    target_i, target_tp, _ = LOUDNESS_TARGET
+    return min(target_i - measured["integrated"], target_tp - measured["true_peak"])
 
-    formats = {
-        "1": ("aac", "m4a"),
-        "2": ("libmp3lame", "mp3"),
-        "3": ("flac", "flac"),
+
+def ReplayGainTags(measured):
+    # ReplayGain 2 uses -18 LUFS as its reference level
+    return {
+        "REPLAYGAIN_TRACK_GAIN": f"{-18.0 - measured['integrated']:.2f} dB",
+        "REPLAYGAIN_TRACK_PEAK": f"{10 ** (measured['true_peak'] / 20):.6f}",
     }
 
-    while True:
-        choice = input(prompt).strip().lower()
-        print(choice)
-        if choice in formats:
-            return formats[choice]
-        
-        print(f"{colors.RED}Invalid input. Please type 1 - 3 to choose between audio formats.{colors.ENDC}")
 
+def WriteMp4ReplayGainTags(output_path, tags):
 
-def BuildSponsorSegments(sponsors):
+    # The mp4 muxer only keeps unknown tags as mdta keys, which most players ignore. ReplayGain
+    # goes into iTunes freeform atoms instead, where players and taggers look for it.
+    if not tags:
+        return
+    try:
+        audio = mutagen_mp4.MP4(str(output_path))
+    except ImportError:
+        print(f"{colors.YELLOW}mutagen isn't installed; writing the file without ReplayGain tags.{colors.ENDC}")
+        return
+    for tag, value in tags.items():
+        audio[f"----:com.apple.iTunes:{tag}"] = [mutagen_mp4.MP4FreeForm(value.encode("utf-8"))]
+    audio.save()
 
-    # Used to build the ffmpeg filter expressions to cut fetched segments out of the encoded video
-    # Check for sponsor segments, if none return from this with nothing
-    if not sponsors:
-        return None, None
 
-    chapters = []
-    # Build list of filter expressions
-    for sp in sponsors:
-        start, end = sp["segment"]
-        chapters.append(f"not(between(t\\,{start}\\,{end}))")
+def GetAudioCodec(audio_file):
+
+    # Ffprobe the codec of the first audio stream
+    command = [
+        'ffprobe', '-v', 'error', '-select_streams', 'a:0',
+        '-show_entries', 'stream=codec_name', '-of', 'default=noprint_wrappers=1:nokey=1', str(audio_file)
+    ]
+    return RunProcess(command, check=True).stdout.strip()
 
-    # Keep the frame if it's outside compiled segment list
-    expr = " * ".join(chapters)
 
-    # Ffmpeg filters
-    vf = f"select={expr},setpts=N/FRAME_RATE/TB"
-    af = f"aselect={expr},asetpts=N/SR/TB"
+def PlanAudioOnly(source_codec, codec, sponsors, measured=None):
 
-    return vf, af
+    # Decides how an audio-only file is produced:
+    #   "copy"      - the source already is what was asked for, only remux it
+    #   "cut-copy"  - same, but sponsors are cut out at packet boundaries
+    #   "transcode" - decode, filter and encode like before
+    # In "gain" mode the samples still have to change unless the measured gain is negligible.
+    if not AUDIO_PASSTHROUGH or LOUDNESS_MODE not in ("gain", "tags"):
+        return "transcode"
 
+    if AUDIO_CODEC_NAMES.get(codec) != source_codec:
+        return "transcode"
 
-def FetchSponsorSegments(video_id, categories=("sponsor","selfpromo")):
-   
-    # Uses SponsorBlock API to build dictionary of sponsored content in a video
-    url = "https://sponsor.ajay.app/api/skipSegments"
-    params = {
-        "videoID": video_id,
-        "categories": json.dumps(list(categories))
-    }
+    if LOUDNESS_MODE == "gain":
+        if measured is None:
+            return "transcode"
+        if measured["integrated"] != float("-inf") and abs(LoudnessGain(measured)) > AUDIO_PASSTHROUGH_GAIN_TOLERANCE:
+            return "transcode"
+
+    return "cut-copy" if sponsors else "copy"
+
+
+def AudioPassthrough(audio_file, output_path, sponsors, info=None):
+
+    # Produces the audio-only file without re-encoding. Loudness goes into ReplayGain tags.
+    audio_file_str = str(audio_file)
+    video_id = (info or {}).get("id")
+
+    tags = {}
     try:
-        r = requests.get(url, params=params, timeout=5)
-        r.raise_for_status()
-        data = r.json()
-        segments = []
-        for item in data:
-            seg = item.get("segment")
-            if not seg or len(seg) != 2:
-                continue
-            # Ensure floats
-            start, end = float(seg[0]), float(seg[1])
-            if end > start:
-                segments.append({"segment": [start, end], "category": item.get("category", "unknown")})
-
-        # Sort sponsor segments and sort out possible overlapping issues
-        segments.sort(key=lambda x: x["segment"][0])
-        merged = []
-        for s in segments:
-            if not merged:
-                merged.append(s)
-                continue
-            last = merged[-1]["segment"]
-            cur = s["segment"]
-            if cur[0] <= last[1] + 0.02:
-                last[1] = max(last[1], cur[1])
-            else:
-                merged.append(s)
-                
-        # Preserve categories only for logging (FFmpeg only needs the times)
-        out = []
-        for m in merged:
-            out.append({"segment": m["segment"], "category": "merged"})
-        return out
+        measured = MeasureLoudness(audio_file, sponsors, video_id)
+        if measured["integrated"] != float("-inf"):
+            tags = ReplayGainTags(measured)
+    except (JobCancelled, TimeoutError):
+        raise
     except Exception as e:
-        print(f"{colors.YELLOW}SponsorBlock fetch failed: {e}{colors.ENDC}")
-        return []
+        print(f"{colors.YELLOW}Loudness analysis failed ({e}); writing the file without ReplayGain tags.{colors.ENDC}")
+
+    with tempfile.TemporaryDirectory(dir=Path(output_path).parent, prefix="TEMP_passthrough_") as work_dir:
+        if sponsors:
+            # Concat demuxer script that reads only the kept spans of the source
+            list_file = Path(work_dir) / "spans.txt"
+            with open(list_file, "w", encoding="utf-8") as f:
+                for start, end in KeptIntervals(sponsors):
+                    f.write(f"file '{Path(audio_file_str).resolve().as_posix()}'\n")
+                    f.write(f"inpoint {start:.6f}\n")
+                    if end is not None:
+                        f.write(f"outpoint {end:.6f}\n")
+            command = ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', str(list_file)]
+        else:
+            command = ['ffmpeg', '-i', audio_file_str]
 
+        command += [
+            '-map', '0:a:0', '-vn', '-c:a', 'copy',
+            '-movflags', 'faststart',
+            '-loglevel', 'error',
+            '-y', str(output_path)
+        ]
+        result = RunProcess(command)
 
-def GetVideoDuration(video_file):
+    if result.returncode != 0:
+        print(f"{colors.RED}FFmpeg error:{colors.ENDC}\n{result.stderr}")
+        raise RuntimeError(f"FFmpeg exited with error code {result.returncode}")
 
-    # Ffprobe to get the video duration
+    WriteMp4ReplayGainTags(output_path, tags)
+
+
+def GetVideoStreamInfo(video_file):
+
+    # Ffprobe the first video stream: codec, profile, level, pixel format and frame rate
     command = [
-        'ffprobe', '-v', 'error', '-show_entries', 'format=duration', 
-        '-of', 'default=noprint_wrappers=1:nokey=1', video_file
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'stream=codec_name,profile,level,pix_fmt,r_frame_rate', '-of', 'json', str(video_file)
     ]
-    
-    try:
-        # Run the ffprobe command to get the duration in seconds
-        duration_str = subprocess.check_output(command).decode().strip()
-        total_duration = float(duration_str)  # Convert to float (seconds)
-        return total_duration
+    streams = json.loads(RunProcess(command, check=True).stdout).get("streams") or []
+    if not streams:
+        raise RuntimeError(f"No video stream found in {video_file}")
 
-    except subprocess.CalledProcessError as e:
-        # If Ffprobe fails
-        print(f"{colors.RED}Error running ffprobe to get video duration: {e.output}{colors.ENDC}")
-        raise
+    return streams[0]
 
-    except ValueError:
-        # If duration_str can't be converted
-        print(f"{colors.RED}Error: Could not convert the duration to float: {duration_str}{colors.ENDC}")
-        raise
+
+def GetKeyframeTimes(video_file):
+
+    # Lists the timestamps of all video keyframes. Only packet headers are read, nothing is decoded.
+    command = [
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', str(video_file)
+    ]
+    keyframes = []
+    for line in RunProcess(command, check=True).stdout.splitlines():
+        parts = line.strip().split(",")
+        if len(parts) >= 2 and "K" in parts[1]:
+            try:
+                keyframes.append(float(parts[0]))
+            except ValueError:
+                continue
+
+    return sorted(keyframes)
 
 
 def LoadUrlsFromFile(file_path):
@@ -378,18 +3059,25 @@ def LoadUrlsFromFile(file_path):
             
             urls.append(s)
 
-    # Remove duplicates
+    # Remove duplicates. Different urls of the same video (youtu.be, shorts, &t=...) count as one.
     already_seen = set()
     final_list = []
     
     for u in urls:
-        if u not in already_seen:
-            already_seen.add(u)
+        key = CanonicalVideoId(u) or u
+        if key not in already_seen:
+            already_seen.add(key)
             final_list.append(u)
     return final_list
 
 
-def ConverterLibx265(library_path, title, audio_file, video_file, sponsors):
+def ConverterLibx265(library_path, title, audio_file, video_file, sponsors, info=None):
+
+    # Long videos on machines with many cores are split into chunks that are encoded side by side.
+    # Chunks need a seekable file, so streamed inputs are encoded in one go.
+    if LIBX265_CHUNK_WORKERS > 1 and not isinstance(video_file, StreamInput) \
+            and SourceDuration(info, video_file) > 2 * LIBX265_CHUNK_SECONDS:
+        return ConverterLibx265Chunked(library_path, title, audio_file, video_file, sponsors, info=info)
 
     print(f"{colors.GREEN}Encoding video using libx265...{colors.ENDC}")
 
@@ -397,22 +3085,15 @@ def ConverterLibx265(library_path, title, audio_file, video_file, sponsors):
     safe_title = "".join(x for x in title if x.isalnum() or x.isspace()).replace(" ", "_")
     output_path = Path(library_path) / f"{safe_title}.mp4"
 
-    # Convert Path objects to string objects before passing to ffmpeg
-    video_file_str = str(video_file)
-    audio_file_str = str(audio_file)
-
-    # Build sponsor filters
-    vf_core, af_core = BuildSponsorSegments(sponsors)
-
     # For debugging
     print(f"{colors.BLUE}Debug — sponsors passed in: {len(sponsors)}{colors.ENDC}")
     if sponsors:
         print(f"{colors.BLUE}Debug — first segment: {sponsors[0]['segment']}{colors.ENDC}")
 
-    if af_core:
-        audio_filter = f"{af_core},loudnorm=I=-16:TP=-1.5:LRA=11"
-    else:
-        audio_filter = "loudnorm=I=-16:TP=-1.5:LRA=11"
+    audio_filter, _ = BuildLoudnessFilter(audio_file, sponsors, info)
+
+    # Build sponsor filters
+    filter_graph, maps = BuildSponsorSegments(sponsors, audio_chain=audio_filter)
 
     if sponsors:
         print(f"{colors.CYAN}Applying SponsorSkip to {len(sponsors)} segment(s):{colors.ENDC}")
@@ -426,10 +3107,11 @@ def ConverterLibx265(library_path, title, audio_file, video_file, sponsors):
     # Initialize the ffmpeg command
     command = [
         'ffmpeg',
-        '-i', video_file_str,
-        '-i', audio_file_str,
+        *InputArgs(video_file),
+        *InputArgs(audio_file),
+        '-filter_complex', filter_graph,
+        *maps,
         '-c:v', 'libx265',
-        '-af', audio_filter,
         '-c:a', 'aac',
         '-b:a', '192k',
         '-preset', 'medium',
@@ -439,64 +3121,155 @@ def ConverterLibx265(library_path, title, audio_file, video_file, sponsors):
         '-y', str(output_path)
     ]
 
-    if vf_core:
-        # Insert video filter if it exists
-        index_cv = command.index('-c:v')
-        command[index_cv:index_cv] = ['-vf', vf_core]
+    # Expected output length: known from the extracted info, minus the sponsor cuts
+    total_duration = ExpectedDuration(info, sponsors, video_file)
+
+    # Run ffmpeg with progress reporting
+    returncode, stderr = RunFfmpeg(command, total_duration)
+
+    if returncode != 0:
+        print(f"{colors.RED}FFmpeg error:{colors.ENDC}\n{stderr}")
+    else:
+        print(f"\n{colors.GREEN}Video encoding complete. You can find the video here: {output_path}{colors.ENDC}")
+
+    if returncode != 0:
+        # Report the failure to the caller so batch summaries stay correct.
+        # The downloads are kept, so another encoder or a rerun can use them.
+        raise RuntimeError(f"FFmpeg exited with error code {returncode}")
 
-    # Get the total duration of the video file
-    total_duration = GetVideoDuration(video_file)
+    # Clean any left-over files
+    CleanUp(video_file, audio_file)
 
-    # Start ffmpeg process
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    return str(output_path)
 
-    # Initialize progress bar & formatting
-    progress_bar = tqdm(total=100, desc="Encoding Progress", ncols=100, unit='%', \
-        bar_format='{desc}: |{bar}|{percentage:3.0f}%', colour='blue', leave=False)
 
-    # Parse stderr for progress information
-    for line in process.stderr:
-        if 'frame=' in line and 'time=' in line:
+def PlanEncodeChunks(kept, keyframes, duration, chunk_seconds):
 
-            try:
-                # Extract time, split it & convert into total seconds
-                time_str = line.split('time=')[1].split(' ')[0]
-                time_parts = time_str.split(':')
-
-                if len(time_parts) == 3:  # Expected format: hh:mm:ss.xx
-                    seconds = int(time_parts[0]) * 3600 + int(time_parts[1]) * 60 + float(time_parts[2])
-
-                    # Calculate the progress percentage
-                    progress = (seconds / total_duration) * 100
-
-                    # Round to 2 decimals places
-                    progress = round(progress, 2)
-                    
-                    # Update to progress bar
-                    progress_bar.n = progress
-                    progress_bar.last_print_n = progress
-                    progress_bar.set_postfix_str(f'{progress}%')
-                    progress_bar.update(0)
-            
-            # If error in parsing time print an error message and continue
-            except ValueError:
-                print(f"{colors.RED}Error parsing time: {line}{colors.ENDC}")
-                continue
+    # Splits the kept spans into chunks of roughly chunk_seconds. Chunks start on
+    # keyframes where possible, so every encoder only decodes its own part.
+    chunks = []
+    for start, end in kept:
+        if end is None:
+            end = duration
+        end = min(end, duration)
+        if end - start < 0.05:
+            continue
 
-    # Wait for the ffmpeg process to finish
-    process.wait()
+        cursor = start
+        for k in keyframes:
+            if k - cursor >= chunk_seconds and end - k >= chunk_seconds / 2:
+                chunks.append((cursor, k))
+                cursor = k
+        chunks.append((cursor, end))
 
-    stdout, stderr = process.communicate()
-    if process.returncode != 0:
-        print(f"{colors.RED}FFmpeg error:{colors.ENDC}\n{stderr}")
+    return chunks
+
+
+def ConverterLibx265Chunked(library_path, title, audio_file, video_file, sponsors, info=None):
+
+    workers = LIBX265_CHUNK_WORKERS
+    # Split the cores between the chunks; x265 scales poorly past a handful of threads anyway
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    print(f"{colors.GREEN}Encoding video using libx265 in chunks ({workers} workers x {threads} threads)...{colors.ENDC}")
+
+    # Sanitizing title to ensure there are no special characters that could cause issues
+    safe_title = "".join(x for x in title if x.isalnum() or x.isspace()).replace(" ", "_")
+    output_path = Path(library_path) / f"{safe_title}.mp4"
+
+    # Convert Path objects to string objects before passing to ffmpeg
+    video_file_str = str(video_file)
+    audio_file_str = str(audio_file)
+
+    if sponsors:
+        print(f"{colors.CYAN}Applying SponsorSkip to {len(sponsors)} segment(s):{colors.ENDC}")
+        for sp in sponsors:
+            s, e = sp["segment"]
+            cat = sp.get("category", "unknown")
+            print(f"  - {cat}: {s:.2f}s → {e:.2f}s")
     else:
-        print(f"\n{colors.GREEN}Video encoding complete. You can find the video here: {output_path}{colors.ENDC}")
+        print(f"{colors.YELLOW}No SponsorBlock segments found; encoding full video.{colors.ENDC}")
+
+    # Sponsors are removed by simply not encoding them: chunks only cover kept spans
+    chunks = PlanEncodeChunks(KeptIntervals(sponsors), GetKeyframeTimes(video_file),
+                              SourceDuration(info, video_file), LIBX265_CHUNK_SECONDS)
+    print(f"{colors.BLUE}Encoding {len(chunks)} chunk(s).{colors.ENDC}")
+
+    with tempfile.TemporaryDirectory(dir=library_path, prefix="TEMP_chunks_") as work_dir:
+
+        def ChunkCommand(index, start, end):
+            chunk_file = Path(work_dir) / f"chunk_{index:04d}.mkv"
+            return [
+                'ffmpeg',
+                '-ss', f"{start:.6f}", '-i', video_file_str, '-t', f"{end - start:.6f}",
+                '-map', '0:v:0', '-an',
+                '-c:v', 'libx265',
+                '-preset', 'medium',
+                '-crf', '10',
+                '-threads', str(threads),
+                '-x265-params', f"pools={threads}:log-level=error",
+                '-loglevel', 'error',
+                '-y', str(chunk_file)
+            ]
+
+        # The supervisor keeps up to workers ffmpeg processes running; the encoding itself runs in those processes
+        reporter = getattr(_thread_state, "reporter", None)
+        slot = AcquireProgressSlot()
+        progress_bar = tqdm(total=round(sum(end - start for start, end in chunks), 2), desc="Encoding Progress", ncols=100, \
+            bar_format='{desc}: |{bar}|{percentage:3.0f}%', colour='blue', leave=False, position=slot)
+
+        def ChunkDone(index, result):
+            start, end = chunks[index]
+            progress_bar.update(round(end - start, 2))
+            ReportProgress("encode", progress_bar.n / progress_bar.total, reporter)
+
+        try:
+            GetProcessSupervisor().RunMany([ChunkCommand(i, start, end) for i, (start, end) in enumerate(chunks)], workers,
+                                           on_done=ChunkDone, control=CurrentJobControl())
+        except (JobCancelled, TimeoutError):
+            raise
+        except Exception as e:
+            print(f"{colors.RED}FFmpeg error:{colors.ENDC}\n{e}")
+            raise RuntimeError(f"Chunked encode failed: {e}")
+        finally:
+            progress_bar.close()
+            ReleaseProgressSlot(slot)
+
+        # Join the chunks without re-encoding and add the cut, normalized audio
+        list_file = Path(work_dir) / "chunks.txt"
+        with open(list_file, "w", encoding="utf-8") as f:
+            for i in range(len(chunks)):
+                f.write(f"file '{(Path(work_dir) / f'chunk_{i:04d}.mkv').resolve().as_posix()}'\n")
+
+        audio_filter, _ = BuildLoudnessFilter(audio_file, sponsors, info)
+        filter_graph, maps = BuildSponsorSegments(sponsors, video_input=None, audio_input="1:a", audio_chain=audio_filter)
+        command = [
+            'ffmpeg',
+            '-f', 'concat', '-safe', '0', '-i', str(list_file),
+            '-i', audio_file_str,
+            '-filter_complex', filter_graph,
+            '-map', '0:v:0', *maps,
+            '-c:v', 'copy',
+            '-tag:v', 'hvc1',
+            '-c:a', 'aac', '-b:a', '192k',
+            '-movflags', 'faststart',
+            '-loglevel', 'error',
+            '-y', str(output_path)
+        ]
+        returncode, stderr = RunFfmpeg(command, ExpectedDuration(info, sponsors, video_file), desc="Joining Progress")
+
+    if returncode != 0:
+        print(f"{colors.RED}FFmpeg error:{colors.ENDC}\n{stderr}")
+        raise RuntimeError(f"FFmpeg exited with error code {returncode}")
+
+    print(f"\n{colors.GREEN}Video encoding complete. You can find the video here: {output_path}{colors.ENDC}")
 
     # Clean any left-over files
     CleanUp(video_file, audio_file)
 
+    return str(output_path)
 
-def ConverterNvenc(library_path, title, audio_file, video_file, sponsors):
+
+def ConverterNvenc(library_path, title, audio_file, video_file, sponsors, info=None):
 
     print(f"{colors.GREEN}Encoding video using Nvenc...{colors.ENDC}")
 
@@ -504,29 +3277,18 @@ def ConverterNvenc(library_path, title, audio_file, video_file, sponsors):
     safe_title = "".join(x for x in title if x.isalnum() or x.isspace()).replace(" ", "_")
     output_path = Path(library_path) / f"{safe_title}.mp4"
 
-    # Convert path objects to string objects before passing to ffmpeg
-    video_file_str = str(video_file)
-    audio_file_str = str(audio_file)
-
-    # Build sponsor filters
-    vf_core, af_core = BuildSponsorSegments(sponsors)
-
     # For debugging
     print(f"{colors.BLUE}Debug — sponsors passed in: {len(sponsors)}{colors.ENDC}")
     if sponsors:
         print(f"{colors.BLUE}Debug — first segment: {sponsors[0]['segment']}{colors.ENDC}")
 
-    if vf_core:
-        # Safe: CPU-side select filter, then convert to NV12 and upload
-        video_filter = f"{vf_core},format=nv12,hwupload_cuda"
-    else:
-        # Safe: just upload frames to GPU
-        video_filter = "format=nv12,hwupload_cuda"
+    # Safe: cut on the CPU side, then convert to NV12 and upload frames to GPU
+    video_filter = "format=nv12,hwupload_cuda"
 
-    if af_core:
-        audio_filter = f"{af_core},loudnorm=I=-16:TP=-1.5:LRA=11"
-    else:
-        audio_filter = "loudnorm=I=-16:TP=-1.5:LRA=11"
+    audio_filter, _ = BuildLoudnessFilter(audio_file, sponsors, info)
+
+    # Build sponsor filters
+    filter_graph, maps = BuildSponsorSegments(sponsors, video_chain=video_filter, audio_chain=audio_filter)
 
     if sponsors:
         print(f"{colors.CYAN}Applying SponsorSkip to {len(sponsors)} segment(s):{colors.ENDC}")
@@ -541,9 +3303,10 @@ def ConverterNvenc(library_path, title, audio_file, video_file, sponsors):
     command = [
         'ffmpeg',
         '-hwaccel', 'cuda',
-        '-i', video_file_str,
-        '-i', audio_file_str,
-        '-vf', video_filter,
+        *InputArgs(video_file),
+        *InputArgs(audio_file),
+        '-filter_complex', filter_graph,
+        *maps,
         '-c:v', 'hevc_nvenc',
         '-profile:v', 'main10',
         '-preset', 'p5',
@@ -555,70 +3318,36 @@ def ConverterNvenc(library_path, title, audio_file, video_file, sponsors):
         '-spatial_aq', '1',
         '-temporal_aq', '1',
         '-aq-strength', '8',
-        '-af', audio_filter,
         '-c:a', 'aac', '-b:a', '320k',
         '-movflags', 'faststart',
         '-loglevel', 'info',
         '-y', str(output_path)
     ]
 
-    # Get the total duration of the video file
-    total_duration = GetVideoDuration(video_file)
-
-    # Start ffmpeg process
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-    # Initialize progress bar & formatting
-    progress_bar = tqdm(total=100, desc="Encoding Progress", ncols=100, unit='%', \
-        bar_format='{desc}: |{bar}|{percentage:3.0f}%', colour='blue', leave=False)
-
-    # Parse stderr for progress information
-    try:
-        for line in process.stderr:
-            if 'frame=' in line and 'time=' in line:
-
-                try:
-                    # Extract time, split it & convert into total seconds
-                    time_str = line.split('time=')[1].split(' ')[0]
-                    time_parts = time_str.split(':')
-
-                    if len(time_parts) == 3:  # Expected format: hh:mm:ss.xx
-                        seconds = int(time_parts[0]) * 3600 + int(time_parts[1]) * 60 + float(time_parts[2])
-
-                        # Calculate the progress percentage
-                        progress = (seconds / total_duration) * 100
-
-                        # Round to 2 decimals places
-                        progress = round(progress, 2)
-                        
-                        # Update to progress bar
-                        progress_bar.n = progress
-                        progress_bar.last_print_n = progress
-                        progress_bar.set_postfix_str(f'{progress}%')
-                        progress_bar.update(0)
-                
-                # If error in parsing time print an error message and continue
-                except ValueError:
-                    print(f"{colors.RED}Error parsing time: {line}{colors.ENDC}")
-                    continue
-    finally:
-        progress_bar.close()
+    # Expected output length: known from the extracted info, minus the sponsor cuts
+    total_duration = ExpectedDuration(info, sponsors, video_file)
 
-    # Wait for the ffmpeg process to finish
-    process.wait()
+    # Run ffmpeg with progress reporting
+    returncode, stderr = RunFfmpeg(command, total_duration)
 
-    stdout, stderr = process.communicate()
-    if process.returncode != 0:
-        print(f"{colors.RED}FFmpeg exited with error code {process.returncode}.{colors.ENDC}")
+    if returncode != 0:
+        print(f"{colors.RED}FFmpeg exited with error code {returncode}.{colors.ENDC}")
         print(f"{colors.YELLOW}Full FFmpeg stderr output:{colors.ENDC}\n{stderr}")
     else:
         print(f"\n{colors.GREEN}Video encoding complete. You can find the video here: {output_path}{colors.ENDC}")
 
+    if returncode != 0:
+        # Report the failure to the caller so batch summaries stay correct.
+        # The downloads are kept, so another encoder or a rerun can use them.
+        raise RuntimeError(f"FFmpeg exited with error code {returncode}")
+
     # Clean any left-over files
     CleanUp(video_file, audio_file)
 
+    return str(output_path)
+
 
-def ConverterVaapi(library_path, title, audio_file, video_file, sponsors):
+def ConverterVaapi(library_path, title, audio_file, video_file, sponsors, info=None):
 
     print(f"{colors.GREEN}Encoding video using Vaapi...{colors.ENDC}")
 
@@ -626,27 +3355,17 @@ def ConverterVaapi(library_path, title, audio_file, video_file, sponsors):
     safe_title = "".join(x for x in title if x.isalnum() or x.isspace()).replace(" ", "_")
     output_path = Path(library_path) / f"{safe_title}.mp4"
 
-    # Convert path objects to string objects before passing to ffmpeg
-    video_file_str = str(video_file)
-    audio_file_str = str(audio_file)
-
-    # Build sponsor filters
-    vf_core, af_core = BuildSponsorSegments(sponsors)
-
     # For debugging
     print(f"{colors.BLUE}Debug — sponsors passed in: {len(sponsors)}{colors.ENDC}")
     if sponsors:
         print(f"{colors.BLUE}Debug — first segment: {sponsors[0]['segment']}{colors.ENDC}")
 
-    if vf_core:
-        video_filter = f"{vf_core},format=nv12,hwupload"
-    else:
-        video_filter = "format=nv12,hwupload"
+    video_filter = "format=nv12,hwupload"
 
-    if af_core:
-        audio_filter = f"{af_core},loudnorm=I=-16:TP=-1.5:LRA=11"
-    else:
-        audio_filter = "loudnorm=I=-16:TP=-1.5:LRA=11"
+    audio_filter, _ = BuildLoudnessFilter(audio_file, sponsors, info)
+
+    # Build sponsor filters
+    filter_graph, maps = BuildSponsorSegments(sponsors, video_chain=video_filter, audio_chain=audio_filter)
 
     if sponsors:
         print(f"{colors.CYAN}Applying SponsorSkip to {len(sponsors)} segment(s):{colors.ENDC}")
@@ -661,16 +3380,16 @@ def ConverterVaapi(library_path, title, audio_file, video_file, sponsors):
     command = [
         'ffmpeg',
         '-vaapi_device', '/dev/dri/renderD128',
-        '-i', video_file_str,
-        '-i', audio_file_str,
-        '-vf', video_filter,
+        *InputArgs(video_file),
+        *InputArgs(audio_file),
+        '-filter_complex', filter_graph,
+        *maps,
         '-c:v', 'hevc_vaapi',
         '-profile:v', 'main',
         '-global_quality', '20',
         '-g', '150',
         '-keyint_min', '15',
         '-bf', '2',
-        '-af', audio_filter,
         '-c:a', 'aac',
         '-b:a', '192k',
         '-movflags', 'faststart',
@@ -678,62 +3397,29 @@ def ConverterVaapi(library_path, title, audio_file, video_file, sponsors):
         '-y', str(output_path)
     ]
 
-    # Get the total duration of the video file
-    total_duration = GetVideoDuration(video_file)
+    # Expected output length: known from the extracted info, minus the sponsor cuts
+    total_duration = ExpectedDuration(info, sponsors, video_file)
 
-    # Start ffmpeg process
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # Run ffmpeg with progress reporting
+    returncode, stderr = RunFfmpeg(command, total_duration)
 
-    # Initialize progress bar & formatting
-    progress_bar = tqdm(total=100, desc="Encoding Progress", ncols=100, unit='%', \
-        bar_format='{desc}: |{bar}|{percentage:3.0f}%', colour='blue', leave=False)
-
-    # Parse stderr for progress information
-    try:
-        for line in process.stderr:
-            if 'frame=' in line and 'time=' in line:
-
-                try:
-                    # Extract time, split it & convert into total seconds
-                    time_str = line.split('time=')[1].split(' ')[0]
-                    time_parts = time_str.split(':')
-
-                    if len(time_parts) == 3:  # Expected format: hh:mm:ss.xx
-                        seconds = int(time_parts[0]) * 3600 + int(time_parts[1]) * 60 + float(time_parts[2])
-
-                        # Calculate the progress percentage
-                        progress = (seconds / total_duration) * 100
-
-                        # Round to 2 decimals places
-                        progress = round(progress, 2)
-                        
-                        # Update to progress bar
-                        progress_bar.n = progress
-                        progress_bar.last_print_n = progress
-                        progress_bar.set_postfix_str(f'{progress}%')
-                        progress_bar.update(0)
-                
-                # If error in parsing time print an error message and continue
-                except ValueError:
-                    print(f"{colors.RED}Error parsing time: {line}{colors.ENDC}")
-                    continue
-    finally:
-        progress_bar.close()
-
-    # Wait for the ffmpeg process to finish
-    process.wait()
-
-    stdout, stderr = process.communicate()
-    if process.returncode != 0:
+    if returncode != 0:
         print(f"{colors.RED}FFmpeg error:{colors.ENDC}\n{stderr}")
     else:
         print(f"\n{colors.GREEN}Video encoding complete. You can find the video here: {output_path}{colors.ENDC}")
 
+    if returncode != 0:
+        # Report the failure to the caller so batch summaries stay correct.
+        # The downloads are kept, so another encoder or a rerun can use them.
+        raise RuntimeError(f"FFmpeg exited with error code {returncode}")
+
     # Clean any left-over files
     CleanUp(video_file, audio_file)
 
+    return str(output_path)
 
-def ConverterRaw(library_path, title, audio_file, video_file, sponsors):
+
+def ConverterRaw(library_path, title, audio_file, video_file, sponsors, info=None):
 
     print("Encoding video using png...")
 
@@ -741,22 +3427,15 @@ def ConverterRaw(library_path, title, audio_file, video_file, sponsors):
     safe_title = "".join(x for x in title if x.isalnum() or x.isspace()).replace(" ", "_")
     output_path = Path(library_path) / f"{safe_title}.avi"
 
-    # Convert path objects to string objects before passing to ffmpeg
-    video_file_str = str(video_file)
-    audio_file_str = str(audio_file)
-
-    # Build sponsor filters
-    vf_core, af_core = BuildSponsorSegments(sponsors)
-
     # For debugging
     print(f"{colors.BLUE}Debug — sponsors passed in: {len(sponsors)}{colors.ENDC}")
     if sponsors:
         print(f"{colors.BLUE}Debug — first segment: {sponsors[0]['segment']}{colors.ENDC}")
 
-    if af_core:
-        audio_filter = f"{af_core},loudnorm=I=-16:TP=-1.5:LRA=11"
-    else:
-        audio_filter = "loudnorm=I=-16:TP=-1.5:LRA=11"
+    audio_filter, _ = BuildLoudnessFilter(audio_file, sponsors, info)
+
+    # Build sponsor filters
+    filter_graph, maps = BuildSponsorSegments(sponsors, audio_chain=audio_filter)
 
     if sponsors:
         print(f"{colors.CYAN}Applying SponsorSkip to {len(sponsors)} segment(s):{colors.ENDC}")
@@ -770,10 +3449,11 @@ def ConverterRaw(library_path, title, audio_file, video_file, sponsors):
     # Initialize the ffmpeg command
     command = [
         'ffmpeg',
-        '-i', video_file_str,
-        '-i', audio_file_str,
+        *InputArgs(video_file),
+        *InputArgs(audio_file),
+        '-filter_complex', filter_graph,
+        *maps,
         '-c:v', 'png',
-        '-af', audio_filter,
         '-c:a', 'aac',
         '-b:a', '192k',
         '-preset', 'veryslow',
@@ -783,67 +3463,29 @@ def ConverterRaw(library_path, title, audio_file, video_file, sponsors):
         '-y', str(output_path)
     ]
 
-    if vf_core:
-        # Insert video filter if it exists
-        index_cv = command.index('-c:v')
-        command[index_cv:index_cv] = ['-vf', vf_core]
-
-    # Get the total duration of the video file
-    total_duration = GetVideoDuration(video_file)
-
-    # Start ffmpeg process
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-    # Initialize progress bar & formatting
-    progress_bar = tqdm(total=100, desc="Encoding Progress", ncols=100, unit='%', \
-        bar_format='{desc}: |{bar}|{percentage:3.0f}%', colour='blue', leave=False)
-
-    # Parse stderr for progress information
-    try:
-        for line in process.stderr:
-            if 'frame=' in line and 'time=' in line:
-
-                try:
-                    # Extract time, split it & convert into total seconds
-                    time_str = line.split('time=')[1].split(' ')[0]
-                    time_parts = time_str.split(':')
-
-                    if len(time_parts) == 3:  # Expected format: hh:mm:ss.xx
-                        seconds = int(time_parts[0]) * 3600 + int(time_parts[1]) * 60 + float(time_parts[2])
-
-                        # Calculate the progress percentage
-                        progress = (seconds / total_duration) * 100
-
-                        # Round to 2 decimals places
-                        progress = round(progress, 2)
-                        
-                        # Update to progress bar
-                        progress_bar.n = progress
-                        progress_bar.last_print_n = progress
-                        progress_bar.set_postfix_str(f'{progress}%')
-                        progress_bar.update(0)
-                
-                # If error in parsing time print an error message and continue
-                except ValueError:
-                    print(f"{colors.RED}Error parsing time: {line}{colors.ENDC}")
-                    continue
-    finally:
-        progress_bar.close()
+    # Expected output length: known from the extracted info, minus the sponsor cuts
+    total_duration = ExpectedDuration(info, sponsors, video_file)
 
-    # Wait for the ffmpeg process to finish
-    process.wait()
+    # Run ffmpeg with progress reporting
+    returncode, stderr = RunFfmpeg(command, total_duration)
 
-    stdout, stderr = process.communicate()
-    if process.returncode != 0:
+    if returncode != 0:
         print(f"{colors.RED}FFmpeg error:{colors.ENDC}\n{stderr}")
     else:
         print(f"\n{colors.GREEN}Video encoding complete. You can find the video here: {output_path}{colors.ENDC}")
 
+    if returncode != 0:
+        # Report the failure to the caller so batch summaries stay correct.
+        # The downloads are kept, so another encoder or a rerun can use them.
+        raise RuntimeError(f"FFmpeg exited with error code {returncode}")
+
     # Clean any left-over files
     CleanUp(video_file, audio_file)
 
+    return str(output_path)
+
 
-def ConverterAudioOnly(library_path, title, audio_file, sponsors, audio_format=None):
+def ConverterAudioOnly(library_path, title, audio_file, sponsors, audio_format=None, info=None):
 
     print("Creating a audio-only file...")
 
@@ -857,21 +3499,43 @@ def ConverterAudioOnly(library_path, title, audio_file, sponsors, audio_format=N
 
     output_path = Path(library_path) / f"{safe_title}.{extension}"
 
-    # Convert path objects to string objects before passing to ffmpeg
-    audio_file_str = str(audio_file)
-
-    # Build sponsor filters
-    _, af_core = BuildSponsorSegments(sponsors)
-
     # For debugging
     print(f"{colors.BLUE}Debug — sponsors passed in: {len(sponsors)}{colors.ENDC}")
     if sponsors:
         print(f"{colors.BLUE}Debug — first segment: {sponsors[0]['segment']}{colors.ENDC}")
 
-    if af_core:
-        audio_filter = f"{af_core},loudnorm=I=-16:TP=-1.5:LRA=11"
-    else:
-        audio_filter = "loudnorm=I=-16:TP=-1.5:LRA=11"
+    # Skip encoding entirely when the downloaded stream already is in the requested codec
+    try:
+        source_codec = None if isinstance(audio_file, StreamInput) else GetAudioCodec(audio_file)
+    except (JobCancelled, TimeoutError):
+        raise
+    except Exception:
+        source_codec = None
+
+    # In "gain" mode the copy is only good enough when the loudness is already close to the target.
+    # The measurement is cached, so a transcode afterwards doesn't repeat it.
+    measured = None
+    if AUDIO_PASSTHROUGH and LOUDNESS_MODE == "gain" and source_codec and AUDIO_CODEC_NAMES.get(codec) == source_codec:
+        try:
+            measured = MeasureLoudness(audio_file, sponsors, (info or {}).get("id"))
+        except (JobCancelled, TimeoutError):
+            raise
+        except Exception:
+            measured = None
+    plan = PlanAudioOnly(source_codec, codec, sponsors, measured)
+
+    if plan != "transcode":
+        print(f"{colors.CYAN}Source is already {source_codec}; {'cutting sponsors without' if plan == 'cut-copy' else 'remuxing without'} re-encoding.{colors.ENDC}")
+        AudioPassthrough(audio_file, output_path, sponsors, info)
+        CleanUp(audio_file=audio_file)
+        print(f"\n{colors.GREEN}Audio file ready. You can find it from here: {output_path}{colors.ENDC}")
+        return str(output_path)
+
+    # Audio-only files can carry ReplayGain tags instead of having their samples rewritten
+    audio_filter, loudness_tags = BuildLoudnessFilter(audio_file, sponsors, info, allow_tags=True)
+
+    # Build sponsor filters
+    filter_graph, maps = BuildSponsorSegments(sponsors, video_input=None, audio_input="0:a", audio_chain=audio_filter)
 
     if sponsors:
         print(f"{colors.CYAN}Applying SponsorSkip to {len(sponsors)} segment(s):{colors.ENDC}")
@@ -885,74 +3549,258 @@ def ConverterAudioOnly(library_path, title, audio_file, sponsors, audio_format=N
     # Initialize the ffmpeg command
     command = [
         'ffmpeg',
-        '-i', audio_file_str,
+        *InputArgs(audio_file),
         '-vn',
-        '-af', audio_filter,
+        '-filter_complex', filter_graph,
+        *maps,
         '-c:a', codec,
     ]
 
     # Bitrate for lossy codecs, skip for flac
     if codec.lower() != 'flac':
         command += ['-b:a', '192k']
+    # mp3 and flac take the ReplayGain tags from ffmpeg; m4a gets them afterwards
+    if extension != 'm4a':
+        for tag, value in loudness_tags.items():
+            command += ['-metadata', f"{tag}={value}"]
     command += [
         '-movflags', 'faststart',
         '-loglevel', 'info',
         '-y', str(output_path)
     ]
 
-    # Get the total duration of the audio file
-    total_duration = GetVideoDuration(audio_file)
+    # Expected output length: known from the extracted info, minus the sponsor cuts
+    total_duration = ExpectedDuration(info, sponsors, audio_file)
+
+    # Run ffmpeg with progress reporting
+    returncode, stderr = RunFfmpeg(command, total_duration)
+
+    if returncode != 0:
+        print(f"{colors.RED}FFmpeg error:{colors.ENDC}\n{stderr}")
+    else:
+        print(f"\n{colors.GREEN}Audio file ready. You can find it from here: {output_path}{colors.ENDC}")
+
+    if returncode != 0:
+        # Report the failure to the caller so batch summaries stay correct.
+        # The download is kept, so a rerun can use it.
+        raise RuntimeError(f"FFmpeg exited with error code {returncode}")
+
+    if extension == 'm4a':
+        WriteMp4ReplayGainTags(output_path, loudness_tags)
+
+    # Clean any left-over files
+    CleanUp(audio_file=audio_file)
+
+    return str(output_path)
+
+
+# Encoders used to re-encode the few frames around a smart cut, per source codec.
+# Intermediate pieces are stored in a container that keeps codec headers in-band.
+SMART_CUT_ENCODERS = {
+    "h264": (['-c:v', 'libx264', '-preset', 'medium', '-crf', '16'], 'h264_mp4toannexb', 'ts'),
+    "hevc": (['-c:v', 'libx265', '-preset', 'medium', '-crf', '16'], 'hevc_mp4toannexb', 'ts'),
+    "av1": (['-c:v', 'libsvtav1', '-preset', '8', '-crf', '20'], None, 'mkv'),
+    "vp9": (['-c:v', 'libvpx-vp9', '-crf', '20', '-b:v', '0', '-row-mt', '1'], None, 'mkv'),
+}
 
-    # Start ffmpeg process
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+# Profiles as ffprobe names them, mapped to the encoder's -profile:v value ("" when the
+# encoder only produces that one). Other profiles can't be matched. The re-encoded
+# pieces have to carry the same profile and level as the copied ones, or the joined stream
+# changes its parameter sets midway, which many players reject.
+SMART_CUT_PROFILES = {
+    "h264": {"Constrained Baseline": "baseline", "Baseline": "baseline", "Main": "main", "High": "high",
+             "High 10": "high10", "High 4:2:2": "high422", "High 4:4:4 Predictive": "high444"},
+    "hevc": {"Main": "main", "Main 10": "main10"},
+    "av1": {"Main": ""},
+    "vp9": {"Profile 0": "0", "Profile 1": "1", "Profile 2": "2", "Profile 3": "3"},
+}
 
-    # Initialize progress bar & formatting
-    progress_bar = tqdm(total=100, desc="Encoding Progress", ncols=100, unit='%', \
-        bar_format='{desc}: |{bar}|{percentage:3.0f}%', colour='blue', leave=False)
 
-    # Parse stderr for progress information
+def SmartCutStreamArgs(codec, stream):
+
+    # Encoder arguments that reproduce the source's profile and level, or None when
+    # the source uses one the encoder can't match
+    encoder_profile = SMART_CUT_PROFILES[codec].get(stream.get("profile"))
+    if encoder_profile is None:
+        return None
+
+    args = ['-pix_fmt', stream.get("pix_fmt", "yuv420p")]
+    if encoder_profile:
+        args += ['-profile:v', encoder_profile]
+
+    level = stream.get("level") or 0
+    if codec == "h264" and level > 0:
+        args += ['-level:v', f"{level / 10:.1f}"]
+    elif codec == "hevc" and level > 0:
+        # ffprobe reports general_level_idc, which is 30 times the level
+        args += ['-x265-params', f"level-idc={level / 30:.1f}:log-level=error"]
+
+    return args
+
+
+def SmartCutPieceMatches(stream, piece_file):
+
+    # Compares what the encoder actually produced with the source. A piece that can't be probed doesn't match.
     try:
-        for line in process.stderr:
-            if 'time=' in line:
+        piece = GetVideoStreamInfo(piece_file)
+    except (JobCancelled, TimeoutError):
+        raise
+    except Exception:
+        return False
+    keys = ["codec_name", "profile", "pix_fmt"] + (["level"] if (stream.get("level") or 0) > 0 else [])
+    return all(piece.get(key) == stream.get(key) for key in keys)
 
-                try:
-                    # Extract time, split it & convert into total seconds
-                    time_str = line.split('time=')[1].split(' ')[0]
-                    time_parts = time_str.split(':')
-
-                    if len(time_parts) == 3:  # Expected format: hh:mm:ss.xx
-                        seconds = int(time_parts[0]) * 3600 + int(time_parts[1]) * 60 + float(time_parts[2])
-
-                        # Calculate the progress percentage
-                        progress = (seconds / total_duration) * 100
-
-                        # Round to 2 decimals places
-                        progress = round(progress, 2)
-                        
-                        # Update to progress bar
-                        progress_bar.n = progress
-                        progress_bar.last_print_n = progress
-                        progress_bar.set_postfix_str(f'{progress}%')
-                        progress_bar.update(0)
-                
-                # If error in parsing time print an error message and continue
-                except ValueError:
-                    print(f"{colors.RED}Error parsing time: {line}{colors.ENDC}")
-                    continue
-    finally:
-        progress_bar.close()
 
-    # Wait for the ffmpeg process to finish
-    process.wait()
+def PlanSmartCut(kept, keyframes, duration, min_piece=0.05):
+
+    # Splits every kept span into pieces that can be stream copied (keyframe to keyframe)
+    # and the partial GOPs at the edges that have to be re-encoded
+    pieces = []
+    for start, end in kept:
+        if end is None:
+            end = duration
+        if end - start < min_piece:
+            continue
+
+        inner = [k for k in keyframes if start <= k <= end]
+        if len(inner) < 2:
+            # No full GOP inside this span, so the whole span is re-encoded
+            pieces.append((start, end, "encode"))
+            continue
+
+        first, last = inner[0], inner[-1]
+        if first - start >= min_piece:
+            pieces.append((start, first, "encode"))
+        pieces.append((first, last, "copy"))
+        if end - last >= min_piece:
+            pieces.append((last, end, "encode"))
+
+    return pieces
+
+
+def ConverterSmartCut(library_path, title, audio_file, video_file, sponsors, info=None):
+
+    print(f"{colors.GREEN}Creating the video with smart cut...{colors.ENDC}")
+
+    # Sanitizing title to ensure there are no special characters that could cause issues
+    safe_title = "".join(x for x in title if x.isalnum() or x.isspace()).replace(" ", "_")
+    output_path = Path(library_path) / f"{safe_title}.mp4"
+
+    # Convert path objects to string objects before passing to ffmpeg
+    video_file_str = str(video_file)
+    audio_file_str = str(audio_file)
+
+    # Nothing to cut: a pure remux of both streams
+    if not sponsors:
+        print(f"{colors.YELLOW}No SponsorBlock segments found; remuxing without re-encoding.{colors.ENDC}")
+        command = [
+            'ffmpeg',
+            '-i', video_file_str,
+            '-i', audio_file_str,
+            '-map', '0:v:0', '-map', '1:a:0',
+            '-c', 'copy',
+            '-movflags', 'faststart',
+            '-loglevel', 'error',
+            '-y', str(output_path)
+        ]
+        returncode, stderr = RunFfmpeg(command, SourceDuration(info, video_file), desc="Remux Progress")
+        if returncode != 0:
+            print(f"{colors.RED}FFmpeg error:{colors.ENDC}\n{stderr}")
+            raise RuntimeError(f"FFmpeg exited with error code {returncode}")
+        CleanUp(video_file, audio_file)
+        print(f"\n{colors.GREEN}Remux complete. You can find the video here: {output_path}{colors.ENDC}")
+        return str(output_path)
+
+    print(f"{colors.CYAN}Applying SponsorSkip to {len(sponsors)} segment(s):{colors.ENDC}")
+    for sp in sponsors:
+        s, e = sp["segment"]
+        cat = sp.get("category", "unknown")
+        print(f"  - {cat}: {s:.2f}s → {e:.2f}s")
+
+    stream = GetVideoStreamInfo(video_file)
+    codec = stream.get("codec_name")
+    if codec not in SMART_CUT_ENCODERS:
+        print(f"{colors.YELLOW}Smart cut doesn't support {codec} sources; encoding with libx265 instead.{colors.ENDC}")
+        return ConverterLibx265(library_path, title, audio_file, video_file, sponsors, info=info)
 
-    stdout, stderr = process.communicate()
-    if process.returncode != 0:
+    encoder_args, bitstream_filter, container = SMART_CUT_ENCODERS[codec]
+    try:
+        available = ProbeEncoders()["encoders"]
+    except (JobCancelled, TimeoutError):
+        raise
+    except Exception:
+        available = []
+    if encoder_args[1] not in available:
+        print(f"{colors.YELLOW}{encoder_args[1]} isn't available to re-encode the {codec} cut points; encoding with libx265 instead.{colors.ENDC}")
+        return ConverterLibx265(library_path, title, audio_file, video_file, sponsors, info=info)
+
+    stream_args = SmartCutStreamArgs(codec, stream)
+    if stream_args is None:
+        print(f"{colors.YELLOW}Can't match the {codec} source's profile ({stream.get('profile')}) at the cut points; encoding with libx265 instead.{colors.ENDC}")
+        return ConverterLibx265(library_path, title, audio_file, video_file, sponsors, info=info)
+
+    pieces = PlanSmartCut(KeptIntervals(sponsors), GetKeyframeTimes(video_file), SourceDuration(info, video_file))
+    encoded = sum(end - start for start, end, how in pieces if how == "encode")
+    copied = sum(end - start for start, end, how in pieces if how == "copy")
+    print(f"{colors.BLUE}Stream copying {copied:.1f}s, re-encoding {encoded:.1f}s around {len(pieces)} piece(s).{colors.ENDC}")
+
+    with tempfile.TemporaryDirectory(dir=library_path, prefix="TEMP_smartcut_") as work_dir:
+        piece_files = []
+        for i, (start, end, how) in enumerate(pieces):
+            piece_file = Path(work_dir) / f"piece_{i:04d}.{container}"
+            command = ['ffmpeg', '-ss', f"{start:.6f}", '-i', video_file_str, '-t', f"{end - start:.6f}", '-map', '0:v:0', '-an']
+            if how == "copy":
+                command += ['-c:v', 'copy']
+            else:
+                # Match the source so the pieces can be joined without re-encoding
+                command += encoder_args + stream_args + ['-fps_mode', 'passthrough']
+            if bitstream_filter:
+                command += ['-bsf:v', bitstream_filter]
+            command += ['-avoid_negative_ts', 'make_zero', '-loglevel', 'error', '-y', str(piece_file)]
+
+            result = RunProcess(command)
+            if result.returncode != 0:
+                print(f"{colors.RED}FFmpeg error:{colors.ENDC}\n{result.stderr}")
+                raise RuntimeError(f"FFmpeg exited with error code {result.returncode}")
+
+            # The first re-encoded piece shows whether the encoder really matched the source
+            if how == "encode" and not any(p_how == "encode" for _, _, p_how in pieces[:i]) and not SmartCutPieceMatches(stream, piece_file):
+                print(f"{colors.YELLOW}Re-encoded cut points don't match the source's stream parameters; encoding with libx265 instead.{colors.ENDC}")
+                return ConverterLibx265(library_path, title, audio_file, video_file, sponsors, info=info)
+            piece_files.append(piece_file)
+
+        # List of pieces for the concat demuxer
+        list_file = Path(work_dir) / "pieces.txt"
+        with open(list_file, "w", encoding="utf-8") as f:
+            for piece_file in piece_files:
+                f.write(f"file '{piece_file.as_posix()}'\n")
+
+        # Audio is cheap, so it goes through the regular cut graph and loudnorm
+        audio_filter, _ = BuildLoudnessFilter(audio_file, sponsors, info)
+        filter_graph, maps = BuildSponsorSegments(sponsors, video_input=None, audio_input="1:a", audio_chain=audio_filter)
+        command = [
+            'ffmpeg',
+            '-f', 'concat', '-safe', '0', '-i', str(list_file),
+            '-i', audio_file_str,
+            '-filter_complex', filter_graph,
+            '-map', '0:v:0', *maps,
+            '-c:v', 'copy',
+            '-c:a', 'aac', '-b:a', '192k',
+            '-movflags', 'faststart',
+            '-loglevel', 'error',
+            '-y', str(output_path)
+        ]
+        returncode, stderr = RunFfmpeg(command, ExpectedDuration(info, sponsors, video_file), desc="Joining Progress")
+
+    if returncode != 0:
         print(f"{colors.RED}FFmpeg error:{colors.ENDC}\n{stderr}")
-    else:
-        print(f"\n{colors.GREEN}Audio file ready. You can find it from here: {output_path}{colors.ENDC}")
+        raise RuntimeError(f"FFmpeg exited with error code {returncode}")
 
     # Clean any left-over files
-    CleanUp(audio_file=audio_file)
+    CleanUp(video_file, audio_file)
+
+    print(f"\n{colors.GREEN}Smart cut complete. You can find the video here: {output_path}{colors.ENDC}")
+    return str(output_path)
 
 
 def CleanUp(video_file=None, audio_file=None):
@@ -969,12 +3817,18 @@ if __name__ == '__main__':
 
     multiprocessing.freeze_support()
 
-    # Prevent the interactive CLI from launching
+    # Arguments make a scripted run; the interactive prompts are only used without them
+    if len(sys.argv) > 1:
+        sys.exit(RunCli(sys.argv[1:]))
+
+    # The prompts need a terminal. Say so instead of exiting silently.
     try:
-        if not sys.stdin or not sys.stdin.isatty():
-            sys.exit(0)
+        interactive = bool(sys.stdin) and sys.stdin.isatty()
     except Exception:
-        sys.exit(0)
+        interactive = False
+    if not interactive:
+        print("No terminal for the interactive prompts. Pass urls or --file/--spec instead (see --help).", file=sys.stderr)
+        sys.exit(2)
 
     try:
         Main()
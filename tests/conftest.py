@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import Downloader
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache(tmp_path, monkeypatch):
+    # Every test gets its own cache directory and library index
+    monkeypatch.setattr(Downloader, "CACHE_DIR", tmp_path / "cache")
+    monkeypatch.setattr(Downloader, "LIBRARY_INDEX", tmp_path / "cache" / "library.sqlite3")
+    monkeypatch.setattr(Downloader, "_library_db", None)
+    yield tmp_path / "cache"
+    if Downloader._library_db is not None:
+        Downloader._library_db.close()
+
+
+class RangeServer:
+
+    # Local http server for one blob. Honors Range unless ignore_range is set, or only for the
+    # first ignore_range_after requests; short_reads makes the first responses stop early,
+    # like a dropped connection.
+    def __init__(self, blob):
+        self.blob = blob
+        self.ignore_range = False
+        self.ignore_range_after = None
+        self.short_reads = 0
+        self.requests = []
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.Serve(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/blob"
+
+    def Serve(self, request):
+        header = request.headers.get("Range")
+        with self.lock:
+            self.requests.append(header)
+            short = self.short_reads > 0
+            self.short_reads -= short
+            ignore = self.ignore_range or (self.ignore_range_after is not None and len(self.requests) > self.ignore_range_after)
+
+        match = re.match(r"bytes=(\d+)-(\d*)", header or "")
+        if match and not ignore:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), len(self.blob) - 1) if match.group(2) else len(self.blob) - 1
+            request.send_response(206)
+            request.send_header("Content-Range", f"bytes {start}-{end}/{len(self.blob)}")
+        else:
+            start, end = 0, len(self.blob) - 1
+            request.send_response(200)
+        body = self.blob[start:end + 1]
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body[:len(body) // 2] if short else body)
+
+    def Close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def range_server():
+    server = RangeServer(os.urandom(1024 * 1024 + 123))
+    yield server
+    server.Close()
+
+
+class SponsorBlockStub:
+
+    # Answers /api/skipSegments by id and by hash prefix from segments (video id -> list of
+    # segment items). With fail set every request gets a 500.
+    def __init__(self):
+        self.segments = {}
+        self.fail = False
+        self.requests = []
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.Serve(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def Serve(self, request):
+        url = urlparse(request.path)
+        self.requests.append(url.path)
+        if self.fail:
+            body, status = [], 500
+        elif url.path.startswith("/api/skipSegments/"):
+            prefix = url.path.rsplit("/", 1)[1]
+            body = [{"videoID": video_id, "segments": items} for video_id, items in self.segments.items()
+                    if hashlib.sha256(video_id.encode("utf-8")).hexdigest().startswith(prefix)]
+            status = 200 if body else 404
+        else:
+            body = self.segments.get(parse_qs(url.query).get("videoID", [""])[0], [])
+            status = 200 if body else 404
+
+        data = json.dumps(body).encode("utf-8")
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def Close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def sponsorblock(monkeypatch):
+    stub = SponsorBlockStub()
+    monkeypatch.setattr(Downloader, "SPONSORBLOCK_API", stub.url)
+    yield stub
+    stub.Close()
@@ -0,0 +1,42 @@
+import shutil
+import subprocess
+
+import pytest
+
+import Downloader
+
+
+LOUD = {"integrated": -9.0, "true_peak": -0.5, "range": 4.0}
+ON_TARGET = {"integrated": -16.4, "true_peak": -3.0, "range": 4.0}
+
+
+@pytest.mark.parametrize("mode, measured, sponsors, plan", [
+    ("gain", None, [], "transcode"),
+    ("gain", LOUD, [], "transcode"),
+    ("gain", ON_TARGET, [], "copy"),
+    ("gain", ON_TARGET, [{"segment": [1.0, 2.0]}], "cut-copy"),
+    ("tags", None, [], "copy"),
+    ("tags", LOUD, [], "copy"),
+    ("dynamic", ON_TARGET, [], "transcode"),
+])
+def test_passthrough_only_when_loudness_needs_no_change(monkeypatch, mode, measured, sponsors, plan):
+    monkeypatch.setattr(Downloader, "LOUDNESS_MODE", mode)
+    assert Downloader.PlanAudioOnly("aac", "aac", sponsors, measured) == plan
+
+
+def test_passthrough_needs_the_requested_codec(monkeypatch):
+    monkeypatch.setattr(Downloader, "LOUDNESS_MODE", "tags")
+    assert Downloader.PlanAudioOnly("opus", "aac", [], ON_TARGET) == "transcode"
+
+
+@pytest.mark.skipif(not shutil.which("ffmpeg"), reason="needs ffmpeg")
+def test_replaygain_goes_into_itunes_freeform_atoms(tmp_path):
+    mutagen_mp4 = pytest.importorskip("mutagen.mp4")
+    output = tmp_path / "tone.m4a"
+    subprocess.run(["ffmpeg", "-f", "lavfi", "-i", "sine=duration=1", "-c:a", "aac", "-loglevel", "error", "-y", str(output)], check=True)
+
+    Downloader.WriteMp4ReplayGainTags(output, Downloader.ReplayGainTags(LOUD))
+
+    tags = mutagen_mp4.MP4(str(output)).tags
+    assert bytes(tags["----:com.apple.iTunes:REPLAYGAIN_TRACK_GAIN"][0]) == b"-9.00 dB"
+    assert "----:com.apple.iTunes:REPLAYGAIN_TRACK_PEAK" in tags
@@ -0,0 +1,22 @@
+import Benchmark
+
+
+BASE = {"case": {"wall_s": 10.0, "peak_rss_kb": 100000, "fps": 60.0, "output_bytes": 1000000}}
+
+
+def Compare(**changes):
+    return Benchmark.CompareWithBaseline({"case": dict(BASE["case"], **changes)}, BASE, 0.15)
+
+
+def test_unchanged_case_passes():
+    assert Compare() == []
+
+
+def test_lower_fps_is_a_regression():
+    assert [line.split(":")[1].split()[0] for line in Compare(fps=40.0)] == ["fps"]
+    assert Compare(fps=90.0) == []
+
+
+def test_bigger_output_is_a_regression():
+    assert [line.split(":")[1].split()[0] for line in Compare(output_bytes=1300000)] == ["output_bytes"]
+    assert Compare(output_bytes=500000) == []
@@ -0,0 +1,32 @@
+import os
+import time
+
+import Downloader
+
+
+def WriteAged(key, value, age):
+    Downloader.WriteCache("info", key, value)
+    stamp = time.time() - age
+    os.utime(Downloader.CachePath("info", key), (stamp, stamp))
+
+
+def test_prune_drops_least_recently_used_entries_over_the_size_limit():
+    for i, key in enumerate(["old", "middle", "new"]):
+        WriteAged(key, {"blob": "x" * 1000}, age=300 - 100 * i)
+    size = Downloader.CachePath("info", "new").stat().st_size
+
+    Downloader.PruneCache("info", max_bytes=2 * size, every=1)
+
+    assert Downloader.ReadCache("info", "old") is None
+    assert Downloader.ReadCache("info", "middle") is not None
+    assert Downloader.ReadCache("info", "new") is not None
+
+
+def test_prune_drops_entries_unused_for_max_age():
+    WriteAged("stale", {"id": "stale"}, age=8 * 24 * 3600)
+    WriteAged("recent", {"id": "recent"}, age=3600)
+
+    Downloader.PruneCache("info", every=1, max_age=Downloader.INFO_CACHE_MAX_AGE)
+
+    assert Downloader.ReadCache("info", "stale") is None
+    assert Downloader.ReadCache("info", "recent") == {"id": "recent"}
@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+import Downloader
+
+
+def RunWithSpec(tmp_path, spec, *extra):
+    spec_file = tmp_path / "spec.json"
+    spec_file.write_text(json.dumps(spec), encoding="utf-8")
+    return Downloader.RunCli(["--spec", str(spec_file), "--dry-run", *extra])
+
+
+@pytest.mark.parametrize("spec", [
+    ["https://youtu.be/aaaaaaaaaaa"],
+    "https://youtu.be/aaaaaaaaaaa",
+    {"jobs": "https://youtu.be/aaaaaaaaaaa"},
+    {"jobs": [42]},
+    {"jobs": [["https://youtu.be/aaaaaaaaaaa"]]},
+    {"jobs": [{"mode": "audio"}]},
+    {"jobs": [{"url": 42}]},
+    {"files": "urls.txt"},
+    {"files": [1]},
+    {"encoder": ["auto"], "jobs": ["https://youtu.be/aaaaaaaaaaa"]},
+])
+def test_malformed_spec_is_a_usage_error(tmp_path, capsys, spec):
+    assert RunWithSpec(tmp_path, spec) == 2
+    assert "Traceback" not in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("settings", [
+    {"connections": 0},
+    {"connections": -3},
+    {"connections": 2.5},
+    {"connections": "many"},
+    {"connections": True},
+    {"weight": 0},
+    {"weight": -1.5},
+    {"weight": "heavy"},
+    {"weight": None, "connections": [4]},
+])
+def test_spec_numbers_must_be_positive(tmp_path, settings):
+    assert RunWithSpec(tmp_path, {"jobs": ["https://youtu.be/aaaaaaaaaaa"], **settings}) == 2
+    assert RunWithSpec(tmp_path, {"jobs": [{"url": "https://youtu.be/aaaaaaaaaaa", **settings}]}) == 2
+
+
+def test_spec_numbers_are_normalized(tmp_path):
+    spec_file = tmp_path / "spec.json"
+    spec_file.write_text(json.dumps({"connections": "4", "jobs": [{"url": "https://youtu.be/aaaaaaaaaaa", "weight": 2}]}), encoding="utf-8")
+    jobs = Downloader.BuildCliJobs(Downloader.ParseArguments(["--spec", str(spec_file)]))
+    assert jobs[0]["connections"] == 4
+    assert jobs[0]["weight"] == 2.0
+
+
+@pytest.mark.parametrize("argv", [
+    ["--connections", "0"],
+    ["--connections", "two"],
+    ["--weight", "0"],
+    ["--weight", "-1"],
+    ["--weight", "nan"],
+])
+def test_command_line_numbers_must_be_positive(argv):
+    with pytest.raises(SystemExit) as exit_info:
+        Downloader.RunCli(["https://youtu.be/aaaaaaaaaaa", *argv])
+    assert exit_info.value.code == 2
+
+
+def test_missing_spec_file_is_a_usage_error(tmp_path):
+    assert Downloader.RunCli(["--spec", str(tmp_path / "missing.json")]) == 2
+
+
+def test_invalid_json_is_a_usage_error(tmp_path):
+    spec_file = tmp_path / "spec.json"
+    spec_file.write_text("{not json", encoding="utf-8")
+    assert Downloader.RunCli(["--spec", str(spec_file)]) == 2
+
+
+def test_same_video_from_several_sources_runs_once(tmp_path, monkeypatch, capsys):
+    first = tmp_path / "first.txt"
+    first.write_text("https://www.youtube.com/watch?v=aaaaaaaaaaa\nhttps://www.youtube.com/watch?v=bbbbbbbbbbb\n", encoding="utf-8")
+    second = tmp_path / "second.txt"
+    second.write_text("https://youtu.be/aaaaaaaaaaa\n", encoding="utf-8")
+
+    assert Downloader.RunCli(["https://youtube.com/watch?v=aaaaaaaaaaa", "--file", str(first), "--file", str(second), "--dry-run"]) == 0
+    listed = [line for line in capsys.readouterr().out.splitlines() if line.startswith("  ")]
+    assert len(listed) == 2
+
+    batches = []
+    monkeypatch.setattr(Downloader, "RunBatchPipeline", lambda urls, mode, **kwargs: batches.append(list(urls)) or (len(urls), 0))
+    assert Downloader.RunCli(["https://youtube.com/watch?v=aaaaaaaaaaa", "--file", str(first), "--file", str(second)]) == 0
+    assert batches == [["https://youtube.com/watch?v=aaaaaaaaaaa", "https://www.youtube.com/watch?v=bbbbbbbbbbb"]]
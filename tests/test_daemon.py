@@ -0,0 +1,25 @@
+import threading
+
+import pytest
+
+import Daemon
+
+
+@pytest.fixture
+def job_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(Daemon, "_running", {})
+    monkeypatch.setattr(Daemon, "_running_videos", {})
+    Daemon.OpenJobDb(tmp_path / "jobs.sqlite3")
+    yield
+    Daemon._db.close()
+
+
+def test_jobs_of_one_video_do_not_run_at_the_same_time(job_db):
+    first = Daemon.SubmitJob({"url": "https://www.youtube.com/watch?v=aaaaaaaaaaa"})
+    Daemon.SubmitJob({"url": "https://youtu.be/aaaaaaaaaaa", "mode": "audio"})
+    other = Daemon.SubmitJob({"url": "https://www.youtube.com/watch?v=bbbbbbbbbbb"})
+
+    stop = threading.Event()
+    assert Daemon.ClaimJob(stop)["id"] == first
+    assert Daemon.ClaimJob(stop)["id"] == other
+    assert Daemon.CountJobs() == {"running": 2, "queued": 1}
@@ -0,0 +1,51 @@
+import Downloader
+
+
+def Capabilities():
+    return {"key": "test", "encoders": ["hevc_nvenc", "libx265"], "hwaccels": ["cuda"], "calibration": {}}
+
+
+def FakeCalibration(monkeypatch, results):
+    # results: encoder profile name -> fps of its calibration encode, None when it fails
+    calls = []
+
+    def RunFfmpeg(command, duration, desc=None):
+        name = desc.split()[-1]
+        calls.append(name)
+        Downloader._ffmpeg_stats.last = {"fps": results[name]}
+        return (0 if results[name] else 1), ""
+
+    monkeypatch.setattr(Downloader, "RunFfmpeg", RunFfmpeg)
+    return calls
+
+
+def test_failed_calibration_is_retried_after_a_while(monkeypatch):
+    capabilities = Capabilities()
+    calls = FakeCalibration(monkeypatch, {"nvenc": None, "libx265": 40.0})
+    assert Downloader.CalibrateEncoders(capabilities) == {"nvenc": None, "vaapi": None, "libx265": 40.0}
+
+    calls.clear()
+    Downloader.CalibrateEncoders(capabilities)
+    assert calls == []
+
+    capabilities["failures"]["nvenc"] -= Downloader.ENCODER_RETRY_AFTER + 1
+    FakeCalibration(monkeypatch, {"nvenc": 300.0, "libx265": 40.0})
+    assert Downloader.CalibrateEncoders(capabilities)["nvenc"] == 300.0
+    assert "nvenc" not in capabilities["failures"]
+
+
+def test_encoder_failing_a_real_job_is_demoted(monkeypatch):
+    capabilities = Capabilities()
+    capabilities["calibration"] = {"nvenc": 300.0, "vaapi": None, "libx265": 40.0}
+    monkeypatch.setattr(Downloader, "ProbeEncoders", lambda: capabilities)
+
+    def BrokenNvenc(*args, **kwargs):
+        raise RuntimeError("FFmpeg exited with error code 1")
+
+    monkeypatch.setattr(Downloader, "ConverterNvenc", BrokenNvenc)
+    monkeypatch.setattr(Downloader, "ConverterLibx265", lambda *args, **kwargs: "out.mp4")
+
+    assert Downloader.ConverterAuto("lib", "title", "a.m4a", "v.mp4", []) == "out.mp4"
+    calls = FakeCalibration(monkeypatch, {"nvenc": 300.0, "libx265": 40.0})
+    assert Downloader.ResolveAutoEncoders() == ["libx265"]
+    assert calls == []
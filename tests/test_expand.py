@@ -0,0 +1,33 @@
+import yt_dlp
+
+import Downloader
+
+
+def test_failing_page_ends_only_that_collection(monkeypatch, capsys):
+    def FailingCollection(url, depth=0):
+        yield "https://www.youtube.com/watch?v=aaaaaaaaaaa"
+        yield "https://www.youtube.com/watch?v=bbbbbbbbbbb"
+        raise yt_dlp.utils.ExtractorError("page 2 failed")
+
+    monkeypatch.setattr(Downloader, "ExpandCollection", FailingCollection)
+    urls = list(Downloader.ExpandUrls([
+        "https://www.youtube.com/@channel",
+        "https://www.youtube.com/watch?v=ccccccccccc",
+    ]))
+
+    assert urls == [
+        "https://www.youtube.com/watch?v=aaaaaaaaaaa",
+        "https://www.youtube.com/watch?v=bbbbbbbbbbb",
+        "https://www.youtube.com/watch?v=ccccccccccc",
+    ]
+    assert "page 2 failed" in capsys.readouterr().out
+
+
+def test_duplicate_videos_are_yielded_once():
+    urls = list(Downloader.ExpandUrls([
+        "https://www.youtube.com/watch?v=aaaaaaaaaaa",
+        "https://youtu.be/aaaaaaaaaaa",
+        "https://www.youtube.com/watch?v=bbbbbbbbbbb",
+    ]))
+
+    assert urls == ["https://www.youtube.com/watch?v=aaaaaaaaaaa", "https://www.youtube.com/watch?v=bbbbbbbbbbb"]
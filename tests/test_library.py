@@ -0,0 +1,28 @@
+import sqlite3
+
+import Downloader
+
+
+class LockedForWrites:
+
+    # Reads go through, writes fail like on a database another process holds locked
+    def __init__(self, db):
+        self.db = db
+
+    def execute(self, sql, *args):
+        if not sql.lstrip().upper().startswith("SELECT"):
+            raise sqlite3.OperationalError("database is locked")
+        return self.db.execute(sql, *args)
+
+
+def test_lookup_of_a_moved_file_is_a_miss_even_when_the_index_is_locked(tmp_path, monkeypatch):
+    output = tmp_path / "video.mp4"
+    output.write_bytes(b"video")
+    Downloader.RecordLibraryEntry("aaaaaaaaaaa", "video", "libx265", str(output))
+    assert Downloader.LookupLibrary("aaaaaaaaaaa", "video", "libx265") == str(output)
+
+    output.unlink()
+    locked = LockedForWrites(Downloader.GetLibraryIndex())
+    monkeypatch.setattr(Downloader, "GetLibraryIndex", lambda: locked)
+
+    assert Downloader.LookupLibrary("aaaaaaaaaaa", "video", "libx265") is None
@@ -0,0 +1,34 @@
+import threading
+
+import pytest
+
+import Downloader
+
+
+STAGE_PREFIXES = ("metadata-", "sponsors-", "download-", "encode-")
+
+
+def StageThreads():
+    return [t for t in threading.enumerate() if t.name.startswith(STAGE_PREFIXES)]
+
+
+def test_stages_stop_when_feeding_fails():
+    def FailingUrls():
+        raise RuntimeError("url source broke")
+        yield
+
+    with pytest.raises(RuntimeError, match="url source broke"):
+        Downloader.RunBatchPipeline(FailingUrls(), "audio", audio_format=Downloader.AUDIO_FORMATS["aac"])
+
+    assert StageThreads() == []
+
+
+def test_stages_stop_when_the_library_lookup_fails(monkeypatch):
+    def BrokenLookup(video_id, mode, variant):
+        raise OSError("index unreadable")
+
+    monkeypatch.setattr(Downloader, "LookupLibrary", BrokenLookup)
+    with pytest.raises(OSError):
+        Downloader.RunBatchPipeline(iter(["https://youtu.be/aaaaaaaaaaa"]), "audio", audio_format=Downloader.AUDIO_FORMATS["aac"])
+
+    assert StageThreads() == []
@@ -0,0 +1,30 @@
+import threading
+import time
+
+import pytest
+
+import Downloader
+
+
+@pytest.fixture
+def full_disk(tmp_path, monkeypatch):
+    # Another job holds a reservation and the disk has no room for more
+    monkeypatch.setattr(Downloader, "SCRATCH_MIN_FREE", 10 ** 18)
+    other = Downloader.ReserveScratch(tmp_path, 0)
+    yield tmp_path
+    Downloader.ReleaseScratch(other)
+
+
+def test_cancel_ends_the_wait_for_scratch_space(full_disk):
+    control = Downloader.JobControl()
+    threading.Timer(0.2, control.cancel.set).start()
+
+    started = time.monotonic()
+    with Downloader.JobContext(control), pytest.raises(Downloader.JobCancelled):
+        Downloader.ReserveScratch(full_disk, 1024, "video")
+    assert time.monotonic() - started < 5
+
+
+def test_wait_for_scratch_space_can_time_out(full_disk):
+    with pytest.raises(TimeoutError):
+        Downloader.ReserveScratch(full_disk, 1024, "video", timeout=0.2)
@@ -0,0 +1,67 @@
+import pytest
+import requests
+
+import Downloader
+
+
+@pytest.fixture(autouse=True)
+def small_segments(monkeypatch):
+    monkeypatch.setattr(Downloader, "SEGMENT_SIZE", 256 * 1024)
+    monkeypatch.setattr(Downloader.time, "sleep", lambda seconds: None)
+
+
+@pytest.fixture
+def responses(monkeypatch):
+    # Every response the download opens, and whether it was closed again
+    opened = []
+    get, close = requests.Session.get, requests.Response.close
+
+    def Get(self, *args, **kwargs):
+        response = get(self, *args, **kwargs)
+        opened.append(response)
+        return response
+
+    def Close(self):
+        self.test_closed = True
+        close(self)
+
+    monkeypatch.setattr(requests.Session, "get", Get)
+    monkeypatch.setattr(requests.Response, "close", Close)
+    return opened
+
+
+def test_downloads_all_ranges(range_server, tmp_path, responses):
+    output = tmp_path / "out.bin"
+    Downloader.SegmentedDownload(range_server.url, output, connections=3)
+
+    assert output.read_bytes() == range_server.blob
+    assert not (tmp_path / "out.bin.segments.json").exists()
+    assert all(getattr(response, "test_closed", False) for response in responses)
+
+
+def test_dropped_responses_are_retried(range_server, tmp_path):
+    range_server.short_reads = 3
+    output = tmp_path / "out.bin"
+    Downloader.SegmentedDownload(range_server.url, output, connections=2)
+
+    assert output.read_bytes() == range_server.blob
+
+
+def test_server_ignoring_range_is_refused_before_the_download(range_server, tmp_path, responses):
+    range_server.ignore_range = True
+    with pytest.raises(RuntimeError, match="range requests"):
+        Downloader.SegmentedDownload(range_server.url, tmp_path / "out.bin")
+
+    assert len(range_server.requests) == 1
+    assert all(getattr(response, "test_closed", False) for response in responses)
+
+
+def test_full_responses_to_ranges_fail_and_close_their_connection(range_server, tmp_path, responses):
+    # The probe gets its 206, every range after it a 200 with the whole file
+    range_server.ignore_range_after = 1
+    with pytest.raises(RuntimeError, match="HTTP 200"):
+        Downloader.SegmentedDownload(range_server.url, tmp_path / "out.bin", connections=1)
+
+    assert not (tmp_path / "out.bin").exists()
+    assert len(responses) == 1 + Downloader.SEGMENT_RETRIES
+    assert all(getattr(response, "test_closed", False) for response in responses)
@@ -0,0 +1,76 @@
+import Downloader
+
+
+SEGMENT = {"segment": [10.0, 20.0], "category": "sponsor"}
+CACHE_KEY = Downloader.SponsorCacheKey("aaaaaaaaaaa", ("sponsor", "selfpromo"))
+
+
+def test_failed_lookup_is_not_taken_for_no_segments(sponsorblock):
+    sponsorblock.fail = True
+    assert Downloader.FetchSponsorSegments("aaaaaaaaaaa") is None
+    assert Downloader.ReadCache("sponsors", CACHE_KEY) is None
+
+    sponsorblock.fail = False
+    sponsorblock.segments["aaaaaaaaaaa"] = [SEGMENT]
+    assert [item["segment"] for item in Downloader.FetchSponsorSegments("aaaaaaaaaaa")] == [SEGMENT["segment"]]
+
+
+def test_no_segments_answer_is_cached(sponsorblock):
+    assert Downloader.FetchSponsorSegments("aaaaaaaaaaa") == []
+    assert Downloader.ReadCache("sponsors", CACHE_KEY) == []
+
+
+def test_failed_lookup_is_not_checkpointed(sponsorblock, monkeypatch):
+    sponsorblock.fail = True
+    monkeypatch.setattr(Downloader, "ExtractVideoInfo", lambda url: {"id": "aaaaaaaaaaa", "title": "video"})
+
+    def StopDownload(*args, **kwargs):
+        raise RuntimeError("download stopped")
+
+    monkeypatch.setattr(Downloader, "GetPlatformAndOperatingSystem", StopDownload)
+    url = "https://www.youtube.com/watch?v=aaaaaaaaaaa"
+    assert Downloader.RunBatchPipeline([url], "audio", audio_format=("aac", "m4a"), state_key="test") == (0, 1)
+
+    record = Downloader.ReadBatchRecord("test", url)
+    assert record["stage"] == "extracted"
+    assert record["sponsors"] is None
+
+
+def Prefix(video_id):
+    return Downloader.hashlib.sha256(video_id.encode("utf-8")).hexdigest()[:Downloader.SPONSOR_HASH_PREFIX_LENGTH]
+
+
+def CollidingIds():
+    # Two ids that share a hash prefix bucket, found by trying ids in order
+    seen = {}
+    for n in range(100000):
+        video_id = f"vid{n:08d}"
+        if Prefix(video_id) in seen:
+            return seen[Prefix(video_id)], video_id
+        seen[Prefix(video_id)] = video_id
+
+
+def Cached(video_id):
+    return Downloader.ReadCache("sponsors", Downloader.SponsorCacheKey(video_id, ("sponsor", "selfpromo")))
+
+
+def test_prefetch_sends_one_request_per_prefix_and_fans_out(sponsorblock):
+    first, second = CollidingIds()
+    lonely, empty = "ccccccccccc", "ddddddddddd"
+    sponsorblock.segments = {first: [SEGMENT], lonely: [{"segment": [5.0, 6.0], "category": "selfpromo"}]}
+
+    ids = [first, second, lonely, empty, first]
+    assert Downloader.PrefetchSponsorSegments(ids) == 4
+
+    prefixes = {Prefix(video_id) for video_id in ids}
+    assert sorted(sponsorblock.requests) == sorted(f"/api/skipSegments/{prefix}" for prefix in prefixes)
+    assert [item["segment"] for item in Cached(first)] == [[10.0, 20.0]]
+    assert [item["segment"] for item in Cached(lonely)] == [[5.0, 6.0]]
+    assert Cached(second) == []
+    assert Cached(empty) == []
+
+    # Everything is cached now; FetchSponsorSegments doesn't ask again
+    sponsorblock.requests.clear()
+    assert Downloader.PrefetchSponsorSegments(ids) == 0
+    assert Downloader.FetchSponsorSegments(empty) == []
+    assert sponsorblock.requests == []
@@ -0,0 +1,49 @@
+import requests
+
+import Downloader
+
+
+class CountingScheduler(Downloader.BandwidthScheduler):
+
+    def __init__(self):
+        super().__init__(limit=1024 ** 3)
+        self.consumed = 0
+
+    def Consume(self, flow, size):
+        self.consumed += size
+        super().Consume(flow, size)
+
+
+def test_relay_copies_in_chunks_under_the_cap(range_server, monkeypatch):
+    scheduler = CountingScheduler()
+    monkeypatch.setattr(Downloader, "_bandwidth_scheduler", scheduler)
+
+    relay = Downloader.StreamRelay()
+    local = relay.Register(range_server.url, {}, 300 * 1024, weight=2.0)
+    data = requests.get(local, timeout=10).content
+
+    assert data == range_server.blob
+    assert scheduler.consumed == len(range_server.blob)
+    assert all(header and header.startswith("bytes=") for header in range_server.requests)
+    assert len(range_server.requests) == 4
+
+
+def test_relay_answers_range_requests(range_server):
+    relay = Downloader.StreamRelay()
+    local = relay.Register(range_server.url, {}, 300 * 1024)
+    response = requests.get(local, headers={"Range": "bytes=1000-1999"}, timeout=10)
+
+    assert response.status_code == 206
+    assert response.content == range_server.blob[1000:2000]
+
+
+def test_capped_streams_all_go_through_the_relay(monkeypatch):
+    monkeypatch.setattr(Downloader, "STREAMING", True)
+    monkeypatch.setattr(Downloader, "_bandwidth_scheduler", Downloader.BandwidthScheduler(limit=1024 ** 2))
+    monkeypatch.setattr(Downloader, "SelectFormats", lambda info, mode, audio_format=None: [
+        {"url": "https://example.invalid/audio", "protocol": "https"}])
+
+    audio, video = Downloader.ResolveStreamSources("audio", audio_format=("libmp3lame", "mp3"), info={"id": "x"})
+
+    assert video is None
+    assert audio.startswith("http://127.0.0.1:")